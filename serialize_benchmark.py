@@ -0,0 +1,102 @@
+#!/usr/local/bin/python
+# -*- coding: utf8 -*-
+"""Micro-benchmark of SOLRDocument serialization: toXML against the former ElementTree based serializer (and toJSON).
+Run it with python serialize_benchmark.py [number of documents]"""
+
+import sys
+import re
+import logging
+import timeit
+import datetime
+import warnings
+import xml.etree.cElementTree as ET
+
+import solrcl
+
+
+def legacyToXML(doc, update=True):
+    """SOLRDocument.toXML as implemented with ElementTree"""
+    def toElement(doc):
+        element = ET.Element('doc')
+        for field, value in doc._fields.iteritems():
+            if value[0] is None:
+                f = ET.SubElement(element, 'field', null='true', name=field)
+                if field != doc.solr.id_field and update:
+                    f.set('update', 'set')
+                f.text = ''
+            else:
+                for v in value:
+                    f = ET.SubElement(element, 'field', null='false', name=field)
+                    if field != doc.solr.id_field and update:
+                        f.set('update', 'set')
+                    f.text = doc.solr.fields[field].type.serialize(v)
+
+        for child in doc._child_docs:
+            element.append(toElement(child))
+        return element
+
+    return re.sub(r"^<\?xml version='1.0' encoding='[^']*'\?>\s*", '', ET.tostring(toElement(doc), encoding='utf8'))
+
+
+def fakeCore():
+    solr = solrcl.SOLRCore.__new__(solrcl.SOLRCore)
+    solr.id_field = 'id'
+    strtype = solrcl.SOLRType('string', 'org.apache.solr.schema.StrField')
+    texttype = solrcl.SOLRType('text', 'org.apache.solr.schema.TextField')
+    inttype = solrcl.SOLRType('int', 'org.apache.solr.schema.TrieIntField')
+    datetype = solrcl.SOLRType('date', 'org.apache.solr.schema.TrieDateField')
+    solr.fields = {
+        'id': solrcl.SOLRField('id', strtype),
+        'title': solrcl.SOLRField('title', texttype),
+        'tags': solrcl.SOLRField('tags', strtype, multi=True),
+        'count': solrcl.SOLRField('count', inttype),
+        'created': solrcl.SOLRField('created', datetype),
+        'removed': solrcl.SOLRField('removed', strtype),
+    }
+    return solr
+
+
+def makeDocs(solr, n):
+    docs = []
+    for i in xrange(n):
+        doc = solrcl.SOLRDocument(u'doc%d' % i, solr)
+        doc.setField('title', u'Title <%d> & "àèì€"' % i)
+        doc.setField('tags', [u'tag%d' % j for j in range(i % 10)] or None)
+        doc.setField('count', i)
+        doc.setField('created', datetime.datetime(2015, 1, 1, 12, 30) + datetime.timedelta(seconds=i))
+        doc.setField('removed', None)
+        if i % 5 == 0:
+            for j in range(3):
+                child = solrcl.SOLRDocument(u'doc%d.%d' % (i, j), solr)
+                child.setField('title', u'child %d' % j)
+                doc.addChild(child)
+        docs.append(doc)
+    return docs
+
+
+def main(n=10000, repeat=3):
+    logging.getLogger("solrcl").addHandler(logging.NullHandler())
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        solr = fakeCore()
+    docs = makeDocs(solr, n)
+
+    for doc in docs:
+        for update in (True, False):
+            assert doc.toXML(update=update) == legacyToXML(doc, update=update), "Different output for %s" % doc.id
+
+    timings = [
+        ('ElementTree toXML', lambda: [legacyToXML(doc) for doc in docs]),
+        ('toXML', lambda: [doc.toXML() for doc in docs]),
+        ('toJSON', lambda: [doc.toJSON() for doc in docs]),
+    ]
+    base = None
+    for (name, f) in timings:
+        best = min(timeit.repeat(f, number=1, repeat=repeat))
+        if base is None:
+            base = best
+        print "{0:<20} {1:8.0f} docs/s  {2:5.2f}x".format(name, n / best, base / best)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:2]])
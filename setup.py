@@ -7,5 +7,6 @@ setup(
         description='SOLR connection library',
         author='Zaccheo Bagnati',
         author_email='zaccheob@gmail.com',
-	install_requires=['requests>=2.2.0']
+	install_requires=['requests>=2.2.0'],
+	extras_require={'numpy': ['numpy']}
 )
@@ -12,11 +12,15 @@ __version__ = pkg_resources.get_distribution("solrcl").version
 
 from exceptions import SOLRError
 from document import SOLRDocumentError, SOLRDocumentWarning, SOLRDocument, SOLRDocumentFactory
-from base import SOLRNetworkError, SOLRResponseError, SOLRResponseFormatError, SOLRRequest, SOLRBase
+from base import SOLRNetworkError, SOLRResponseError, SOLRBadRequestError, SOLRResponseFormatError, SOLRRequest, SOLRBase, iterJSONDocs
 from core import MissingRequiredField, DocumentNotFound, SOLRReplicationError, ThreadError, SOLRCore
 from admin import SOLRAdmin
+from dispatcher import UpdateDispatcher, DispatcherStats, SpoolQueue, LoadJournal, SerializerPool, ConcurrencyController
 from create import initCore, freeCore, initSlaveSolrCore, SOLRInitError, ExecuteCommandsError
 from log import BaseLogFormatter, ExtendedLogFormatter, HttpLogFilter
 from solrtype import SOLRType, NotImplementedSOLRTypeWarning, solr2datetime, datetime2solr
 from solrfield import SOLRField
-from base import DEFAULT_SOLR_DOMAIN, DEFAULT_SOLR_PORT
+from schema import SOLRSchema
+from idstore import SetIdStore, SortedIdStore, BloomIdStore
+from cache import CacheManager, ResultCache
+from base import DEFAULT_SOLR_DOMAIN, DEFAULT_SOLR_PORT, DEFAULT_POOL_CONNECTIONS, DEFAULT_POOL_MAXSIZE
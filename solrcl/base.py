@@ -1,10 +1,15 @@
 # -*- coding: utf8 -*-
 
 import logging
+import threading
+import codecs
+import json
 import requests
+import requests.adapters
 import httplib
 
 import exceptions
+from cache import CacheManager, ResultCache, deepSizeOf
 
 #Create a custom logger
 logger = logging.getLogger("solrcl")
@@ -12,32 +17,77 @@ logger.setLevel(logging.DEBUG)
 
 DEFAULT_SOLR_DOMAIN="localhost"
 DEFAULT_SOLR_PORT=8983
+DEFAULT_POOL_CONNECTIONS=10
+DEFAULT_POOL_MAXSIZE=10
 
 class SOLRNetworkError(exceptions.SOLRError): pass
 class SOLRResponseError(exceptions.SOLRError):
 	def __init__(self, message, httpStatus=httplib.OK):
 		Exception.__init__(self, message)
 		self.httpStatus = httpStatus
+class SOLRBadRequestError(SOLRResponseError):
+	"""SOLRResponseError for requests rejected by SOLR as invalid (HTTP 400), e.g. documents not matching the schema"""
 class SOLRResponseFormatError(exceptions.SOLRError): pass
 
+def _responseError(message, httpStatus):
+	if httpStatus == httplib.BAD_REQUEST:
+		return SOLRBadRequestError(message, httpStatus=httpStatus)
+	return SOLRResponseError(message, httpStatus=httpStatus)
+
 
 class SOLRRequest(object):
 	"""
 Base class providing SOLR connection and a method :attr:`.request` for making http requests to SOLR. This class should not be used directly.
+
+Connections are kept in a pool shared by all the threads using the instance: pool_connections is the number of per-host pools to cache,
+pool_maxsize is the number of connections kept open for each host, pool_block=True makes pool_maxsize a hard limit (requests wait for a
+free connection instead of opening a new one) and keep_alive=False asks SOLR to close the connection after each request.
+
+If conditional_bytes is set GET responses with ETag or Last-Modified headers (see SOLR httpCaching) are stored, at most
+conditional_bytes of them, and requested again with If-None-Match/If-Modified-Since: on 304 Not Modified the stored
+response is returned without downloading and parsing it. Stored responses are shared and must not be modified.
 	"""
-	def __init__(self, domain=DEFAULT_SOLR_DOMAIN, port=DEFAULT_SOLR_PORT):
+	def __init__(self, domain=DEFAULT_SOLR_DOMAIN, port=DEFAULT_SOLR_PORT, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False, keep_alive=True, conditional_bytes=None):
 		self.domain = domain
 		self.port = port
+		self.keep_alive = keep_alive
 		self.logger = logging.LoggerAdapter(logger, {'domain': self.domain, 'port': self.port})
 
+		#The adapter holds the (thread safe) urllib3 connection pool. Sessions are not guaranteed to be thread safe, so
+		#each thread gets its own session mounting the same adapter
+		self._adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+		self._local = threading.local()
+
+		#(etag, last_modified, response) tuples by request
+		self.conditional = None if conditional_bytes is None else CacheManager(max_bytes=conditional_bytes)
+		#Number of responses returned from conditional store
+		self.not_modified = 0
+
+	@property
+	def session(self):
+		"""requests.Session for the current thread, sharing the connection pool of the instance"""
+		try:
+			return self._local.session
+		except AttributeError:
+			session = requests.Session()
+			session.mount('http://', self._adapter)
+			if not self.keep_alive:
+				session.headers['Connection'] = 'close'
+			self._local.session = session
+			return session
+
+	def close(self):
+		"""Closes all pooled connections"""
+		self._adapter.close()
+
 	def request(self, resource, parameters={}, data=None, dataMIMEType='text/xml'):
 
 		#Infers request method from the value of 'data' parameter
 		if not data is None:
-			req_method = requests.post
+			req_method = self.session.post
 			headers = {'Content-type': dataMIMEType}
 		else:
-			req_method = requests.get
+			req_method = self.session.get
 			headers = {}
 
 		#Set default output /Re/presentation for /S/tate /T/ransfer
@@ -51,9 +101,24 @@ Base class providing SOLR connection and a method :attr:`.request` for making ht
 
 		self.logger.debug("Requesting: {0} {1}".format(resource, parameters))
 
+		stored = None
+		if data is None and not self.conditional is None:
+			conditional_key = (resource, ResultCache.key(parameters))
+			stored = self.conditional.get(conditional_key)
+			if not stored is None:
+				(etag, last_modified, _) = stored
+				if etag:
+					headers['If-None-Match'] = etag
+				if last_modified:
+					headers['If-Modified-Since'] = last_modified
+
 		try:
 			#This makes the request
 			r = req_method(resource, params=parameters, headers=headers, data=data)
+			if not stored is None and r.status_code == httplib.NOT_MODIFIED:
+				self.logger.debug("Not modified: {0}".format(resource))
+				self.not_modified += 1
+				return stored[2]
 			try:
 				#Only json supported for now...
 				if r.headers.get('content-type') in ('application/json; charset=UTF-8', 'application/json'):
@@ -67,7 +132,7 @@ Base class providing SOLR connection and a method :attr:`.request` for making ht
 					r.raise_for_status()
 					raise SOLRResponseError, "Unsupported response content type {0}".format(r.headers.get('content-type'))
 			except requests.HTTPError, err:
-				raise SOLRResponseError("HTTP request error: {0} requesting {1}".format(err, resource), httpStatus=r.status_code)
+				raise _responseError("HTTP request error: {0} requesting {1}".format(err, resource), r.status_code)
 
 		except requests.RequestException, err:
 			raise SOLRNetworkError("{0} requesting {1}".format(err, resource))
@@ -75,18 +140,111 @@ Base class providing SOLR connection and a method :attr:`.request` for making ht
 			
 		try:
 			if response.has_key('responseHeader') and response['responseHeader']['status'] == 0:
+				if data is None and not self.conditional is None:
+					self._storeConditional(conditional_key, r, response)
 				return response
 			elif not response.has_key('responseHeader') and response.has_key('error'):
-				raise SOLRResponseError, "Error in SOLR response: {0} {1} {2}".format(response['error']['code'], response['error']['msg'], response['error'].get('trace', ''))
+				raise _responseError("Error in SOLR response: {0} {1} {2}".format(response['error']['code'], response['error']['msg'], response['error'].get('trace', '')), response['error']['code'])
 			else:
-				raise SOLRResponseError, "Error in SOLR response: {0} {1}".format(response['responseHeader']['status'], response['error']['msg'])
+				raise _responseError("Error in SOLR response: {0} {1}".format(response['responseHeader']['status'], response['error']['msg']), response['error'].get('code', response['responseHeader']['status']))
 		except KeyError, msg:
 			raise SOLRResponseFormatError, "Wrong response format: {0}: {1} - {2}".format(KeyError, msg, repr(response))
 
+	def _storeConditional(self, key, r, response):
+		etag = r.headers.get('etag')
+		last_modified = r.headers.get('last-modified')
+		if etag or last_modified:
+			self.conditional.set(key, (etag, last_modified, response), size=deepSizeOf(response))
+		elif key in self.conditional:
+			del self.conditional[key]
+
+	def streamRequest(self, resource, parameters={}, chunk_size=65536):
+		"""Makes a GET request returning an iterator over unicode chunks of the response body as they arrive, without loading
+the whole response in memory"""
+		parameters.setdefault('wt', 'json')
+
+		if not resource.startswith('/'):
+			resource = '/solr/{0}'.format(resource)
+
+		resource = 'http://{0}:{1}{2}'.format(self.domain, self.port, resource)
+
+		self.logger.debug("Requesting (stream): {0} {1}".format(resource, parameters))
+
+		try:
+			r = self.session.get(resource, params=parameters, stream=True)
+			try:
+				r.raise_for_status()
+			except requests.HTTPError, err:
+				r.close()
+				raise SOLRResponseError("HTTP request error: {0} requesting {1}".format(err, resource), httpStatus=r.status_code)
+		except requests.RequestException, err:
+			raise SOLRNetworkError("{0} requesting {1}".format(err, resource))
+
+		def gen():
+			decoder = codecs.getincrementaldecoder('utf8')()
+			try:
+				for chunk in r.iter_content(chunk_size=chunk_size):
+					yield decoder.decode(chunk)
+				yield decoder.decode('', final=True)
+			except requests.RequestException, err:
+				raise SOLRNetworkError("{0} requesting {1}".format(err, resource))
+			finally:
+				#Releases the connection also when the consumer stops before the end
+				r.close()
+
+		return gen()
+
+
+def iterJSONDocs(chunks):
+	"""Incrementally parses a SOLR json response read from chunks iterator (unicode strings) yielding one by one the
+objects in the response docs list. Only the document being parsed is kept in memory"""
+	decoder = json.JSONDecoder()
+	whitespace = u' \t\n\r'
+	buf = u''
+	pos = None
+	chunks = iter(chunks)
+	eof = False
+
+	while True:
+		if pos is None:
+			#Looks for the beginning of docs list
+			start = buf.find(u'"docs"')
+			if start >= 0:
+				bracket = buf.find(u'[', start)
+				if bracket >= 0:
+					buf = buf[bracket + 1:]
+					pos = 0
+					continue
+		else:
+			while pos < len(buf) and buf[pos] in whitespace + u',':
+				pos += 1
+			if pos < len(buf):
+				if buf[pos] == u']':
+					return
+				try:
+					(doc, end) = decoder.raw_decode(buf, pos)
+				except ValueError:
+					#Incomplete document: needs more data
+					pass
+				else:
+					yield doc
+					pos = end
+					continue
+			#Discards already parsed data
+			buf = buf[pos:]
+			pos = 0
+
+		if eof:
+			raise SOLRResponseFormatError, "Wrong response format: {0}".format("docs list not found" if pos is None else "truncated docs list")
+		try:
+			buf += chunks.next()
+		except StopIteration:
+			eof = True
+
 
 class SOLRBase(SOLRRequest):
-	def __init__(self, domain=DEFAULT_SOLR_DOMAIN, port=DEFAULT_SOLR_PORT):
-		super(SOLRBase, self).__init__(domain=domain, port=port)
+	def __init__(self, domain=DEFAULT_SOLR_DOMAIN, port=DEFAULT_SOLR_PORT, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False, keep_alive=True, conditional_bytes=None):
+		super(SOLRBase, self).__init__(domain=domain, port=port, pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block, keep_alive=keep_alive, conditional_bytes=conditional_bytes)
 
 		data = self.request("/solr/admin/info/system")
 		try:
@@ -0,0 +1,255 @@
+# -*- coding: utf8 -*-
+"""Memory budgeted caches of SOLRCore"""
+
+import sys
+import time
+import threading
+import collections
+
+
+def deepSizeOf(value):
+    """Estimated memory used by value and the containers and strings it references (e.g. a parsed JSON response)"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deepSizeOf(k) + deepSizeOf(v) for (k, v) in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deepSizeOf(x) for x in value)
+    return size
+
+
+def sizeOf(value):
+    """Estimated memory used by value: its nbytes attribute if any (e.g. id stores), otherwise sys.getsizeof"""
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is None:
+        nbytes = sys.getsizeof(value)
+    return nbytes
+
+
+class _Entry(object):
+    __slots__ = ('value', 'size', 'time', 'ids', 'stale')
+
+    def __init__(self, value, size, ids):
+        self.value = value
+        self.size = size
+        self.time = time.time()
+        self.ids = ids
+        #Ids changed after the entry was built: lookups for them must not use value
+        self.stale = set()
+
+
+class CacheManager(object):
+    """LRU cache with a memory budget: when entries (sized with sizeOf when they are set) exceed max_bytes least recently
+used ones are evicted. Entries older than ttl seconds are expired. Entries set with ids=True hold ids membership (e.g.
+blockjoin prefetch caches): invalidateIds marks the changed ids stale in them instead of dropping them, until more than
+max_stale ids are stale. hits, misses, evictions, expirations and invalidations are counted. Keys evicted (or not stored)
+for the memory budget are remembered until they are set again or the cache is cleared (see wasEvicted)"""
+    def __init__(self, max_bytes=None, ttl=None, max_stale=10000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()
+        self._evicted = set()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.nbytes -= entry.size + len(entry.stale) * sys.getsizeof(0)
+
+    def _entry(self, key):
+        #Returns the live entry for key (moving it to most recently used) or None
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not self.ttl is None and time.time() - entry.time > self.ttl:
+            self._drop(key)
+            self.expirations += 1
+            return None
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry.value
+
+    def set(self, key, value, size=None, ids=False):
+        """Stores value in key and returns it. It is not stored if it alone exceeds max_bytes"""
+        if size is None:
+            size = sizeOf(value)
+        with self._lock:
+            if self._entries.has_key(key):
+                self._drop(key)
+            if not self.max_bytes is None and size > self.max_bytes:
+                self._evicted.add(key)
+                self.evictions += 1
+                return value
+            self._evicted.discard(key)
+            self._entries[key] = _Entry(value, size, ids)
+            self.nbytes += size
+            self._evict()
+        return value
+
+    def _evict(self):
+        while not self.max_bytes is None and self.nbytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._drop(key)
+            self._evicted.add(key)
+            self.evictions += 1
+
+    def wasEvicted(self, key):
+        """Returns True if key was evicted (or not stored) because of the memory budget"""
+        with self._lock:
+            return key in self._evicted
+
+    def isStale(self, key, solrid):
+        """Returns True if solrid has been invalidated after the entry key was set"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return not entry is None and solrid in entry.stale
+
+    def invalidateIds(self, ids):
+        """Marks ids as changed: they become stale in ids entries, other entries are dropped. ids entries with more than
+max_stale stale ids are dropped too"""
+        ids = set(ids)
+        if not ids:
+            return
+        with self._lock:
+            for (key, entry) in self._entries.items():
+                if entry.ids:
+                    new = ids - entry.stale
+                    if len(entry.stale) + len(new) <= self.max_stale:
+                        entry.stale.update(new)
+                        self.nbytes += len(new) * sys.getsizeof(0)
+                        continue
+                self._drop(key)
+                self.invalidations += 1
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._evicted.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return not self._entry(key) is None
+
+    def has_key(self, key):
+        return key in self
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            return entry.value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hitRatio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def __repr__(self):
+        return "<CacheManager: {0} entries, {1} bytes, hits {2}, misses {3}, evictions {4}, expirations {5}, invalidations {6}>".format(len(self), self.nbytes, self.hits, self.misses, self.evictions, self.expirations, self.invalidations)
+
+
+class ResultCache(object):
+    """LRU cache of select responses (see SOLRCore result_cache) keyed on normalized query parameters, holding at most
+max_bytes (estimated with deepSizeOf). All entries are invalidated when the index version changes: it is checked at most
+once every check_interval seconds, so responses may be check_interval seconds older than the index. Cached responses are
+shared and must not be modified"""
+    def __init__(self, max_bytes=64 * 1024 * 1024, check_interval=5.0):
+        self.check_interval = check_interval
+        self.version = None
+        self.version_checks = 0
+        self._checked = None
+        self._lock = threading.Lock()
+        self._cache = CacheManager(max_bytes=max_bytes)
+
+    @staticmethod
+    def key(query):
+        """Returns the hashable normalized form of query parameters: order of parameters and of filter queries is not
+relevant"""
+        def normalize(value):
+            #Strings are left as they are: byte strings may not be ascii
+            return value if isinstance(value, basestring) else unicode(value)
+
+        items = []
+        for (name, value) in query.iteritems():
+            if isinstance(value, (list, tuple)):
+                value = tuple(normalize(x) for x in value)
+                if name == 'fq':
+                    value = tuple(sorted(value))
+            else:
+                value = normalize(value)
+            items.append((name, value))
+        if not query.has_key('wt'):
+            items.append(('wt', u'json'))
+        return tuple(sorted(items))
+
+    def checkVersion(self, version_f):
+        """Calls version_f (if check_interval is elapsed since last call) and clears the cache if the version changed"""
+        with self._lock:
+            now = time.time()
+            if not self._checked is None and now - self._checked < self.check_interval:
+                return
+            version = version_f()
+            self.version_checks += 1
+            self._checked = now
+            if version != self.version:
+                self._cache.clear()
+                self.version = version
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, response, version):
+        """Stores response got for index version"""
+        with self._lock:
+            #The index changed while the response was requested
+            if version != self.version:
+                return
+            self._cache.set(key, response, size=deepSizeOf(response))
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._checked = None
+
+    @property
+    def hitRatio(self):
+        return self._cache.hitRatio
+
+    @property
+    def nbytes(self):
+        return self._cache.nbytes
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __repr__(self):
+        return "<ResultCache: {0} responses, {1} bytes, hit ratio {2:.2f}, index version {3}>".format(len(self), self.nbytes, self.hitRatio, self.version)
@@ -11,11 +11,26 @@ import warnings
 import threading
 import Queue
 import logging
+import collections
+import itertools
+import json
+import urllib
+
+#numpy is optional: needed only for columnar output
+try:
+    import numpy
+except ImportError:
+    numpy = None
     
 from solrcl.base import *
 from solrcl.solrtype import *
 from solrcl.solrfield import *
+from solrcl.schema import *
 from solrcl.document import *
+from solrcl.document import _escapeText
+from solrcl.dispatcher import *
+from solrcl.idstore import newIdStore
+from solrcl.cache import CacheManager, ResultCache
 import solrcl.exceptions
 
 #Create a custom logger
@@ -24,6 +39,22 @@ logger.setLevel(logging.DEBUG)
 
 SOLR_REPLICATION_DATETIME_FORMAT = '%a %b %d %H:%M:%S %Z %Y'
 
+#Separators of terms query values containing commas: no whitespace (SOLR splits on any whitespace then) nor characters
+#invalid in XML delete requests
+TERMS_SEPARATORS = u'|;~^'
+
+#Selects with longer (url encoded) parameters are sent as POST form data: SOLR (Jetty) rejects request headers over 8KB
+MAX_GET_QUERY_BYTES = 4096
+
+#numpy dtypes for columnar output by SOLR type class. Other types are returned as object arrays
+COLUMNAR_DTYPES = {
+    'TrieIntField': 'int32',
+    'TrieLongField': 'int64',
+    'TrieFloatField': 'float64',
+    'TrieDoubleField': 'float64',
+    'TrieDateField': 'datetime64[ms]',
+}
+
 class MissingRequiredField(exceptions.SOLRError):
     """Exception raised when a required field is missing in the schema"""
     pass
@@ -42,9 +73,15 @@ class ThreadError(exceptions.SOLRError):
 
 class SOLRCore(SOLRBase):
     """Class representing SOLR core with methods for acting on it"""
-    def __init__(self, core, domain=DEFAULT_SOLR_DOMAIN, port=DEFAULT_SOLR_PORT, blockjoin_condition=None):
+    def __init__(self, core, domain=DEFAULT_SOLR_DOMAIN, port=DEFAULT_SOLR_PORT, blockjoin_condition=None, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False, keep_alive=True, prefetch_store='set', cache_bytes=None, cache_ttl=None, result_cache=None, conditional_bytes=None):
         self.core = core
-        super(SOLRCore, self).__init__(domain=domain, port=port)
+        #Kind of id store for prefetched blockjoin ids: 'set', 'sorted' or 'bloom' (see solrcl.idstore)
+        self.prefetch_store = prefetch_store
+        #Enabled when the core is opened
+        self.result_cache = None
+        #Prefetched id stores used by a running loadDocs, whether they fit in cache or not
+        self._pinned_stores = None
+        super(SOLRCore, self).__init__(domain=domain, port=port, pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block, keep_alive=keep_alive, conditional_bytes=conditional_bytes)
         self._setLogger()
         try:
             self._setSchema()
@@ -67,8 +104,12 @@ class SOLRCore(SOLRBase):
             except SOLRResponseError, e:
                 raise SOLRResponseError("Invalid blockjoin condition: '%s': %s" % (self.blockjoin_condition, e), httpStatus=e.httpStatus)
 
-        #Set caches
-        self.cache = {}
+        #Set caches: at most cache_bytes (unlimited if None) of entries newer than cache_ttl seconds
+        self.cache = CacheManager(max_bytes=cache_bytes, ttl=cache_ttl)
+        #Cache of select responses (a ResultCache, True for the default one), disabled if None
+        if result_cache is True:
+            result_cache = ResultCache()
+        self.result_cache = result_cache
 
         self.logger.debug("Core opened")
 
@@ -76,6 +117,16 @@ class SOLRCore(SOLRBase):
         """Setup a custom logger for the class customized for printing solr context"""
         self.logger = logging.LoggerAdapter(logger, {'domain': self.domain, 'port': self.port, 'core': self.core})
 
+    @property
+    def schema(self):
+        """Read-only snapshot (SOLRSchema) of fields and id field, referenced by SOLRDocument instances. It is rebuilt
+when fields are reloaded"""
+        schema = getattr(self, '_schema', None)
+        if schema is None or not self._schema_fields is self.fields or schema.id_field != self.id_field:
+            self._schema = schema = SOLRSchema(self.id_field, self.fields)
+            self._schema_fields = self.fields
+        return schema
+
     def _setTypes(self, solrtypesdict):
         """Setup core types from schema"""
         self.types = {}
@@ -88,7 +139,9 @@ class SOLRCore(SOLRBase):
             fieldsdict[fieldname] = SOLRField(
                 fieldname,
                 self.types[fieldspecs['type']],
-                multi={'M': True}.get(fieldspecs['flags'][4], False)
+                multi={'M': True}.get(fieldspecs['flags'][4], False),
+                docValues={'D': True}.get(fieldspecs['flags'][3], False),
+                stored={'S': True}.get(fieldspecs['flags'][2], False)
                 )
 
     def _setSchema(self):
@@ -133,13 +186,44 @@ absolute requests are left as they are"""
             r = "{0}/{1}".format(self.core, resource)
         return super(SOLRCore, self).request(r, parameters=parameters, data=data, dataMIMEType=dataMIMEType)
 
+    def streamRequest(self, resource, parameters={}, chunk_size=65536):
+        """Wraps base streamRequest method adding corename to relative requests.
+absolute requests are left as they are"""
+        if resource.startswith('/'):
+            r = resource
+        else:
+            r = "{0}/{1}".format(self.core, resource)
+        return super(SOLRCore, self).streamRequest(r, parameters=parameters, chunk_size=chunk_size)
+
     def ping(self):
         """admin/ping SOLR request"""
         return self.request('admin/ping', parameters={'ts': '{0}'.format(time.mktime(datetime.datetime.now().timetuple()))})
 
     def select(self, query):
-        """select SOLR request, query should be a dictionary containing query parameters"""
-        return self.request('select', parameters=query)
+        """select SOLR request, query should be a dictionary containing query parameters. If result_cache is set responses
+are cached until index version (see getIndexVersion) changes"""
+        if self.result_cache is None:
+            return self._selectRequest(query)
+
+        self.result_cache.checkVersion(self.getIndexVersion)
+        key = ResultCache.key(query)
+        version = self.result_cache.version
+        response = self.result_cache.get(key)
+        if response is None:
+            response = self._selectRequest(query)
+            self.result_cache.set(key, response, version)
+        return response
+
+    def _selectRequest(self, query):
+        """Sends select request with query parameters in URL, or as form data if they exceed MAX_GET_QUERY_BYTES (e.g. terms
+queries of getDocs chunks)"""
+        def encode(value):
+            return value.encode('utf8') if isinstance(value, unicode) else value
+
+        body = urllib.urlencode([(name, [encode(x) for x in value] if isinstance(value, (list, tuple)) else encode(value)) for (name, value) in query.iteritems() if name != 'wt'], doseq=True)
+        if len(body) <= MAX_GET_QUERY_BYTES:
+            return self.request('select', parameters=query)
+        return self.request('select', parameters={'wt': query.get('wt', 'json')}, data=body, dataMIMEType='application/x-www-form-urlencoded; charset=UTF-8')
 
     def _iterResponseDocs(self, response, fields):
         """Transform SOLR json response for select in an iterator over tuples"""
@@ -147,6 +231,75 @@ absolute requests are left as they are"""
         for doc in docs:
             yield tuple(doc.get(f) for f in fields)
 
+    def _isExportable(self, fields):
+        """Returns True if all fields can be retrieved with /export request handler (docValues fields)"""
+        for fieldname in fields:
+            field = self.fields.get(fieldname)
+            if field is None or not getattr(field, 'docValues', False):
+                return False
+        return True
+
+    def exportIter(self, query, fields=None, limit=None, sort='', blocksize=10000, parallel=6, cursor=False, partitions=None, partition_field=None, window=None):
+        """Iterates over all results for query as tuples of field values using /export request handler: the whole sorted
+result set is streamed in one response and parsed while it arrives. All fields (and sort fields) must be docValues
+enabled: if not, it falls back to selectAllIter (blocksize, parallel, cursor, partitions, partition_field and window are
+used only in this case). Sort defaults to unique key field"""
+        if fields is None:
+            fields = (self.id_field,)
+        export_sort = sort if sort else "{0} asc".format(self.id_field)
+
+        sort_fields = [clause.split()[0] for clause in export_sort.split(',') if clause.strip()]
+        if not self._isExportable(tuple(fields) + tuple(sort_fields)):
+            self.logger.debug("Fields ({0}) are not all docValues enabled: export not available".format(','.join(fields)))
+            for d in self.selectAllIter(query, fields, limit=limit, blocksize=blocksize, parallel=parallel, sort=sort, cursor=cursor, partitions=partitions, partition_field=partition_field, window=window):
+                yield d
+            return
+
+        self.logger.debug("Exporting fields ({0}) for records matching: '{1}'".format(','.join(fields), query))
+
+        chunks = self.streamRequest('export', parameters={'q': query, 'fl': ','.join(fields), 'sort': export_sort})
+        selected = 0
+        try:
+            for doc in iterJSONDocs(chunks):
+                if not limit is None and selected >= limit:
+                    break
+                if doc.has_key('EXCEPTION'):
+                    #Export handler reports errors inside docs list
+                    raise SOLRResponseError, "Error in SOLR export response: {0}".format(doc['EXCEPTION'])
+                yield tuple(doc.get(f) for f in fields)
+                selected += 1
+        finally:
+            chunks.close()
+
+        self.logger.debug("{0} records exported".format(selected))
+
+    def _columnDtype(self, fieldname):
+        """Returns numpy dtype for field values in columnar output (None for object arrays)"""
+        field = self.fields.get(fieldname)
+        if field is None or field.multi:
+            return None
+        return COLUMNAR_DTYPES.get(field.type.className.rsplit('.', 1)[-1])
+
+    def _responseColumns(self, docs, fields):
+        """Transform docs from SOLR json response for select in a dictionary of numpy arrays, one per field, typed from schema.
+Missing values are NaN for float fields, NaT for date fields and make integer fields fall back to object arrays"""
+        columns = {}
+        for f in fields:
+            values = [doc.get(f) for doc in docs]
+            dtype = self._columnDtype(f)
+            if not dtype is None and dtype.startswith('datetime64'):
+                #SOLR dates are UTC: timezone designator is removed because numpy datetime64 is timezone naive
+                columns[f] = numpy.array([u'NaT' if v is None else v.rstrip(u'Z') for v in values], dtype=dtype)
+            elif dtype == 'float64':
+                columns[f] = numpy.array([numpy.nan if v is None else v for v in values], dtype=dtype)
+            elif not dtype is None and not None in values:
+                columns[f] = numpy.array(values, dtype=dtype)
+            else:
+                #Assigning to an empty array avoids numpy building multidimensional arrays from multivalued fields
+                columns[f] = numpy.empty(len(values), dtype=object)
+                columns[f][:] = values
+        return columns
+
     def listFieldValuesIter(self, field, filter=None):
         """Iterates over all distinct values for a field"""
         if filter is None:
@@ -168,54 +321,234 @@ absolute requests are left as they are"""
         for r in zip(response['facet_counts']['facet_fields'][field][::2], response['facet_counts']['facet_fields'][field][1::2]):
             yield r
 
-    def selectAllIter(self, query, fields=None, limit=None, blocksize=10000, parallel=6, start_blocksize=100, sort=''):
-        """Iterates over all results for query as tuples of field values. query is a SOLR query string, fields are
-the fields to be retrieved, limit is the maximum number of result to return, parallel is the number of simultaneous
-requests to SOLR, blocksize is the number of documents to retrieve per request, start_blocksize is the number of 
-documents to retrieve for the only first request (to optimize response times for smaller result sets), sort is the
-sort parameter to pass to SOLR"""
-        if sort and parallel > 1:
-            parallel = 1
-            warnings.warn("Cannot sort parallel query: using single process")
-        if fields is None:
-            fields = (self.id_field,)
-        self.logger.debug("Selecting fields ({0}) for records matching: '{1}'".format(','.join(fields), query))
+    def _cursorSort(self, sort=''):
+        """Returns sort parameter suitable for cursorMark paging: the unique key field is added as tie breaker if missing"""
+        if not sort:
+            return "{0} asc".format(self.id_field)
+        if not self.id_field in [clause.split()[0] for clause in sort.split(',') if clause.strip()]:
+            sort = "{0},{1} asc".format(sort, self.id_field)
+        return sort
+
+    def _cursorResponsesIter(self, query, fields, blocksize=10000, sort='', filter_query=None):
+        """Iterates over select responses for query paging with cursorMark. Each request costs the same to SOLR regardless
+of how deep the scan is. Requires SOLR 4.7+"""
+        parameters = {'q': query, 'fl': ','.join(fields), 'rows': blocksize, 'sort': self._cursorSort(sort), 'cursorMark': '*'}
+        if not filter_query is None:
+            parameters['fq'] = filter_query
+        while True:
+            response = self.select(parameters)
+            yield response
+            next_cursor_mark = response['nextCursorMark']
+            if next_cursor_mark == parameters['cursorMark']:
+                break
+            parameters = dict(parameters, cursorMark=next_cursor_mark)
+
+    def _partitionFilters(self, partitions, field=None):
+        """Returns partitions disjoint filters on field (unique key field by default) with hash query parser: each document
+is assigned to a partition by the hash of its value, so partitions have about the same number of documents and no
+sampling request is needed (deep start offsets are expensive). field should have docValues, otherwise SOLR uninverts
+it. Requires SOLR 5.1+"""
+        if field is None:
+            field = self.id_field
+        return [u"{{!hash workers={0} worker={1} partitionKeys={2}}}".format(partitions, worker, field) for worker in xrange(partitions)]
+
+    def _partitionedResponsesIter(self, query, fields, partitions, blocksize=10000, parallel=6, partition_field=None):
+        """Iterates over select responses for query splitting it in partitions walked in parallel, each with its own cursor.
+Responses from different partitions are merged in arrival order"""
+        filters_q = Queue.Queue()
+        for filter_query in self._partitionFilters(partitions, field=partition_field):
+            filters_q.put(filter_query)
+
+        #Bounded queue: workers wait for the consumer
+        responses_q = Queue.Queue(parallel * 2)
+        stop = threading.Event()
+        done = object()
 
-        if not limit is None and blocksize > limit:
-            blocksize = limit
+        def put(item):
+            while not stop.is_set():
+                try:
+                    responses_q.put(item, True, 1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                while not stop.is_set():
+                    try:
+                        filter_query = filters_q.get(False)
+                    except Queue.Empty:
+                        break
+                    for response in self._cursorResponsesIter(query, fields, blocksize=blocksize, filter_query=filter_query):
+                        if not put(response):
+                            return
+            except Exception:
+                put(sys.exc_info())
+            finally:
+                put(done)
+
+        threads = []
+        for _ in range(0, min(parallel, filters_q.qsize())):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        try:
+            running = len(threads)
+            while running > 0:
+                item = responses_q.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, tuple):
+                    raise ThreadError("An error occurred in partitioned scan: %s: %s" % (item[0], item[1]))
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
+    def _prefetchResponsesIter(self, queries, parallel=6, window=None, ordered=True):
+        """Executes select for queries with parallel threads. At most window (default parallel) requests are in flight or
+waiting to be consumed: next pages are fetched while current one is consumed and no new request is issued until the
+consumer asks for more. If ordered is True responses are yielded in the same order as queries, otherwise as soon as
+they arrive. Threads are released when the iterator is exhausted or closed"""
+        if window is None:
+            window = parallel
+
+        def fetch(query):
+            try:
+                return (True, self.select(query))
+            except Exception:
+                return (False, sys.exc_info())
+
+        queries = iter(queries)
+        #The multiprocessing.dummy module exposes same functionalities as multiprocessing module, but using threads, not subprocesses.
+        p = multiprocessing.dummy.Pool(parallel)
+        #Ordered: AsyncResults in submission order. Unordered: results in completion order
+        pending = collections.deque()
+        completed = Queue.Queue()
+        in_flight = 0
+
+        def submit():
+            for query in itertools.islice(queries, 1):
+                if ordered:
+                    pending.append(p.apply_async(fetch, (query,)))
+                else:
+                    p.apply_async(fetch, (query,), callback=completed.put)
+                return True
+            return False
+
+        try:
+            while in_flight < window and submit():
+                in_flight += 1
+            while in_flight > 0:
+                if ordered:
+                    (ok, result) = pending.popleft().get()
+                else:
+                    (ok, result) = completed.get()
+                in_flight -= 1
+                if not ok:
+                    raise result[0], result[1], result[2]
+                #Keeps the window full before handing the response to the consumer
+                if submit():
+                    in_flight += 1
+                yield result
+        finally:
+            #Drops queued requests and waits for the running ones
+            p.terminate()
+            p.join()
+
+    def _offsetResponsesIter(self, query, fields, limit=None, blocksize=10000, parallel=6, start_blocksize=100, sort='', window=None):
+        """Iterates over select responses for query paging with start offsets. Pages beyond limit are never requested"""
+        if not limit is None and start_blocksize > limit:
+            start_blocksize = limit
 
         start = 0
 
         #First request with small blocksize to retrieve some docs and numFound. For small requests it is sufficient
         response = self.select({'q': query, 'fl': ','.join(fields), 'rows': start_blocksize, 'start': start, 'sort': sort})
+        yield response
 
         numFound = response['response']['numFound']
+        if not limit is None and numFound > limit:
+            numFound = limit
         start += start_blocksize
-        selected = 0
 
-        for d in self._iterResponseDocs(response, fields):
-            if limit is None or selected < limit:
-                yield d
-                selected += 1
-            else:
-                break
+        if start >= numFound:
+            return
 
-        #The multiprocessing.dummy module exposes same functionalities as multiprocessing module, but using threads, not subprocesses.
-        p = multiprocessing.dummy.Pool(parallel)
         queries = ({'q': query, 'fl': ','.join(fields), 'rows': blocksize, 'start': start, 'sort': sort} for start in xrange(start, numFound, blocksize))
 
-        for response in p.imap_unordered(self.select, queries):
-            for d in self._iterResponseDocs(response, fields):
-                if limit is None or selected < limit:
-                    yield d
-                    selected += 1
+        #Sorted results: pages are prefetched in parallel but yielded in order
+        responses = self._prefetchResponsesIter(queries, parallel=parallel, window=window, ordered=bool(sort))
+        try:
+            for response in responses:
+                yield response
+        finally:
+            responses.close()
+
+    def selectAllIter(self, query, fields=None, limit=None, blocksize=10000, parallel=6, start_blocksize=100, sort='', cursor=False, partitions=None, partition_field=None, window=None, columnar=False):
+        """Iterates over all results for query as tuples of field values. query is a SOLR query string, fields are
+the fields to be retrieved, limit is the maximum number of result to return, parallel is the number of simultaneous
+requests to SOLR, blocksize is the number of documents to retrieve per request, start_blocksize is the number of 
+documents to retrieve for the only first request (to optimize response times for smaller result sets), sort is the
+sort parameter to pass to SOLR. If cursor is True results are paged with cursorMark instead of start offsets (constant
+cost per page for deep scans, requires SOLR 4.7+): requests are sequential, parallel and start_blocksize are ignored and
+the unique key field is added to sort. If partitions is set query is split in partitions disjoint hash buckets of
+partition_field (unique key field by default) each walked with its own cursor, parallel partitions at a time: results are
+not sorted. Partitions use the hash query parser and require SOLR 5.1+ (older servers reject them as bad requests).
+Pages are fetched in parallel keeping at most window (default parallel) pages in flight or buffered; when sort is set
+they are yielded in order. Requests stop as soon as limit is reached or the iterator is closed. If columnar is True,
+instead of tuples it yields a dictionary of numpy arrays (one per field, typed from schema) for each page"""
+        if fields is None:
+            fields = (self.id_field,)
+        if columnar and numpy is None:
+            raise ImportError("numpy is required for columnar output")
+        self.logger.debug("Selecting fields ({0}) for records matching: '{1}'".format(','.join(fields), query))
+
+        if not limit is None and blocksize > limit:
+            blocksize = limit
+
+        if partitions:
+            if sort:
+                warnings.warn("Cannot sort partitioned query: sort ignored")
+            responses = self._partitionedResponsesIter(query, fields, partitions, blocksize=blocksize, parallel=parallel, partition_field=partition_field)
+        elif cursor:
+            responses = self._cursorResponsesIter(query, fields, blocksize=blocksize, sort=sort)
+        else:
+            responses = self._offsetResponsesIter(query, fields, limit=limit, blocksize=blocksize, parallel=parallel, start_blocksize=start_blocksize, sort=sort, window=window)
+
+        selected = 0
+        try:
+            for response in responses:
+                if columnar:
+                    docs = response['response']['docs']
+                    if not limit is None:
+                        docs = docs[:limit - selected]
+                    if docs:
+                        yield self._responseColumns(docs, fields)
+                        selected += len(docs)
                 else:
+                    for d in self._iterResponseDocs(response, fields):
+                        if limit is None or selected < limit:
+                            yield d
+                            selected += 1
+                        else:
+                            break
+                if not limit is None and selected >= limit:
                     break
+        finally:
+            responses.close()
 
         self.logger.debug("{0} records selected".format(selected))
 
-    def listFieldsIter(self, fields=None, limit=None, blocksize=10000, parallel=6, filter=None, sort=''):
-        """Iterates over all values for given fields"""
+    def listFieldsIter(self, fields=None, limit=None, blocksize=10000, parallel=6, filter=None, sort='', cursor=False, partitions=None, partition_field=None, export=False, window=None, columnar=False):
+        """Iterates over all values for given fields. If export is True fields are streamed by /export request handler
+when they are all docValues enabled. If columnar is True it yields pages as dictionaries of numpy arrays (see selectAllIter):
+export is not available for columnar output"""
         if fields is None:
             fields = (self.id_field,)
         if filter is None:
@@ -228,22 +561,28 @@ sort parameter to pass to SOLR"""
             msg += " matching \"{0}\"".format(query)
         self.logger.debug(msg)
 
-        return self.selectAllIter(query, fields, limit=limit, blocksize=blocksize, parallel=parallel, sort=sort)
+        if export:
+            if columnar:
+                warnings.warn("Cannot export columnar output: export ignored")
+            else:
+                return self.exportIter(query, fields, limit=limit, sort=sort, blocksize=blocksize, parallel=parallel, cursor=cursor, partitions=partitions, partition_field=partition_field, window=window)
 
-    def listParentFieldsIter(self, fields=None, limit=None, blocksize=10000, parallel=6, filter=None, sort=''):
+        return self.selectAllIter(query, fields, limit=limit, blocksize=blocksize, parallel=parallel, sort=sort, cursor=cursor, partitions=partitions, partition_field=partition_field, window=window, columnar=columnar)
+
+    def listParentFieldsIter(self, fields=None, limit=None, blocksize=10000, parallel=6, filter=None, sort='', cursor=False, partitions=None, partition_field=None, window=None, columnar=False):
         if not filter is None:
             filter = "(%s) AND (%s)" % (self.blockjoin_condition, filter)
         else:
             filter = self.blockjoin_condition
-        return self.listFieldsIter(fields=fields, limit=limit, blocksize=blocksize, parallel=parallel, filter=filter, sort=sort)
+        return self.listFieldsIter(fields=fields, limit=limit, blocksize=blocksize, parallel=parallel, filter=filter, sort=sort, cursor=cursor, partitions=partitions, partition_field=partition_field, window=window, columnar=columnar)
 
-    def listFieldsDict(self, fields=None, limit=None, filter=None):
+    def listFieldsDict(self, fields=None, limit=None, filter=None, export=False):
         res = {}
         if fields is None:
             fields = ()
         fields = (self.id_field,) + fields
         self.logger.debug("Saving fields ({0}) in dict for all records".format(', '.join(fields)))
-        for values in self.listFieldsIter(fields=fields, limit=limit, filter=filter):
+        for values in self.listFieldsIter(fields=fields, limit=limit, filter=filter, export=export):
             if len(values) > 1:
                 res[values[0]] = values[1:]
             else:
@@ -288,15 +627,82 @@ sort parameter to pass to SOLR"""
     def deleteByQuery(self, query):
         return self.deleteByQueries((query,))
 
-    def deleteByIds(self, ids):
-        return self.deleteByQueries("{0}:{1}".format(self.id_field, solrid) for solrid in ids)
+    def _deleteElements(self, elements, commitWithin=None, wire_format='xml'):
+        """Streams a delete update request with elements serialized by _deleteElement"""
+        def gen():
+            yield '<delete>'
+            for element in elements:
+                yield element
+            yield '</delete>'
+
+        def genJSON():
+            sep = '{"delete":['
+            for element in elements:
+                yield sep
+                yield element
+                sep = ','
+            yield ']}' if sep == ',' else '{"delete":[]}'
+
+        parameters = {}
+        if not commitWithin is None:
+            parameters['commitWithin'] = commitWithin
+        if wire_format == 'json':
+            return self.update(parameters=parameters, data=genJSON(), dataMIMEType="application/json; charset=utf-8")
+        else:
+            return self.update(parameters=parameters, data=gen(), dataMIMEType="text/xml; charset=utf-8")
+
+    def _deleteElement(self, solrid, wire_format='xml'):
+        if wire_format == 'json':
+            return json.dumps(unicode(solrid))
+        return u'<id>{0}</id>'.format(_escapeText(unicode(solrid))).encode('utf8')
+
+    def _dispatchDeletes(self, items, send, chunksize, parallel):
+        dispatcher = UpdateDispatcher(send, parallel=parallel, batch_size=chunksize, batch_bytes=None, log=self.logger)
+        stats = dispatcher.run(items)
+        if len(dispatcher.errors) > 0:
+            raise ThreadError("An error occurred in one or more threads: %s" % (", ".join(["%s: %s" % (x[0], x[1]) for x in dispatcher.errors]),))
+        return stats
+
+    def deleteByIds(self, ids, chunksize=None, parallel=1, commitWithin=None, wire_format='xml'):
+        """Removes documents whose ids are in ids iterator with <id> elements (or a JSON delete list if wire_format is
+'json'): any character is allowed in ids and SOLR does not run queries. If chunksize is set ids are deleted chunksize at
+a time by parallel threads, and DispatcherStats are returned. Otherwise all ids are streamed in a single request"""
+        try:
+            return self._deleteByIds(ids, chunksize=chunksize, parallel=parallel, commitWithin=commitWithin, wire_format=wire_format)
+        finally:
+            #Children of deleted documents are not known: the whole cache is invalidated
+            self.clearCache()
+
+    def _deleteByIds(self, ids, chunksize=None, parallel=1, commitWithin=None, wire_format='xml'):
+        if not wire_format in ('xml', 'json'):
+            raise ValueError("Invalid wire format %s" % wire_format)
+        elements = (self._deleteElement(solrid, wire_format=wire_format) for solrid in ids)
+        if chunksize is None:
+            return self._deleteElements(elements, commitWithin=commitWithin, wire_format=wire_format)
+        return self._dispatchDeletes(elements, lambda batch: self._deleteElements(batch, commitWithin=commitWithin, wire_format=wire_format), chunksize, parallel)
+
+    def _deleteParentIdsChunk(self, ids, commitWithin=None):
+        #Children have parent id in _root_. Parents without children may not have _root_
+        queries = (self._termsQuery('_root_', ids), self._termsQuery(self.id_field, ids))
+        return self._deleteElements((u'<query>{0}</query>'.format(_escapeText(q)).encode('utf8') for q in queries), commitWithin=commitWithin)
+
+    def deleteByParentIds(self, ids, chunksize=None, parallel=1, commitWithin=None):
+        """Remove documents whose ids are in ids iterator including their children, if any. Blockjoin documents are deleted
+with terms queries on _root_ and id fields, one request each chunksize ids (with parallel threads, DispatcherStats are
+returned) or a single request for all ids if chunksize is None"""
+        try:
+            return self._deleteByParentIds(ids, chunksize=chunksize, parallel=parallel, commitWithin=commitWithin)
+        finally:
+            self.clearCache()
 
-    def deleteByParentIds(self, ids):
-        """Remove documents whose ids are in ids iterator including their children, if any"""
+    def _deleteByParentIds(self, ids, chunksize=None, parallel=1, commitWithin=None):
+        #Cache is not invalidated: see loadDocs
         if self.blockjoin_condition:
-            return self.deleteByQueries("_root_:{0} OR {1}:{0}".format(solrid, self.id_field) for solrid in ids)
+            if chunksize is None:
+                return self._deleteParentIdsChunk(list(ids), commitWithin=commitWithin)
+            return self._dispatchDeletes((unicode(solrid) for solrid in ids), lambda batch: self._deleteParentIdsChunk(batch, commitWithin=commitWithin), chunksize, parallel)
         else:
-            return self.deleteByIds(ids)
+            return self._deleteByIds(ids, chunksize=chunksize, parallel=parallel, commitWithin=commitWithin)
 
     def dropIndex(self):
         out = self.deleteByQuery("*:*")
@@ -315,7 +721,7 @@ sort parameter to pass to SOLR"""
         if not solrid is None:
             q += ' AND %s:"%s"' % (self.id_field, solrid)
 
-        return (r[0] for r in self.selectAllIter(q))
+        return self._idsIter(q)
 
     def listBlockJoinChildIdsIter(self, solrid=None):
         """Iterates over children ids that are in block join (and then need to be updated together with their child documents)"""
@@ -328,19 +734,41 @@ sort parameter to pass to SOLR"""
         if not solrid is None:
             q += ' AND %s:"%s"' % (self.id_field, solrid)
 
-        return (r[0] for r in self.selectAllIter(q))
+        return self._idsIter(q)
+
+    def _idsIter(self, query, blocksize=10000):
+        """Streams unique key values of documents matching query, sorted, straight from cursorMark paged responses"""
+        for response in self._cursorResponsesIter(query, (self.id_field,), blocksize=blocksize):
+            for doc in response['response']['docs']:
+                yield doc[self.id_field]
 
     def _isInIterDoc(self, solrid, iterator_f, prefetch=False):
-        """If id is in iterator returns True, else False. iterator should accept a solrid optional parameter. If prefetch i true result is cached and prefetched"""
+        """If id is in iterator returns True, else False. iterator should accept a solrid optional parameter. If prefetch i true result is cached and prefetched
+in an id store of kind prefetch_store: bloom stores check positive hits without prefetch"""
         cache_name = "_" + iterator_f.__name__ + "_ids_cache"
-        if prefetch and not self.cache.has_key(cache_name):
-            self.logger.info("Prefetching cache for %s" % iterator_f.__name__)
-            self.cache[cache_name] = set()
-            cache = self.cache[cache_name]
-            for temp_solrid in iterator_f():
-                cache.add(temp_solrid)
         if prefetch:
-            return solrid in self.cache[cache_name]
+            pinned = self._pinned_stores
+            cache = None if pinned is None else pinned.get(cache_name)
+            if cache is None:
+                cache = self.cache.get(cache_name)
+            if cache is None and pinned is None and self.cache.wasEvicted(cache_name):
+                #The store doesn't fit in cache budget: ids are checked in core until the cache is cleared
+                prefetch = False
+            else:
+                if cache is None:
+                    self.logger.info("Prefetching cache for %s" % iterator_f.__name__)
+                    cache = newIdStore(self.prefetch_store, fallback=lambda x: self._isInIterDoc(x, iterator_f, prefetch=False))
+                    for temp_solrid in iterator_f():
+                        cache.add(temp_solrid)
+                    cache.freeze()
+                    self.cache.set(cache_name, cache, ids=True)
+                if not pinned is None:
+                    #Kept for the rest of the load even if it is evicted
+                    pinned[cache_name] = cache
+                #Ids loaded after prefetch are checked in core
+                prefetch = not self.cache.isStale(cache_name, solrid)
+        if prefetch:
+            return solrid in cache
         else:
             g = iterator_f(solrid=solrid)
             try:
@@ -352,7 +780,7 @@ sort parameter to pass to SOLR"""
                 return False
 
     def clearCache(self):
-        self.cache = {}
+        self.cache.clear()
 
     def isBlockJoinParentDoc(self, solrid, prefetch=False):
         return self._isInIterDoc(solrid, self.listBlockJoinParentIdsIter, prefetch=prefetch)
@@ -360,21 +788,39 @@ sort parameter to pass to SOLR"""
     def isBlockJoinChildDoc(self, solrid, prefetch=False):
         return self._isInIterDoc(solrid, self.listBlockJoinChildIdsIter, prefetch=prefetch)
 
-    def getDoc(self, solrid, include_reserved_fields=(), get_child_docs=True):
-        """Returns a SOLRDocument instance with data from core for id solrid. Internal SOLR fields (starting and ending with "_") are not returned unless listed in include_reserved_fields. If get_child_docs is True will have child docs retrieved from blockjoin"""
-        res = self.select({"q": '%s:"%s"' % (self.id_field, solrid), "rows": "1"})
-        if res['response']['numFound'] > 0:
-            doc = SOLRDocument(u'changeme', self)
-            for (fieldname, fieldvalue) in res['response']['docs'][0].iteritems():
-                if fieldname.startswith('_') and fieldname.endswith('_') and not fieldname in include_reserved_fields:
-                    pass
+    def _childTransformer(self):
+        """Returns the [child] document transformer for fl parameter retrieving all child documents of blockjoin parents"""
+        return u'[child parentFilter="{0}" limit=-1]'.format(self.blockjoin_condition.replace(u'\\', u'\\\\').replace(u'"', u'\\"'))
+
+    def _docFromResponse(self, responsedoc, include_reserved_fields=()):
+        """Returns a SOLRDocument instance from a document in SOLR json response for select. Child documents returned by
+[child] transformer are added as child docs"""
+        doc = SOLRDocument(u'changeme', self)
+        for (fieldname, fieldvalue) in responsedoc.iteritems():
+            if fieldname == '_childDocuments_':
+                for childdoc in fieldvalue:
+                    doc.addChild(self._docFromResponse(childdoc, include_reserved_fields=include_reserved_fields))
+            elif fieldname.startswith('_') and fieldname.endswith('_') and not fieldname in include_reserved_fields:
+                pass
+            else:
+                if isinstance(fieldvalue, list):
+                    doc.setField(fieldname, self.fields[fieldname].type.deserializeList(fieldvalue))
                 else:
-                    if isinstance(fieldvalue, list):
-                        doc.setField(fieldname, [self.fields[fieldname].type.deserialize(x) for x in fieldvalue])
-                    else:
-                        doc.setField(fieldname, self.fields[fieldname].type.deserialize(fieldvalue))
+                    doc.setField(fieldname, self.fields[fieldname].type.deserialize(fieldvalue))
+        return doc
+
+    def getDoc(self, solrid, include_reserved_fields=(), get_child_docs=True, child_transformer=False):
+        """Returns a SOLRDocument instance with data from core for id solrid. Internal SOLR fields (starting and ending with "_") are not returned unless listed in include_reserved_fields. If get_child_docs is True will have child docs retrieved from blockjoin. If child_transformer is True parent and child docs are retrieved in a single request with [child] document transformer (solrid must be a parent document)"""
+        parameters = {"q": '%s:"%s"' % (self.id_field, solrid), "rows": "1"}
+        with_transformer = bool(self.blockjoin_condition and get_child_docs and child_transformer)
+        if with_transformer:
+            parameters['fl'] = u'*,{0}'.format(self._childTransformer())
 
-            if self.blockjoin_condition and get_child_docs:
+        res = self.select(parameters)
+        if res['response']['numFound'] > 0:
+            doc = self._docFromResponse(res['response']['docs'][0], include_reserved_fields=include_reserved_fields)
+
+            if self.blockjoin_condition and get_child_docs and not with_transformer:
                 for (child_solrid,) in self.selectAllIter('{!child of="%s"}%s:"%s"' % (self.blockjoin_condition, self.id_field, solrid)):
                     child_doc = self.getDoc(child_solrid, include_reserved_fields=include_reserved_fields, get_child_docs=False)
                     doc.addChild(child_doc)
@@ -384,7 +830,90 @@ sort parameter to pass to SOLR"""
         else:
             raise DocumentNotFound, 'Document "%s" not found' % solrid
 
-    def _loadXMLDocs(self, docs):
+    def _termsQuery(self, field, values):
+        """Returns a terms query matching documents with any of values in field. Values are separated by commas, or by the
+first of TERMS_SEPARATORS (then unicode private use characters) that is not in values"""
+        values = [unicode(v) for v in values]
+        text = u"".join(values)
+        if not u',' in text:
+            return u"{{!terms f={0}}}{1}".format(field, u",".join(values))
+        for separator in itertools.chain(TERMS_SEPARATORS, (unichr(x) for x in xrange(0xE000, 0xF900))):
+            if not separator in text:
+                return u"{{!terms f={0} separator=\"{1}\"}}{2}".format(field, separator, separator.join(values))
+        raise ValueError("No separator available for terms query")
+
+    def _getDocsChunk(self, ids, include_reserved_fields=(), get_child_docs=True, child_transformer=False):
+        """Retrieves documents for a chunk of ids with one request (plus one for child documents, unless they are retrieved
+with [child] transformer). Returns a tuple with the list of SOLRDocument found and the list of missing ids"""
+        parameters = {'q': self._termsQuery(self.id_field, ids), 'rows': len(ids)}
+        with_transformer = bool(self.blockjoin_condition and get_child_docs and child_transformer)
+        if with_transformer:
+            parameters['fl'] = u'*,{0}'.format(self._childTransformer())
+        res = self.select(parameters)
+        docs = [self._docFromResponse(d, include_reserved_fields=include_reserved_fields) for d in res['response']['docs']]
+
+        found = set(unicode(doc.id) for doc in docs)
+        missing = [solrid for solrid in ids if not unicode(solrid) in found]
+
+        if self.blockjoin_condition and get_child_docs and not with_transformer and docs:
+            if self.fields['_root_'].stored:
+                #Child documents of the whole chunk share _root_ field with their parent
+                parents = dict((unicode(doc.id), doc) for doc in docs)
+                query = self._termsQuery('_root_', parents.keys())
+                for response in self._cursorResponsesIter(query, ('*', '_root_'), filter_query="-(%s)" % self.blockjoin_condition):
+                    for d in response['response']['docs']:
+                        parents[unicode(d['_root_'])].addChild(self._docFromResponse(d, include_reserved_fields=include_reserved_fields))
+            else:
+                #_root_ field is not stored: child documents are retrieved parent by parent
+                for doc in docs:
+                    child_ids = [child_solrid for (child_solrid,) in self.selectAllIter('{!child of="%s"}%s:"%s"' % (self.blockjoin_condition, self.id_field, doc.id))]
+                    if child_ids:
+                        for child_doc in self._getDocsChunk(child_ids, include_reserved_fields=include_reserved_fields, get_child_docs=False)[0]:
+                            doc.addChild(child_doc)
+
+        return (docs, missing)
+
+    def getDocs(self, ids, include_reserved_fields=(), get_child_docs=True, chunksize=500, parallel=6, child_transformer=False):
+        """Returns a tuple (docs, missing) where docs is a dictionary id -> SOLRDocument instance for documents in core
+with ids in ids iterator and missing is the list of ids not found. Documents are retrieved chunksize ids per request
+with parallel simultaneous requests. Internal SOLR fields and child documents are managed as in getDoc (child
+documents of a chunk are retrieved with one more request if _root_ field is stored, otherwise with two requests per
+parent; with child_transformer=True they are retrieved in the same request with [child] transformer and ids must be
+parent documents)"""
+        def chunks():
+            seen = set()
+            chunk = []
+            for solrid in ids:
+                if solrid in seen:
+                    continue
+                seen.add(solrid)
+                chunk.append(solrid)
+                if len(chunk) >= chunksize:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        def getChunk(chunk):
+            return self._getDocsChunk(chunk, include_reserved_fields=include_reserved_fields, get_child_docs=get_child_docs, child_transformer=child_transformer)
+
+        docs = {}
+        missing = []
+        p = multiprocessing.dummy.Pool(parallel)
+        try:
+            for (chunkdocs, chunkmissing) in p.imap_unordered(getChunk, chunks()):
+                for doc in chunkdocs:
+                    docs[doc.id] = doc
+                missing.extend(chunkmissing)
+        finally:
+            p.terminate()
+            p.join()
+
+        self.logger.debug("{0} documents retrieved, {1} not found".format(len(docs), len(missing)))
+        return (docs, missing)
+
+    def _loadXMLDocs(self, docs, commitWithin=None, wire_format='xml'):
+        """Streams documents serialized by SOLRDocument.toXML (or toJSON if wire_format is 'json', in a JSON array) in a single update request"""
         def gen():
             yield '<add>'
             for doc in docs:
@@ -392,25 +921,50 @@ sort parameter to pass to SOLR"""
                 self.logger.debug("DATA: %s" % doc)
             yield '</add>'
 
-        return self.update(data=gen(), dataMIMEType="text/xml; charset=utf-8")
+        def genJSON():
+            sep = '['
+            for doc in docs:
+                #Keep alive whitespace must not be separated
+                if doc == "\n":
+                    yield doc
+                    continue
+                yield sep
+                yield doc
+                self.logger.debug("DATA: %s" % doc)
+                sep = ','
+            yield ']' if sep == ',' else '[]'
+
+        parameters = {}
+        if not commitWithin is None:
+            parameters['commitWithin'] = commitWithin
+        if wire_format == 'json':
+            return self.update(parameters=parameters, data=genJSON(), dataMIMEType="application/json; charset=utf-8")
+        elif wire_format == 'xml':
+            return self.update(parameters=parameters, data=gen(), dataMIMEType="text/xml; charset=utf-8")
+        else:
+            raise ValueError("Invalid wire format %s" % wire_format)
 
-    def _loadXMLDocsFromQueue(self, q, stop, errors_q):
+    def _loadXMLDocsFromQueue(self, q, stop, errors_q, commitWithin=None, wire_format='xml'):
         def gen():
             #After 5 seconds of inactivity sends however a \n
             #to keep the connection connection alive.
             #Each object in the query is a string <doc>...</doc>
             #therefore there is no data corruption (\n are ignored)
-            #stop is an Event signal
+            #stop is an Event signal, None the end of the queue
             while not stop.is_set():
                 try:
                     xmldoc = q.get(True, 5)
-                    yield xmldoc
-                    q.task_done()
                 except Queue.Empty:
                     yield "\n"
+                    continue
+                if xmldoc is None:
+                    q.task_done()
+                    return
+                yield xmldoc
+                q.task_done()
 
         try:
-            return self._loadXMLDocs(gen())
+            return self._loadXMLDocs(gen(), commitWithin=commitWithin, wire_format=wire_format)
         except Exception:
             errors_q.put(sys.exc_info())
             raise
@@ -419,56 +973,202 @@ sort parameter to pass to SOLR"""
         """Loads empty docs with id from ids iterator"""
         return self._loadXMLDocs('<doc><field name="{0}" null="false">{1}</field></doc>'.format(self.id_field, solr_id) for solr_id in ids)
 
-    def loadDocs(self, docs, merge_child_docs=False, parallel=1):
-        """Load documents from docs iterator. docs should iterate over SOLRDocument instances. This function transparently manages blockjoin updates. merge_child_docs=False replace child docs in core with child_docs in docs. merge_child_docs=True update child documents also, based in id field"""
-        def gen():
-            for newdoc in docs:
+    def _mergeBlockJoinDocs(self, newdocs, merge_child_docs=False, parallel=1, wire_format='xml', serialize=True):
+        """Merges a chunk of blockjoin documents with their current version in core to simulate update. Current versions are
+retrieved in bulk and original documents are deleted with a single request. Returns the list of XML (or JSON if
+wire_format is 'json') documents to load, one for each document in newdocs: None if the document can't be loaded.
+If serialize is False SOLRDocument instances are returned instead"""
+        #include_reserved_fields because I need to check _version_ field
+        #Chunk is split among parallel requests
+        chunksize = max(1, -(-len(newdocs) // parallel))
+        (currentdocs, _) = self.getDocs([newdoc.id for newdoc in newdocs], include_reserved_fields=('_version_',), chunksize=chunksize, parallel=parallel)
+
+        todelete = []
+        #Ids of current child documents
+        replaced = []
+        docs2load = []
+        for newdoc in newdocs:
+            newversion = newdoc.getFieldDefault('_version_', 0)
+            currentdoc = currentdocs.get(newdoc.id)
+            if not currentdoc is None:
+                currentversion = currentdoc.getFieldDefault('_version_', 0)
+
+                if newversion < 0:
+                    #can't update: When version < 0 document must not already exists in core
+                    warnings.warn("Can't update document %s: version < 0 and document exists in core" % newdoc.id, SOLRDocumentWarning)
+                    docs2load.append(None)
+                    continue
+
+                elif newversion > 1 and newversion != currentversion:
+                    #Can't update: when version > 1 must match with version in core
+                    warnings.warn("Can't update document %s: version doesn't match (%s - %s)" % (newdoc.id, newversion, currentversion), SOLRDocumentWarning)
+                    docs2load.append(None)
+                    continue
+                else:
+                    #All other cases are OK
+                    replaced.extend(child.id for child in currentdoc.getChildDocs())
+                    currentdoc.update(newdoc, merge_child_docs=merge_child_docs)
+                    doc2load = currentdoc
+                    #When loading blockjoin documents we must delete documents before update
+                    todelete.append(newdoc.id)
+            else:
+                if newversion > 0:
+                    #Can't update: when version > 0 document must exists in core
+                    warnings.warn("Can't update document %s: version > 0 and document does not exists in core" % (newdoc.id,), SOLRDocumentWarning)
+                    docs2load.append(None)
+                    continue
+                else:
+                    #All other cases are OK
+                    doc2load = newdoc
+            #Remove _version_: must not exists when loading new documents. Blockjoins are always new documents because we've already deleted the original version.
+            doc2load.removeField('_version_')
+            #Can't use update for blockjoin documents: SOLR doesn't load and raises no error.
+            if not serialize:
+                docs2load.append(doc2load)
+            else:
+                docs2load.append(doc2load.toJSON(update=False) if wire_format == 'json' else doc2load.toXML(update=False))
+
+        if todelete:
+            #Merged documents are loaded again: the cache is invalidated for their ids only (see loadDocs)
+            self._deleteByParentIds(todelete)
+            #Children of deleted documents may not be loaded again
+            self.cache.invalidateIds(replaced)
+
+        return docs2load
+
+    def loadDocs(self, docs, merge_child_docs=False, parallel=1, blockjoin_chunksize=500, batch_size=None, batch_bytes=None, commitWithin=None, bisect=False, on_error=None, queue_size=DEFAULT_QUEUE_SIZE, spool=False, spool_dir=None, journal=None, wire_format='xml', processes=None, ordered=True, adaptive=False, max_retries=None):
+        """Load documents from docs iterator. docs should iterate over SOLRDocument instances. This function transparently manages blockjoin updates. merge_child_docs=False replace child docs in core with child_docs in docs. merge_child_docs=True update child documents also, based in id field. Blockjoin documents are merged with their current version blockjoin_chunksize at a time.
+If batch_size or batch_bytes are set documents are sent in batches of at most batch_size documents and batch_bytes bytes, each with its own update request, by parallel threads, and DispatcherStats with per-batch latency is returned. Otherwise each thread streams documents in a single update request. commitWithin (ms) is passed to update requests.
+If bisect is True (batch mode) batches rejected by SOLR as bad requests (SOLRBadRequestError, HTTP 400) are split and retried until invalid documents are isolated, other errors make the load fail: each of them is passed as on_error(xmldoc, exc_info) or, if on_error is None, reported with a SOLRDocumentWarning. Other documents are loaded normally.
+At most queue_size documents (parallel batches in batch mode) wait in memory to be sent: the docs iterator is consumed only as fast as SOLR takes documents. If spool is True documents that don't fit in memory are written to a temporary spool file in spool_dir instead of waiting.
+If journal (a LoadJournal) is given the load is resumable (batch mode): docs must iterate over (position, SOLRDocument) tuples,
+as returned by journal.resume(docs) or SOLRDocumentFactory.fromXMLOffsets(fh, journal.checkpoint), and positions of
+acknowledged batches are recorded in the journal. Documents up to journal.checkpoint are skipped by the restarted job.
+wire_format 'json' sends documents as JSON arrays (SOLRDocument.toJSON) instead of XML.
+If processes is set documents are serialized by a SerializerPool of processes (instead of the calling thread) and handed
+to sender threads in input order if ordered is True, otherwise as soon as they are ready.
+If adaptive is True (or a ConcurrencyController) batches in flight are adjusted between 1 and parallel following batch
+latency and network errors (see ConcurrencyController): the limit over time is in returned stats.concurrency.
+Batches failing with network errors are retried max_retries times (default 3 if adaptive, otherwise 0) with exponential
+backoff (see UpdateDispatcher)"""
+        #Ids of loaded documents, invalidated in cache when the load ends (all ids entries are dropped beyond max_stale)
+        touched = set()
+        def touch(doc):
+            if len(touched) <= self.cache.max_stale:
+                touched.add(doc.id)
+                for child in doc.getChildDocs():
+                    touch(child)
+
+        def docs2load():
+            #Yields (position, doc, update) tuples, doc is None when the document is skipped
+            chunk = []
+            chunk_positions = []
+            chunk_ids = set()
+            def merge():
+                #Blockjoin documents are loaded as new documents
+                return ((position, doc, False) for (position, doc) in itertools.izip(chunk_positions, self._mergeBlockJoinDocs(chunk, merge_child_docs=merge_child_docs, parallel=parallel, serialize=False)))
+
+            for (position, newdoc) in docs:
+                touch(newdoc)
+                #The same document twice in a chunk would be merged with the same current version, and any other update
+                #of a buffered document must follow it
+                if newdoc.id in chunk_ids:
+                    for item in merge():
+                        yield item
+                    chunk = []
+                    chunk_positions = []
+                    chunk_ids = set()
+
                 if newdoc.hasChildDocs() or self.isBlockJoinParentDoc(newdoc.id, prefetch=True):
-                    #Merge provided doc with solr doc to simulate update
-                    newversion = newdoc.getFieldDefault('_version_', 0)
-                    try:
-                        #exclude_reserved_fields=False because I need to check _version_ field
-                        currentdoc = self.getDoc(newdoc.id, include_reserved_fields=('_version_',))
-                        currentversion = currentdoc.getFieldDefault('_version_', 0)
-
-                        if newversion < 0:
-                            #can't update: When version < 0 document must not already exists in core
-                            warnings.warn("Can't update document %s: version < 0 and document exists in core" % newdoc.id, SOLRDocumentWarning)
-                            continue
-
-                        elif newversion > 1 and newversion != currentversion:
-                            #Can't update: when version > 1 must match with version in core
-                            warnings.warn("Can't update document %s: version doesn't match (%s - %s)" % (newdoc.id, newversion, currentversion), SOLRDocumentWarning)
-                            continue
-                        else:
-                            #All other cases are OK
-                            currentdoc.update(newdoc, merge_child_docs=merge_child_docs)
-                            doc2load = currentdoc
-                            #When loading blockjoin documents we must delete documents before update
-                            self.deleteByParentIds((newdoc.id,))
-                    except DocumentNotFound:
-                        if newversion > 0:
-                            #Can't update: when version > 0 document must exists in core
-                            warnings.warn("Can't update document %s: version > 0 and document does not exists in core" % (newdoc.id,), SOLRDocumentWarning)
-                            continue
-                        else:
-                            #All other cases are OK
-                            doc2load = newdoc
-                    #Remove _version_: must not exists when loading new documents. Blockjoins are always new documents because we've already deleted the original version.
-                    doc2load.removeField('_version_')
-                    #Can't use update for blockjoin documents: SOLR doesn't load and raises no error.
-                    yield doc2load.toXML(update=False)
+                    chunk.append(newdoc)
+                    chunk_positions.append(position)
+                    chunk_ids.add(newdoc.id)
+                    if len(chunk) >= blockjoin_chunksize:
+                        for item in merge():
+                            yield item
+                        chunk = []
+                        chunk_positions = []
+                        chunk_ids = set()
 
                 elif self.isBlockJoinChildDoc(newdoc.id, prefetch=True):
                     #Not yet supported: skip
                     warnings.warn("Can't update document %s: it is a child blockjoin doc. This use case is not yet supported" % (newdoc.id,), SOLRDocumentWarning)
-                    continue
+                    yield (position, None, True)
                 else:
-                    doc2load = newdoc
-                    yield doc2load.toXML()
+                    yield (position, newdoc, True)
 
-        #A FIFO Queue to send docs
-        q = Queue.Queue()
+            if chunk:
+                for item in merge():
+                    yield item
+
+        def gen():
+            #Yields (position, xmldoc) tuples, xmldoc is None when the document is skipped
+            if not serializer is None:
+                for item in serializer.serialize(docs2load()):
+                    yield item
+            else:
+                for (position, doc, update) in docs2load():
+                    if doc is None:
+                        yield (position, None)
+                    else:
+                        yield (position, doc.toJSON(update=update) if wire_format == 'json' else doc.toXML(update=update))
+
+        if not wire_format in ('xml', 'json'):
+            raise ValueError("Invalid wire format %s" % wire_format)
+
+        def xmldocs():
+            for (_, xmldoc) in gen():
+                if not xmldoc is None:
+                    yield xmldoc
+
+        if journal is None:
+            docs = ((None, doc) for doc in docs)
+        else:
+            docs = journal.track(docs)
+
+        if adaptive is True:
+            adaptive = ConcurrencyController(min_parallel=1, max_parallel=parallel)
+        elif adaptive is False:
+            adaptive = None
+
+        if max_retries is None:
+            max_retries = 0 if adaptive is None else 3
+
+        if (bisect or not journal is None or not adaptive is None or max_retries > 0) and batch_size is None and batch_bytes is None:
+            batch_size = DEFAULT_BATCH_SIZE
+            batch_bytes = DEFAULT_BATCH_BYTES
+
+        #Processes must be forked before starting threads
+        serializer = None
+        if processes:
+            serializer = SerializerPool(processes=processes, ordered=ordered, wire_format=wire_format)
+
+        if not batch_size is None or not batch_bytes is None:
+            if bisect and on_error is None:
+                def on_error(xmldoc, exc_info):
+                    warnings.warn("Can't load document %s: %s" % (xmldoc, exc_info[1]), SOLRDocumentWarning)
+
+            dispatcher = UpdateDispatcher(lambda batch: self._loadXMLDocs(batch, commitWithin=commitWithin, wire_format=wire_format), parallel=parallel, batch_size=batch_size, batch_bytes=batch_bytes, log=self.logger, bisect=(SOLRBadRequestError,) if bisect else (), on_error=on_error, spool=spool, spool_dir=spool_dir, journal=journal, retry=(SOLRNetworkError,), max_retries=max_retries, adaptive=adaptive)
+            #Prefetched stores are built at most once per load
+            self._pinned_stores = {}
+            try:
+                stats = dispatcher.run(xmldocs() if journal is None else gen())
+            finally:
+                self._pinned_stores = None
+                if not serializer is None:
+                    serializer.close()
+                # invalidate cache because documents have changed
+                self.cache.invalidateIds(touched)
+
+            if len(dispatcher.errors) > 0:
+                raise ThreadError("An error occurred in one or more threads: %s" % (", ".join(["%s: %s" % (x[0], x[1]) for x in dispatcher.errors]),))
+            return stats
+
+        #A FIFO Queue to send docs: bounded to block the producer when SOLR is slower, or overflowing to disk
+        if spool:
+            q = SpoolQueue(queue_size, spool_dir=spool_dir)
+        else:
+            q = Queue.Queue(queue_size)
 
         # A FIFO Queue to return errors
         errors_q = Queue.Queue()
@@ -482,27 +1182,49 @@ sort parameter to pass to SOLR"""
         #Starts threads
         threads = []
         for _ in range(0,parallel):
-            t = threading.Thread(target=self._loadXMLDocsFromQueue, args=(q, stop, errors_q))
+            t = threading.Thread(target=self._loadXMLDocsFromQueue, args=(q, stop, errors_q, commitWithin, wire_format))
             t.start()
             threads.append(t)
             self.logger.debug("Starting thread %s" % t.name)
+        #Prefetched stores are built at most once per load
+        self._pinned_stores = {}
         try:
             #Fill the queue
-            for d in gen():
-                q.put(d)
+            for d in xmldocs():
+                while True:
+                    try:
+                        q.put(d, True, 1)
+                        break
+                    except Queue.Full:
+                        #If all threads died nobody will empty the queue
+                        if not any(t.is_alive() for t in threads):
+                            break
+                if not any(t.is_alive() for t in threads):
+                    break
                 self.logger.debug("Put document in queue %s" % repr(q))
                 self.logger.debug("%s" % d)
 
         finally:
+            self._pinned_stores = None
             self.logger.debug("Joining documents queue")
-            q.join()
+            while q.unfinished_tasks > 0 and any(t.is_alive() for t in threads):
+                time.sleep(0.01)
             self.logger.debug("Queue joined")
 
-            #Sending stop signal to threads
+            #Sending stop signal to threads: waiting ones are woken by None (dead threads may have left the queue full)
             stop.set()
+            for _ in threads:
+                try:
+                    q.put_nowait(None)
+                except Queue.Full:
+                    break
             for t in threads:
                 self.logger.debug("Joining thread %s", t.name)
                 t.join()
+            if spool:
+                q.close()
+            if not serializer is None:
+                serializer.close()
 
         # If any error occurred in threads raise an exception:
         # Check errors in threads
@@ -522,7 +1244,7 @@ sort parameter to pass to SOLR"""
             raise ThreadError("An error occurred in one or more threads: %s" % (", ".join(["%s: %s" % (x[0], x[1]) for x in exceptions_in_threads]),))
 
         # invalidate cache because documents have changed
-        self.clearCache()
+        self.cache.invalidateIds(touched)
 
     def replicationCommand(self, command, **pars):
         pars['command'] = command
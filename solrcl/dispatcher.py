@@ -0,0 +1,531 @@
+# -*- coding: utf8 -*-
+"""Classes for sending documents to SOLR in batches"""
+
+import os
+import sys
+import time
+import itertools
+import threading
+import Queue
+import collections
+import marshal
+import tempfile
+import multiprocessing
+import logging
+
+logger = logging.getLogger("solrcl")
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_RETRY_DELAY = 0.5
+DEFAULT_MAX_RETRY_DELAY = 30.0
+
+
+class SpoolQueue(Queue.Queue):
+    """FIFO Queue keeping at most memory_size items in memory: when it is full items overflow to a temporary spool file
+(in spool_dir) instead of blocking the producer. Items must be marshallable (strings, unicode strings...)"""
+    def __init__(self, memory_size=DEFAULT_QUEUE_SIZE, spool_dir=None):
+        self.memory_size = memory_size
+        self.spool_dir = spool_dir
+        Queue.Queue.__init__(self, 0)
+
+    def _init(self, maxsize):
+        self.queue = collections.deque()
+        self._spool = None
+        self._spool_read_pos = 0
+        self._spool_write_pos = 0
+        self._spooled = 0
+
+    def _qsize(self, len=len):
+        return len(self.queue) + self._spooled
+
+    def _put(self, item):
+        #Once something is spooled new items go to the spool to preserve FIFO order
+        if self._spooled > 0 or len(self.queue) >= self.memory_size:
+            if self._spool is None:
+                self._spool = tempfile.TemporaryFile(prefix='solrcl_spool_', dir=self.spool_dir)
+            self._spool.seek(self._spool_write_pos)
+            marshal.dump(item, self._spool)
+            self._spool_write_pos = self._spool.tell()
+            self._spooled += 1
+        else:
+            self.queue.append(item)
+
+    def _get(self):
+        if len(self.queue) == 0:
+            self._unspool()
+        item = self.queue.popleft()
+        #Keeps memory buffer full, oldest spooled items first
+        if self._spooled > 0:
+            self._unspool()
+        return item
+
+    def _unspool(self):
+        self._spool.seek(self._spool_read_pos)
+        self.queue.append(marshal.load(self._spool))
+        self._spool_read_pos = self._spool.tell()
+        self._spooled -= 1
+        if self._spooled == 0:
+            #Spool is empty: reuses file space from the beginning
+            self._spool.seek(0)
+            self._spool.truncate()
+            self._spool_read_pos = 0
+            self._spool_write_pos = 0
+
+    def close(self):
+        """Removes spool file"""
+        if not self._spool is None:
+            self._spool.close()
+            self._spool = None
+
+
+def _serializeChunk(chunk, wire_format):
+    try:
+        out = []
+        for (position, doc, update) in chunk:
+            if doc is None:
+                out.append((position, None))
+            else:
+                out.append((position, doc.toJSON(update=update) if wire_format == 'json' else doc.toXML(update=update)))
+        return (True, out)
+    except Exception, e:
+        return (False, e)
+
+
+class SerializerPool(object):
+    """Pool of processes serializing documents with SOLRDocument.toXML (or toJSON if wire_format is 'json'), to use more
+than one CPU. Documents (pickled with their SOLRSchema) are sent to processes chunksize at a time and at most window
+(default 2 * processes) chunks are in flight: input is consumed only as fast as serialized documents are. The pool
+should be created before starting threads and closed when done"""
+    def __init__(self, processes=None, chunksize=100, window=None, ordered=True, wire_format='xml'):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.window = 2 * self.processes if window is None else window
+        self.ordered = ordered
+        self.wire_format = wire_format
+        self._pool = multiprocessing.Pool(self.processes)
+
+    def serialize(self, items):
+        """Iterates over (position, SOLRDocument, update) tuples from items and yields (position, serialized document)
+tuples, in the same order if ordered is True, otherwise as soon as they are ready. SOLRDocument None is passed through"""
+        items = iter(items)
+        #AsyncResults in submission order
+        pending = collections.deque()
+        in_flight = 0
+
+        def submit():
+            chunk = list(itertools.islice(items, self.chunksize))
+            if not chunk:
+                return False
+            pending.append(self._pool.apply_async(_serializeChunk, (chunk, self.wire_format)))
+            return True
+
+        def nextReady():
+            #Polls results: a callback would never be called if the chunk can't be pickled
+            while True:
+                for r in pending:
+                    if r.ready():
+                        pending.remove(r)
+                        return r
+                pending[0].wait(0.01)
+
+        while in_flight < self.window and submit():
+            in_flight += 1
+        while in_flight > 0:
+            if self.ordered:
+                (ok, result) = pending.popleft().get()
+            else:
+                (ok, result) = nextReady().get()
+            in_flight -= 1
+            if not ok:
+                raise result
+            #Keeps processes busy while serialized documents are consumed
+            if submit():
+                in_flight += 1
+            for item in result:
+                yield item
+
+    def close(self):
+        """Stops worker processes"""
+        self._pool.terminate()
+        self._pool.join()
+
+
+class LoadJournal(object):
+    """Checkpoint journal of a resumable load, stored in file path. Input documents are identified by increasing
+positions (their index in the input iterator, or their byte offset in an XML file): each time SOLR acknowledges a batch
+the highest position up to which all documents have been loaded (or skipped) is appended to the file. checkpoint
+attribute is the last confirmed position read from the file (None for a new journal): a restarted load should skip
+documents up to it"""
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint = None
+        if os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    #A line not terminated may have been truncated by a crash
+                    if line.endswith('\n') and line.strip():
+                        self.checkpoint = int(line)
+        self._lock = threading.Lock()
+        #Positions read from input, in order, waiting to be confirmed
+        self._issued = collections.deque()
+        self._done = set()
+        self._fh = open(path, 'a')
+
+    def resume(self, docs):
+        """Numbers docs iterator yielding (position, doc) tuples and skips documents already confirmed"""
+        start = 0 if self.checkpoint is None else self.checkpoint + 1
+        return itertools.islice(enumerate(docs), start, None)
+
+    def track(self, items):
+        """Registers positions of (position, doc) tuples from items iterator as they are read"""
+        for (position, doc) in items:
+            with self._lock:
+                self._issued.append(position)
+            yield (position, doc)
+
+    def done(self, positions):
+        """Confirms positions and writes the new checkpoint if it has moved on"""
+        with self._lock:
+            self._done.update(positions)
+            checkpoint = self.checkpoint
+            while self._issued and self._issued[0] in self._done:
+                checkpoint = self._issued.popleft()
+                self._done.remove(checkpoint)
+            if checkpoint != self.checkpoint:
+                self.checkpoint = checkpoint
+                self._fh.write("%d\n" % checkpoint)
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+
+    def close(self):
+        self._fh.close()
+
+
+class ConcurrencyController(object):
+    """AIMD control of the number of update requests in flight, between min_parallel and max_parallel (starting from
+start, default min_parallel). The limit is increased by one after limit consecutive batches loaded within latency_target
+seconds and multiplied by decrease after a failed batch or a slower one, at most once per round: batches started before
+the last decrease can't tell anything about the new limit. If latency_target is None it is tolerance times the fastest
+batch seen. history attribute lists (seconds from start, limit) tuples, one for each change"""
+    def __init__(self, min_parallel=1, max_parallel=8, start=None, latency_target=None, tolerance=2.0, decrease=0.5):
+        self.min_parallel = min_parallel
+        self.max_parallel = max_parallel
+        self.limit = min_parallel if start is None else max(min_parallel, min(start, max_parallel))
+        self.latency_target = latency_target
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.in_flight = 0
+        self.min_latency = None
+        self._successes = 0
+        #Incremented at each decrease: identifies batches started with the current limit
+        self._round = 0
+        self._cond = threading.Condition()
+        self.start_time = time.time()
+        self.history = [(0.0, self.limit)]
+
+    def acquire(self, stop):
+        """Waits for a free slot and returns a token for record and release, or None if stop Event is set meanwhile"""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                if stop.is_set():
+                    return None
+                self._cond.wait(1)
+            self.in_flight += 1
+            return self._round
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _setLimit(self, limit):
+        self.limit = limit
+        self.history.append((time.time() - self.start_time, limit))
+        self._cond.notify_all()
+
+    def record(self, token, seconds, ok=True):
+        """Adjusts the limit after a batch (started with token) loaded in seconds or failed"""
+        with self._cond:
+            if ok and (self.min_latency is None or seconds < self.min_latency):
+                self.min_latency = seconds
+            if not self.latency_target is None:
+                target = self.latency_target
+            elif not self.min_latency is None:
+                target = self.min_latency * self.tolerance
+            else:
+                target = None
+            if ok and seconds <= target:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self._successes = 0
+                    if self.limit < self.max_parallel:
+                        self._setLimit(self.limit + 1)
+            elif token == self._round:
+                self._round += 1
+                self._successes = 0
+                limit = max(self.min_parallel, int(self.limit * self.decrease))
+                if limit != self.limit:
+                    self._setLimit(limit)
+
+    def meanLimit(self):
+        """Returns the time weighted mean of the limit"""
+        now = time.time() - self.start_time
+        if now <= 0:
+            return float(self.limit)
+        changes = self.history + [(now, None)]
+        return sum((changes[i + 1][0] - changes[i][0]) * changes[i][1] for i in range(len(self.history))) / now
+
+
+class DispatcherStats(object):
+    """Per-batch latency and throughput of an UpdateDispatcher run"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        #List of (docs, bytes, seconds) tuples, one per batch sent
+        self.batches = []
+        #Number of documents rejected (see UpdateDispatcher bisect)
+        self.failed = 0
+        #Number of batches retried (see UpdateDispatcher retry)
+        self.retries = 0
+        #(seconds from start, limit) tuples from ConcurrencyController, if any
+        self.concurrency = []
+        self.start_time = time.time()
+        self.end_time = None
+
+    def addBatch(self, docs, size, seconds):
+        with self._lock:
+            self.batches.append((docs, size, seconds))
+
+    def addFailed(self, docs=1):
+        with self._lock:
+            self.failed += docs
+
+    def addRetry(self):
+        with self._lock:
+            self.retries += 1
+
+    def stop(self):
+        self.end_time = time.time()
+
+    @property
+    def docs(self):
+        return sum(b[0] for b in self.batches)
+
+    @property
+    def bytes(self):
+        return sum(b[1] for b in self.batches)
+
+    @property
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def throughput(self):
+        """Returns loaded documents per second (wall clock)"""
+        elapsed = self.elapsed
+        return self.docs / elapsed if elapsed > 0 else 0.0
+
+    def meanLatency(self):
+        """Returns mean batch request time in seconds"""
+        if not self.batches:
+            return 0.0
+        return sum(b[2] for b in self.batches) / len(self.batches)
+
+    def __repr__(self):
+        return "<DispatcherStats: {0} docs in {1} batches, {2} failed, {3} retries, {4:.0f} docs/s, mean batch latency {5:.0f} ms>".format(self.docs, len(self.batches), self.failed, self.retries, self.throughput(), self.meanLatency() * 1000)
+
+
+class UpdateDispatcher(object):
+    """Groups XML documents in batches bounded by number of documents (batch_size) and size in bytes (batch_bytes) and
+sends each batch with send function (that should make an update request) using parallel worker threads. At most parallel
+batches wait to be sent: the producer is blocked until a worker is free. Dispatching stops at the first error: errors
+are stored as sys.exc_info() tuples in errors attribute.
+Batches waiting to be sent are at most queue_size (default parallel). If spool is True batches that don't fit in
+memory are written to a spool file in spool_dir and the producer is never blocked.
+If bisect is a tuple of exception classes, a batch failing with one of them is split in halves that are retried
+recursively, until the offending documents are isolated: they are passed with sys.exc_info() to on_error function
+(or stored in failed attribute if on_error is None) and dispatching goes on.
+If journal (a LoadJournal) is given documents are (position, xmldoc) tuples, with positions registered by
+journal.track: positions of sent or rejected batches are confirmed in the journal. xmldoc None marks a skipped document.
+A batch failing with one of retry exception classes is sent again, at most max_retries times, after retry_delay seconds
+doubled at each attempt up to max_retry_delay: when bisecting each request is retried on its own.
+If adaptive (a ConcurrencyController) is given its max_parallel threads are started, but only as many batches as its
+limit are sent at the same time: the limit follows batch latency and failures (see retry)"""
+    def __init__(self, send, parallel=1, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES, log=logger, bisect=(), on_error=None, queue_size=None, spool=False, spool_dir=None, journal=None, retry=(), max_retries=3, adaptive=None, retry_delay=DEFAULT_RETRY_DELAY, max_retry_delay=DEFAULT_MAX_RETRY_DELAY):
+        self.send = send
+        self.adaptive = adaptive
+        if not adaptive is None:
+            parallel = adaptive.max_parallel
+        self.parallel = parallel
+        self.queue_size = parallel if queue_size is None else queue_size
+        self.spool = spool
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.logger = log
+        self.bisect = bisect
+        self.on_error = on_error
+        self.journal = journal
+        self.retry = retry
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.errors = []
+        self.failed = []
+        self.stats = DispatcherStats()
+
+    def batches(self, xmldocs):
+        """Groups xmldocs iterator in lists of documents"""
+        batch = []
+        size = 0
+        for item in xmldocs:
+            xmldoc = self._xmldoc(item)
+            if xmldoc is None:
+                #Skipped document: nothing to send
+                self.journal.done((item[0],))
+                continue
+            #A document bigger than batch_bytes is sent alone
+            if batch and ((not self.batch_size is None and len(batch) >= self.batch_size) or (not self.batch_bytes is None and size + len(xmldoc) > self.batch_bytes)):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(item)
+            size += len(xmldoc)
+        if batch:
+            yield batch
+
+    def _xmldoc(self, item):
+        return item if self.journal is None else item[1]
+
+    def _confirm(self, batch):
+        if not self.journal is None:
+            self.journal.done(position for (position, _) in batch)
+
+    def _sendBatch(self, batch, token=None):
+        xmldocs = batch if self.journal is None else [xmldoc for (_, xmldoc) in batch]
+        size = sum(len(xmldoc) for xmldoc in xmldocs)
+        start = time.time()
+        try:
+            self.send(xmldocs)
+        except self.retry:
+            if not self.adaptive is None:
+                self.adaptive.record(token, time.time() - start, ok=False)
+            raise
+        elapsed = time.time() - start
+        if not self.adaptive is None:
+            self.adaptive.record(token, elapsed)
+        self.stats.addBatch(len(batch), size, elapsed)
+        self._confirm(batch)
+        self.logger.debug("Batch of {0} documents ({1} bytes) loaded in {2:.0f} ms ({3:.0f} docs/s)".format(len(batch), size, elapsed * 1000, len(batch) / elapsed if elapsed > 0 else 0.0))
+
+    def _bisectBatch(self, batch, stop):
+        """Sends batch isolating documents that make it fail"""
+        try:
+            self._retryBatch(batch, stop)
+        except self.bisect:
+            if len(batch) == 1:
+                self.logger.debug("Document rejected: {0}".format(sys.exc_info()[1]))
+                self.stats.addFailed()
+                if self.on_error is None:
+                    self.failed.append((self._xmldoc(batch[0]), sys.exc_info()))
+                else:
+                    self.on_error(self._xmldoc(batch[0]), sys.exc_info())
+                self._confirm(batch)
+            else:
+                self.logger.debug("Batch of {0} documents failed: bisecting".format(len(batch)))
+                half = len(batch) // 2
+                self._bisectBatch(batch[:half], stop)
+                self._bisectBatch(batch[half:], stop)
+
+    def _worker(self, q, stop):
+        #None is the end of the queue: batches queued after an error are skipped
+        while True:
+            batch = q.get()
+            try:
+                if batch is None:
+                    return
+                if not stop.is_set():
+                    self._dispatchBatch(batch, stop)
+            except Exception:
+                self.errors.append(sys.exc_info())
+                stop.set()
+            finally:
+                q.task_done()
+
+    def _dispatchBatch(self, batch, stop):
+        if self.bisect:
+            self._bisectBatch(batch, stop)
+        else:
+            self._retryBatch(batch, stop)
+
+    def _retryBatch(self, batch, stop):
+        """Sends batch retrying on retry exceptions with exponential backoff, in a controller slot if adaptive. Returns
+without sending it if stop is set meanwhile"""
+        attempts = 0
+        while True:
+            token = None
+            if not self.adaptive is None:
+                token = self.adaptive.acquire(stop)
+                if token is None:
+                    return
+            try:
+                self._sendBatch(batch, token)
+                return
+            except self.retry:
+                attempts += 1
+                if attempts > self.max_retries:
+                    raise
+                self.stats.addRetry()
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+                self.logger.warning("Batch of {0} documents failed ({1}): retrying in {2:.1f} s".format(len(batch), sys.exc_info()[1], delay))
+            finally:
+                if not self.adaptive is None:
+                    self.adaptive.release()
+            if stop.wait(delay):
+                return
+
+    def run(self, xmldocs):
+        """Sends all documents in xmldocs iterator. Returns stats"""
+        #Bounded FIFO Queue of batches: producer waits for workers (or overflows to disk)
+        if self.spool:
+            q = SpoolQueue(self.queue_size, spool_dir=self.spool_dir)
+        else:
+            q = Queue.Queue(self.queue_size)
+
+        #A signal Event for stopping running threads
+        stop = threading.Event()
+
+        threads = []
+        for _ in range(0, self.parallel):
+            t = threading.Thread(target=self._worker, args=(q, stop))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+            self.logger.debug("Starting thread %s" % t.name)
+
+        try:
+            for batch in self.batches(xmldocs):
+                while not stop.is_set():
+                    try:
+                        q.put(batch, True, 1)
+                        break
+                    except Queue.Full:
+                        pass
+                if stop.is_set():
+                    break
+        finally:
+            #Workers end after queued batches (skipped if an error occurred)
+            for _ in threads:
+                q.put(None)
+            for t in threads:
+                self.logger.debug("Joining thread %s", t.name)
+                t.join()
+            if self.spool:
+                q.close()
+            if not self.adaptive is None:
+                self.stats.concurrency = list(self.adaptive.history)
+            self.stats.stop()
+
+        self.logger.info("{0} documents loaded in {1} batches in {2:.1f} s ({3:.0f} docs/s, mean batch latency {4:.0f} ms)".format(self.stats.docs, len(self.stats.batches), self.stats.elapsed, self.stats.throughput(), self.stats.meanLatency() * 1000))
+        return self.stats
@@ -1,26 +1,63 @@
 # -*- coding: utf8 -*-
 import warnings
+import json
 import xml.etree.cElementTree as ET
-import re
+import xml.parsers.expat
 
 import logging
 logger = logging.getLogger("solrcl")
 logger.setLevel(logging.DEBUG)
 
 import exceptions
+from solrcl.schema import SOLRSchema
 
 class SOLRDocumentError(exceptions.SOLRError): pass
 class SOLRDocumentWarning(UserWarning): pass
 
+def _escapeText(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+def _escapeAttribute(text):
+    text = _escapeText(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    return text
+
+
 class SOLRDocument(object):
-    """Class that stores data for a SOLR document. To instantiate SOLRDocument from xml use SOLRDocumentFactory"""
+    """Class that stores data for a SOLR document. To instantiate SOLRDocument from xml use SOLRDocumentFactory.
+solrcore can be a SOLRCore or a SOLRSchema: the document references only the schema snapshot of the core (solr attribute)
+and can be pickled"""
+    __slots__ = ('_fields', '_child_docs', 'solr')
+
     def __init__(self, solrid, solrcore):
         self._fields = {}
         self._child_docs = []
-        self.solr = solrcore
+        schema = getattr(solrcore, 'schema', None)
+        self.solr = schema if isinstance(schema, SOLRSchema) else solrcore
 
         self.setField(self.solr.id_field, solrid)
 
+    def __getstate__(self):
+        #Child documents are nested in parent state: the schema is pickled once
+        return (self.solr, self._fields, [child.__getstate__()[1:] for child in self._child_docs])
+
+    def __setstate__(self, state):
+        (self.solr, self._fields, children) = state
+        self._child_docs = []
+        for child_state in children:
+            child = SOLRDocument.__new__(SOLRDocument)
+            child.__setstate__((self.solr,) + child_state)
+            self._child_docs.append(child)
+
     def __getattr__(self, name):
         #Shortcut to id field
         if name == "id":
@@ -103,29 +140,65 @@ class SOLRDocument(object):
     def hasChildDocs(self):
         return bool(self._child_docs)
 
-    def _toXML(self, update=True):
-        doc = ET.Element('doc')
+    def _writeXML(self, write, update=True):
+        """Writes <doc> markup with write function (e.g. list.append on a buffer), one string per element"""
+        write('<doc>')
         for field, value in self._fields.iteritems():
+            #Concatenation: field names may contain %
+            tag = '<field name="' + _escapeAttribute(field) + '" null="'
+            if field != self.solr.id_field and update:
+                attributes = '" update="set"'
+            else:
+                attributes = '"'
+
             if value[0] is None:
-                f = ET.SubElement(doc, 'field', null='true', name=field)
-                if field != self.solr.id_field and update:
-                    f.set('update', 'set')
-                f.text = ''
+                write(tag + 'true' + attributes + ' />')
             else:
+                serialize = self.solr.fields[field].type.serialize
+                tag = tag + 'false' + attributes
                 for v in value:
-                    f = ET.SubElement(doc, 'field', null='false', name=field)
-                    if field != self.solr.id_field and update:
-                        f.set('update', 'set')
-                    f.text = self.solr.fields[field].type.serialize(v)
+                    text = serialize(v)
+                    if text:
+                        write('%s>%s</field>' % (tag, _escapeText(text)))
+                    else:
+                        write(tag + ' />')
 
         for child in self._child_docs:
-            doc.append(child._toXML(update=update))
-        return doc
+            child._writeXML(write, update=update)
+        write('</doc>')
 
     def toXML(self, update=True):
-        """Serializes SOLRDocument into an XML string suitable for SOLR update request handler"""
-        #Unfortunately it seems there's no way to avoid xml declaration... so I've to remove it with a regexp
-        return re.sub(r"^<\?xml version='1.0' encoding='[^']*'\?>\s*", '', ET.tostring(self._toXML(update=update), encoding='utf8'))
+        """Serializes SOLRDocument into an utf8 XML string suitable for SOLR update request handler"""
+        buf = []
+        self._writeXML(buf.append, update=update)
+        return u''.join(buf).encode('utf8')
+
+    def toDict(self, update=True):
+        """Returns SOLRDocument as a dict suitable for SOLR JSON update request handler. Values are serialized and child
+documents are in _childDocuments_ list. If update is True fields other than id are in atomic update form {"set": value}
+(null fields are removed), otherwise null fields are omitted"""
+        doc = {}
+        for field, value in self._fields.iteritems():
+            if value[0] is None:
+                if field != self.solr.id_field and update:
+                    doc[field] = {'set': None}
+            else:
+                serialize = self.solr.fields[field].type.serialize
+                if self.solr.fields[field].multi:
+                    v = [serialize(x) for x in value]
+                else:
+                    v = serialize(value[0])
+                if field != self.solr.id_field and update:
+                    v = {'set': v}
+                doc[field] = v
+
+        if self._child_docs:
+            doc['_childDocuments_'] = [child.toDict(update=update) for child in self._child_docs]
+        return doc
+
+    def toJSON(self, update=True):
+        """Serializes SOLRDocument into a JSON string suitable for SOLR JSON update request handler (see toDict)"""
+        return json.dumps(self.toDict(update=update), separators=(',', ':'))
 
     def clone(self):
         #Don't use copy.deepcopy because i don't want to clone also self.solr object
@@ -169,6 +242,15 @@ class SOLRDocumentFactory(object):
         #Create a new document with a fake id, unfortunately id field is not necessarly in the first position so I should iterate all fields to find it before reading other fields. In this way I can set it later. The counterpart is that I have to enforce that id field exists in another way.
         doc = SOLRDocument(u'changeme', self.solr)
 
+        #Values of each field, deserialized at once by flush
+        values = {}
+        def flush(fieldname):
+            try:
+                for value in self.solr.fields[fieldname].type.deserializeList(values.pop(fieldname)):
+                    doc.appendFieldValue(fieldname, value)
+            except ValueError as e:
+                raise SOLRDocumentError("%s" % e)
+
         for field in xmldoc:
             if field.tag == 'field':
                 fieldname = field.get('name')
@@ -179,24 +261,28 @@ class SOLRDocumentFactory(object):
                     id_in_record = True
 
                 if field.get('null') == 'true':
+                    #Null replaces values before it
+                    values.pop(fieldname, None)
                     doc.setField(fieldname, None)
                 else:
                     value = field.text
                     # Note that when there is no text field.text returns None, not ''
                     # Let's transform it in '' because Nulls are already managed separately
                     value = u'' if value is None else value
-                    try:
-                        if fieldname == self.solr.id_field:
+                    if fieldname == self.solr.id_field:
+                        try:
                             doc.setField(fieldname, self.solr.fields[fieldname].type.deserialize(unicode(value)))
-                        else:
-                            doc.appendFieldValue(fieldname, self.solr.fields[fieldname].type.deserialize(unicode(value)))
-                    except ValueError as e:
-                        raise SOLRDocumentError("%s" % e)
+                        except ValueError as e:
+                            raise SOLRDocumentError("%s" % e)
+                    else:
+                        values.setdefault(fieldname, []).append(unicode(value))
 
             elif field.tag == 'doc':
                 doc.addChild(self._fromXMLDoc(field))
             else:
                 raise SOLRDocumentError, "Invalid tag {0} in doc".format(field.tag)
+        for fieldname in values.keys():
+            flush(fieldname)
         if not id_in_record:
             raise SOLRDocumentError, "Missing unique id field in doc"
 
@@ -225,3 +311,76 @@ class SOLRDocumentFactory(object):
                 except SOLRDocumentError, e:
                     #Transform document errors in warnings to continue to next
                     warnings.warn("%s" % e, SOLRDocumentWarning)
+
+    def fromXMLOffsets(self, fh, offset=None, chunk_size=65536):
+        """Like fromXML, but returns a generator over (offset, SOLRDocument) tuples where offset is the position in bytes of
+the closing tag of each top level document in fh. If offset is given (e.g. LoadJournal.checkpoint of a previous load)
+fh is seeked past the closing tag at offset and parsing starts from the following document: fh must be a seekable
+utf8 file with documents in an add element."""
+        state = {'depth': 0, 'builder': None}
+        parsed = []
+
+        if offset is None:
+            base = 0
+            prefix = ''
+        else:
+            fh.seek(offset)
+            skipped = ''
+            while not '>' in skipped:
+                data = fh.read(64)
+                if not data:
+                    raise SOLRDocumentError("No closing tag at offset %s" % offset)
+                skipped += data
+            end = skipped.index('>') + 1
+            fh.seek(offset + end)
+            #The remaining documents are still closed by </add>
+            prefix = '<add>'
+            base = offset + end - len(prefix)
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+
+        def start(tag, attrs):
+            if not tag in ('add', 'doc', 'field'):
+                raise SOLRDocumentError, "Invalid tag {0}".format(tag)
+            if tag == 'doc':
+                if state['depth'] == 0:
+                    state['builder'] = ET.TreeBuilder()
+                state['depth'] += 1
+            if not state['builder'] is None:
+                state['builder'].start(tag, attrs)
+
+        def end(tag):
+            if not state['builder'] is None:
+                state['builder'].end(tag)
+            if tag == 'doc':
+                state['depth'] -= 1
+                if state['depth'] == 0:
+                    parsed.append((base + parser.CurrentByteIndex, state['builder'].close()))
+                    state['builder'] = None
+
+        def data(text):
+            if not state['builder'] is None:
+                state['builder'].data(text)
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = data
+
+        if prefix:
+            parser.Parse(prefix)
+        while True:
+            chunk = fh.read(chunk_size)
+            try:
+                parser.Parse(chunk, not chunk)
+            except xml.parsers.expat.ExpatError, e:
+                raise SyntaxError("%s" % e)
+            for (docoffset, element) in parsed:
+                try:
+                    yield (docoffset, self._fromXMLDoc(element))
+                except SOLRDocumentError, e:
+                    #Transform document errors in warnings to continue to next
+                    warnings.warn("%s" % e, SOLRDocumentWarning)
+            del parsed[:]
+            if not chunk:
+                break
@@ -0,0 +1,176 @@
+# -*- coding: utf8 -*-
+"""Compact id membership stores for SOLRCore prefetch caches"""
+
+import array
+import hashlib
+import math
+import struct
+import sys
+
+
+def _key(solrid):
+    """Returns the utf8 bytes of solrid: they sort as SOLR sorts string ids"""
+    if isinstance(solrid, str):
+        return solrid
+    if not isinstance(solrid, unicode):
+        solrid = unicode(solrid)
+    return solrid.encode('utf8')
+
+
+class SetIdStore(object):
+    """Ids in a python set: fastest lookups, largest memory footprint"""
+    def __init__(self):
+        self._ids = set()
+
+    def add(self, solrid):
+        self._ids.add(solrid)
+
+    def freeze(self):
+        """Called when all ids have been added"""
+        pass
+
+    def __contains__(self, solrid):
+        return solrid in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def nbytes(self):
+        """Memory used by the set and ids"""
+        return sys.getsizeof(self._ids) + sum(sys.getsizeof(x) for x in self._ids)
+
+
+class SortedIdStore(object):
+    """Ids stored as sorted utf8 strings in a single buffer with an array of offsets, searched with binary search. Adding
+ids already sorted (e.g. streamed sorting on the unique key) is cheap, otherwise they are sorted by freeze"""
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array.array('I', [0])
+        self._last = None
+        self._sorted = True
+
+    def add(self, solrid):
+        key = _key(solrid)
+        if not self._last is None:
+            if key == self._last:
+                return
+            if key < self._last:
+                self._sorted = False
+        self._last = key
+        self._data.extend(key)
+        end = len(self._data)
+        if end > 0xFFFFFFFF and self._offsets.typecode == 'I':
+            #Buffer bigger than 4GB
+            self._offsets = array.array('L', self._offsets)
+        self._offsets.append(end)
+
+    def _get(self, i):
+        return str(self._data[self._offsets[i]:self._offsets[i + 1]])
+
+    def freeze(self):
+        if self._sorted:
+            return
+        keys = sorted(set(self._get(i) for i in xrange(len(self))))
+        self.__init__()
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, solrid):
+        key = _key(solrid)
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._get(mid)
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    @property
+    def nbytes(self):
+        """Memory used by ids and offsets"""
+        return len(self._data) + len(self._offsets) * self._offsets.itemsize
+
+
+class _BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        #Double hashing: positions h1 + i * h2
+        (h1, h2) = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return ((h1 + i * h2) % self.bits for i in xrange(self.hashes))
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        array = self._array
+        return all(array[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class BloomIdStore(object):
+    """Ids hashed in a Bloom filter that grows (as a chain of filters with doubling capacity and halving error rate) when
+capacity is reached: memory is a few bits per id. A positive hit may be false (with probability at most error_rate):
+if fallback is given it is called with the id to return the exact answer"""
+    def __init__(self, capacity=1000000, error_rate=0.01, fallback=None):
+        self.error_rate = error_rate
+        self.fallback = fallback
+        self._filters = [_BloomFilter(capacity, error_rate / 2.0)]
+
+    def add(self, solrid):
+        current = self._filters[-1]
+        if current.count >= current.capacity:
+            current = _BloomFilter(current.capacity * 2, self.error_rate / 2.0 ** (len(self._filters) + 1))
+            self._filters.append(current)
+        current.add(_key(solrid))
+
+    def freeze(self):
+        pass
+
+    def mightContain(self, solrid):
+        """Returns False if solrid has not been added, True if it probably has"""
+        key = _key(solrid)
+        return any(key in f for f in self._filters)
+
+    def __contains__(self, solrid):
+        if not self.mightContain(solrid):
+            return False
+        if self.fallback is None:
+            return True
+        return self.fallback(solrid)
+
+    def __len__(self):
+        return sum(f.count for f in self._filters)
+
+    @property
+    def nbytes(self):
+        """Memory used by filters"""
+        return sum(len(f._array) for f in self._filters)
+
+
+ID_STORES = {'set': SetIdStore, 'sorted': SortedIdStore, 'bloom': BloomIdStore}
+
+def newIdStore(kind, fallback=None):
+    """Returns an empty id store of kind ('set', 'sorted' or 'bloom'). fallback (exact lookup function) is used by bloom
+stores only"""
+    if kind == 'bloom':
+        return BloomIdStore(fallback=fallback)
+    try:
+        return ID_STORES[kind]()
+    except KeyError:
+        raise ValueError("Invalid id store %s" % kind)
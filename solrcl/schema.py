@@ -0,0 +1,76 @@
+# -*- coding: utf8 -*-
+"""Read-only snapshot of a SOLR core schema"""
+
+import weakref
+
+from solrcl.solrtype import SOLRType
+from solrcl.solrfield import SOLRField
+
+#Schemas unpickled in this process by state, while they are referenced: documents pickled separately share the same
+#instance (and types)
+_unpickled = weakref.WeakValueDictionary()
+
+def _unpickleSchema(state):
+    try:
+        return _unpickled[state]
+    except KeyError:
+        (id_field, fieldspecs) = state
+        types = {}
+        fields = {}
+        for (name, typename, className, multi, docValues, stored, _) in fieldspecs:
+            if not types.has_key((typename, className)):
+                types[(typename, className)] = SOLRType(typename, className)
+            fields[name] = SOLRField(name, types[(typename, className)], multi=multi, docValues=docValues, stored=stored)
+        for (name, _, _, _, _, _, copySources) in fieldspecs:
+            fields[name].copySources.extend(fields[x] for x in copySources)
+
+        schema = _unpickled[state] = SOLRSchema(id_field, fields)
+        return schema
+
+
+class ReadOnlyDict(dict):
+    """dict that can't be modified after creation"""
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError("{0} is read-only".format(type(self).__name__))
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readOnly
+
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+
+class SOLRSchema(object):
+    """Read-only snapshot of the fields (with their types) and unique key field of a SOLR core, referenced by SOLRDocument
+instances instead of SOLRCore: attributes can't be set and fields is a ReadOnlyDict. SOLRField and SOLRType instances are
+shared with the core and must not be modified. It is cheap to pickle, so documents can be built, validated and
+serialized in other processes without a connection to SOLR"""
+    __slots__ = ('id_field', 'fields', '_state', '__weakref__')
+
+    def __init__(self, id_field, fields):
+        object.__setattr__(self, 'id_field', id_field)
+        object.__setattr__(self, 'fields', ReadOnlyDict(fields))
+        object.__setattr__(self, '_state', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SOLRSchema is read-only")
+
+    def _getState(self):
+        if self._state is None:
+            fieldspecs = tuple(sorted((name, f.type.name, f.type.className, f.multi, f.docValues, f.stored, tuple(x.name for x in f.copySources)) for (name, f) in self.fields.iteritems()))
+            object.__setattr__(self, '_state', (self.id_field, fieldspecs))
+        return self._state
+
+    def __reduce__(self):
+        return (_unpickleSchema, (self._getState(),))
+
+    def __eq__(self, other):
+        return type(other) is type(self) and self._getState() == other._getState()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._getState())
+
+    def __repr__(self):
+        return "<SOLRSchema: {0} fields, id field {1}>".format(len(self.fields), self.id_field)
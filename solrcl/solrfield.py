@@ -3,10 +3,12 @@
 
 class SOLRField(object):
     """A SOLR field with all properties from schema"""
-    def __init__(self, name, solrtype, multi=False, copySources=None):
+    def __init__(self, name, solrtype, multi=False, copySources=None, docValues=False, stored=True):
         self.name = name
         self.type = solrtype
         self.multi = multi
+        self.docValues = docValues
+        self.stored = stored
         if copySources is None:
             self.copySources = []
         else:
@@ -1,7 +1,6 @@
 # -*- coding: utf8 -*-
 """Classes representing SOLR types"""
 
-import re
 import datetime
 import warnings
 import logging
@@ -20,43 +19,43 @@ class NotImplementedSOLRTypeWarning(UserWarning):
 #Utility functions
 def solr2datetime(s):
     """
-Utility function to convert SOLR datetime string representation into a datetime python object
+Utility function to convert SOLR datetime string representation into a datetime python object. The fixed layout
+YYYY-MM-DDThh:mm:ssZ, optionally with fractional seconds (YYYY-MM-DDThh:mm:ss.SSSZ), is parsed by position: other
+strings are parsed with strptime and SOLR_DATETIME_FORMAT
 
 :param s: SOLR formatted date to convert
 :type x: str
 :rtype: datetime.datetime
     """
+    try:
+        if s[4] == s[7] == '-' and s[10] == 'T' and s[13] == s[16] == ':' and s[-1] == 'Z':
+            fields = (s[:4], s[5:7], s[8:10], s[11:13], s[14:16], s[17:19])
+            if all(x.isdigit() for x in fields):
+                if len(s) == 20:
+                    return datetime.datetime(*[int(x) for x in fields])
+                elif s[19] == '.' and 21 < len(s) <= 27 and s[20:-1].isdigit():
+                    return datetime.datetime(*[int(x) for x in fields] + [int(s[20:-1].ljust(6, '0'))])
+    except (IndexError, TypeError):
+        pass
     return datetime.datetime.strptime(s, SOLR_DATETIME_FORMAT)
 
-#This function supporting datetime formatting for dates prior to 1-1-1900 comes from
-#http://stackoverflow.com/questions/1526170/formatting-date-string-in-python-for-dates-prior-to-1900
-
-ANCIENT_FMT_DICT = {
-    '%Y': '{0.year}',
-    '%m': '{0.month:02}',
-    '%d': '{0.day:02}',
-    '%H': '{0.hour:02}',
-    '%M': '{0.minute:02}',
-    '%S': '{0.second:02}'}
-
-def ancient_fmt(ts, fmt):
-    fmt = fmt.replace('%%', '%')
-    fmt = re.sub('(%\w)', r'{\1}', fmt)
-    return fmt.format(**ANCIENT_FMT_DICT).format(ts)
-
 def datetime2solr(d):
+    """Formats datetime d as SOLR does: YYYY-MM-DDThh:mm:ssZ, with milliseconds (YYYY-MM-DDThh:mm:ss.SSSZ) if any. Years
+before 1900 are supported. Dates (datetime.date) are formatted at midnight"""
     try:
-        if d.year < 1900:
-            return unicode(ancient_fmt(d, SOLR_DATETIME_FORMAT))
-        else:
-            return unicode(d.strftime(SOLR_DATETIME_FORMAT))
+        if not isinstance(d, datetime.datetime):
+            return u'%04d-%02d-%02dT00:00:00Z' % (d.year, d.month, d.day)
+        millis = d.microsecond // 1000
+        if millis:
+            return u'%04d-%02d-%02dT%02d:%02d:%02d.%03dZ' % (d.year, d.month, d.day, d.hour, d.minute, d.second, millis)
+        return u'%04d-%02d-%02dT%02d:%02d:%02dZ' % (d.year, d.month, d.day, d.hour, d.minute, d.second)
     except AttributeError, e:
         raise ValueError, "Not a datetime compatible object: %s" % repr(d)
 
 
 class SOLRType(object):
     """Class representing a SOLR type that provides methods to check,
- serialize and deserialize values"""
+ serialize and deserialize values. checkList, serializeList and deserializeList do the same on lists of values at once"""
     def __init__(self, name, className):
         self.name = name
         self.className = className
@@ -76,6 +75,20 @@ class SOLRType(object):
                 warnings.warn("Unknown SOLR class %s" % self.className, NotImplementedSOLRTypeWarning)
                 setattr(self, action, getattr(self, '_%s_default' % action))
 
+            #Batch codecs: per class if defined, otherwise calling the single value one
+            try:
+                setattr(self, action + 'List', getattr(self, '_%sList_%s' % (action, class_name)))
+            except AttributeError:
+                setattr(self, action + 'List', self._listCodec(getattr(self, action)))
+
+    def __reduce__(self):
+        #Functions are bound on init
+        return (SOLRType, (self.name, self.className))
+
+    @staticmethod
+    def _listCodec(f):
+        return lambda values: [f(x) for x in values]
+
     @staticmethod
     def check(self, value):
         #Dinamically defined on init
@@ -91,6 +104,21 @@ class SOLRType(object):
         #Dinamically defined on init
         pass
 
+    @staticmethod
+    def checkList(self, values):
+        #Dinamically defined on init
+        pass
+
+    @staticmethod
+    def serializeList(self, values):
+        #Dinamically defined on init
+        pass
+
+    @staticmethod
+    def deserializeList(self, values):
+        #Dinamically defined on init
+        pass
+
     @staticmethod
     def _check_default(value):
         pass
@@ -195,3 +223,51 @@ class SOLRType(object):
     @staticmethod
     def _deserialize_TrieFloatField(value):
         return float(value)
+
+    @staticmethod
+    def _serializeList_TextField(values):
+        return list(values)
+
+    @staticmethod
+    def _serializeList_StrField(values):
+        return list(values)
+
+    @staticmethod
+    def _serializeList_TrieDateField(values):
+        return map(datetime2solr, values)
+
+    @staticmethod
+    def _serializeList_TrieIntField(values):
+        return map(unicode, values)
+
+    @staticmethod
+    def _serializeList_TrieLongField(values):
+        return map(unicode, values)
+
+    @staticmethod
+    def _serializeList_TrieFloatField(values):
+        return map(unicode, values)
+
+    @staticmethod
+    def _deserializeList_TextField(values):
+        return list(values)
+
+    @staticmethod
+    def _deserializeList_StrField(values):
+        return list(values)
+
+    @staticmethod
+    def _deserializeList_TrieDateField(values):
+        return map(solr2datetime, values)
+
+    @staticmethod
+    def _deserializeList_TrieIntField(values):
+        return map(int, values)
+
+    @staticmethod
+    def _deserializeList_TrieLongField(values):
+        return map(int, values)
+
+    @staticmethod
+    def _deserializeList_TrieFloatField(values):
+        return map(float, values)
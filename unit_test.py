@@ -7,11 +7,24 @@ import unittest
 import mock
 import copy
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+import threading
+import os
+import json
+import pickle
+import tempfile
+import time
+
 import datetime
 import xml.etree.cElementTree as ET
 import StringIO
 import requests
 import httplib
+import urlparse
+import zlib
 
 import solrcl
 
@@ -27,6 +40,7 @@ class TestSolrlibSOLRDocumentBase(unittest.TestCase):
         solrtype.check.return_value = True
         solrtype.serialize.side_effect = lambda x: x
         solrtype.deserialize.side_effect = lambda x: x
+        solrtype.deserializeList.side_effect = lambda x: list(x)
 
         solrwrongtype = mock.Mock(spec=solrcl.SOLRType)
         solrwrongtype.name = 'testwrongtype'
@@ -34,6 +48,7 @@ class TestSolrlibSOLRDocumentBase(unittest.TestCase):
         solrwrongtype.check.return_value = True
         solrwrongtype.serialize.side_effect = lambda x: x
         solrwrongtype.deserialize.side_effect = ValueError("Wrong value!")
+        solrwrongtype.deserializeList.side_effect = ValueError("Wrong value!")
 
         solrfield = mock.Mock(spec=solrcl.SOLRField)
         solrfield.name = 'myidfield'
@@ -270,6 +285,48 @@ class TestSolrlibSOLRDocument(TestSolrlibSOLRDocumentBase):
         xmldoc = self._checkXMLDoc(xml)
         self._checkFieldAttribute(xmldoc, 'testfield', 'update', None)
 
+    def test_toXML_markup(self):
+        d = solrcl.SOLRDocument(u'a', self.solr)
+        d.setField('testfield', u'<à€> & "b"')
+        d.setField('testfieldmulti', [u'', u'x'])
+        dchild = solrcl.SOLRDocument(u'a.1', self.solr)
+        d.addChild(dchild)
+        xml = d.toXML(update=False)
+        self.assertTrue(isinstance(xml, str))
+        self.assertTrue('<field name="testfield" null="false">&lt;\xc3\xa0\xe2\x82\xac&gt; &amp; "b"</field>' in xml)
+        self.assertTrue('<field name="testfieldmulti" null="false" /><field name="testfieldmulti" null="false">x</field>' in xml)
+        self.assertTrue(xml.endswith('<doc><field name="myidfield" null="false">a.1</field></doc></doc>'))
+        xmldoc = self._checkXMLDoc(xml)
+        self._checkField(xmldoc, 'testfield', u'<à€> & "b"')
+
+    def test_toXML_percent_fieldname(self):
+        for name in ('a%sb', 'c%d'):
+            self.solr.fields[name] = self.solr.fields['testfield']
+        d = solrcl.SOLRDocument(u'a', self.solr)
+        d.setField('a%sb', u'x')
+        d.setField('c%d', None)
+        xml = d.toXML()
+        self.assertTrue('<field name="a%sb" null="false" update="set">x</field>' in xml)
+        self.assertTrue('<field name="c%d" null="true" update="set" />' in xml)
+        xmldoc = self._checkXMLDoc(xml)
+        self._checkField(xmldoc, 'a%sb', u'x')
+
+    def test_toDict(self):
+        d = solrcl.SOLRDocument(u'a', self.solr)
+        d.setField('testfield', None)
+        d.setField('testfieldmulti', [u'à€b', u'à€a'])
+        dchild = solrcl.SOLRDocument(u'a.1', self.solr)
+        dchild.setField('testfield', u'x')
+        d.addChild(dchild)
+        self.assertEqual(d.toDict(), {'myidfield': u'a', 'testfield': {'set': None}, 'testfieldmulti': {'set': [u'à€b', u'à€a']}, '_childDocuments_': [{'myidfield': u'a.1', 'testfield': {'set': u'x'}}]})
+        self.assertEqual(d.toDict(update=False), {'myidfield': u'a', 'testfieldmulti': [u'à€b', u'à€a'], '_childDocuments_': [{'myidfield': u'a.1', 'testfield': u'x'}]})
+
+    def test_toJSON(self):
+        d = solrcl.SOLRDocument(u'à€', self.solr)
+        d.setField('testfield', u'"x"')
+        self.assertEqual(json.loads(d.toJSON()), {'myidfield': u'à€', 'testfield': {'set': u'"x"'}})
+        self.assertTrue(isinstance(d.toJSON(), str))
+
     def test_clone(self):
         d = solrcl.SOLRDocument(u'a', self.solr)
         d.setField('testfield', None)
@@ -455,6 +512,16 @@ class TestSolrlibSOLRDocumentFactory(TestSolrlibSOLRDocumentBase):
             self.assertEqual(len(w), 1)
             self.assertEqual(w[0].category, solrcl.SOLRDocumentWarning)
 
+    def test_fromXML_invalidDate(self):
+        self.df.solr.fields['testfield'].type = solrcl.SOLRType('testdate', 'org.apache.solr.schema.TrieDateField')
+        XML = '<add><doc><field name="myidfield">1</field><field name="testfield">2014-+1-01T00:00:00Z</field></doc><doc><field name="myidfield">2</field><field name="testfield">2014-01-01T00:00:00.5Z</field></doc></add>'
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            docs = list(self.df.fromXML(StringIO.StringIO(XML)))
+            self.assertEqual(len(w), 1)
+            self.assertEqual(w[0].category, solrcl.SOLRDocumentWarning)
+        self.assertEqual([doc.getField('testfield') for doc in docs], [datetime.datetime(2014, 1, 1, 0, 0, 0, 500000)])
+
     def test_fromXML_invalidTag(self):
         XML = '<add><doc><field name="myidfield">1</field><invalidtag>aaa</invalidtag></doc></add>'
         fh = StringIO.StringIO(XML)
@@ -462,6 +529,31 @@ class TestSolrlibSOLRDocumentFactory(TestSolrlibSOLRDocumentBase):
 
         self.assertRaises(solrcl.SOLRDocumentError, iterdocs.next)
 
+    def test_fromXMLOffsets(self):
+        XML = '<?xml version="1.0" encoding="UTF-8"?>\n<add>\n<doc><field name="myidfield">1</field><field name="testfield">à€</field></doc>\n<doc><field name="myidfield">2</field><doc><field name="myidfield">2.1</field></doc></doc >\n<doc><field name="myidfield">3</field></doc>\n</add>\n'
+        fh = StringIO.StringIO(XML)
+        docs = list(self.df.fromXMLOffsets(fh, chunk_size=10))
+        self.assertEqual([doc.id for (_, doc) in docs], [u'1', u'2', u'3'])
+        self.assertEqual(docs[0][1].getField('testfield'), u'à€')
+        self.assertEqual(len(docs[1][1].getChildDocs()), 1)
+        for (offset, _) in docs:
+            self.assertTrue(XML[offset:].startswith('</doc'))
+
+        #Resumes after the second document
+        docs = list(self.df.fromXMLOffsets(StringIO.StringIO(XML), offset=docs[1][0]))
+        self.assertEqual([doc.id for (_, doc) in docs], [u'3'])
+        self.assertTrue(XML[docs[0][0]:].startswith('</doc>\n</add>'))
+
+        docs = list(self.df.fromXMLOffsets(StringIO.StringIO(XML), offset=docs[0][0]))
+        self.assertEqual(docs, [])
+
+    def test_fromXMLOffsets_invalidTag(self):
+        XML = '<add><doc><field name="myidfield">1</field><invalidtag>aaa</invalidtag></doc></add>'
+        iterdocs = self.df.fromXMLOffsets(StringIO.StringIO(XML))
+        self.assertRaises(solrcl.SOLRDocumentError, iterdocs.next)
+        iterdocs = self.df.fromXMLOffsets(StringIO.StringIO('<doc><field>this is not xml</doc>'))
+        self.assertRaises(SyntaxError, iterdocs.next)
+
     def test_fromXML_missingId(self):
         XML = '<add><doc><field name="testfield">testvalue</field></doc></add>'
         fh = StringIO.StringIO(XML)
@@ -630,6 +722,38 @@ class TestSOLRTypeMethods(unittest.TestCase):
         self.assertEqual(self.t._deserialize_TrieFloatField(u'1.2345'), 1.2345)
         self.assertRaises(ValueError, self.t._deserialize_TrieFloatField, "nonvalid")
 
+    def test_solr2datetime(self):
+        self.assertEqual(solrcl.solr2datetime(u'1975-03-04T03:15:23.5Z'), datetime.datetime(1975, 3, 4, 3, 15, 23, 500000))
+        self.assertEqual(solrcl.solr2datetime('2015-12-31T23:59:59.123Z'), datetime.datetime(2015, 12, 31, 23, 59, 59, 123000))
+        self.assertEqual(solrcl.solr2datetime(u'0850-01-01T00:00:00Z'), datetime.datetime(850, 1, 1))
+        for value in (u'1975-13-04T03:15:23Z', u'1975-03-04T03:15:23.Z', u'1975-03-04T03:15:23.abcZ', u'1975-03-04 03:15:23Z', u'', u'2014-+1-01T00:00:00Z', u'2014-01-01T 1:00:00Z', u'2014-01-01T01:00:-1Z', u'+014-01-01T00:00:00Z'):
+            self.assertRaises(ValueError, solrcl.solr2datetime, value)
+
+    def test_datetime2solr(self):
+        self.assertEqual(solrcl.datetime2solr(datetime.datetime(1975, 3, 4, 3, 15, 23, 123456)), u'1975-03-04T03:15:23.123Z')
+        self.assertEqual(solrcl.datetime2solr(datetime.datetime(1975, 3, 4, 3, 15, 23, 999)), u'1975-03-04T03:15:23Z')
+        self.assertEqual(solrcl.datetime2solr(datetime.datetime(850, 1, 1)), u'0850-01-01T00:00:00Z')
+        self.assertEqual(solrcl.datetime2solr(datetime.date(1850, 3, 4)), u'1850-03-04T00:00:00Z')
+        self.assertRaises(ValueError, solrcl.datetime2solr, 'a')
+
+    def test_list_codecs(self):
+        t = solrcl.SOLRType('testdate', 'org.apache.solr.schema.TrieDateField')
+        dates = [datetime.datetime(1975, 3, 4, 3, 15, 23, 500000), datetime.datetime(1850, 1, 1)]
+        self.assertEqual(t.serializeList(dates), [u'1975-03-04T03:15:23.500Z', u'1850-01-01T00:00:00Z'])
+        self.assertEqual(t.deserializeList(t.serializeList(dates)), dates)
+        t.checkList(dates)
+        self.assertRaises(AssertionError, t.checkList, [dates[0], u'a'])
+
+        t = solrcl.SOLRType('testint', 'org.apache.solr.schema.TrieIntField')
+        self.assertEqual(t.deserializeList([u'1', 2]), [1, 2])
+        self.assertEqual(t.serializeList([1, 2]), [u'1', u'2'])
+        self.assertRaises(ValueError, t.deserializeList, [u'1', u'a'])
+
+        #Types without batch codecs
+        t = solrcl.SOLRType('testbool', 'org.apache.solr.schema.BoolField')
+        self.assertEqual(t.deserializeList([u'true', u'False']), [True, False])
+        self.assertEqual(t.serializeList([True]), [u'true'])
+
 
 
 class TestSOLRField(unittest.TestCase):
@@ -642,6 +766,11 @@ class TestSOLRField(unittest.TestCase):
         self.assertFalse(f.multi)
         self.assertEqual(f.copySources, [])
 
+    def test_init_docValues(self):
+        solrtype = mock.Mock()
+        f = solrcl.SOLRField('testfield', solrtype, docValues=True)
+        self.assertEqual(f.docValues, True)
+
     def test_init_multi(self):
         solrtype = mock.Mock()
         f = solrcl.SOLRField('testfield', solrtype, multi=True)
@@ -685,7 +814,7 @@ class TestSOLRRequest(unittest.TestCase):
     def setUp(self):
         self.solr = solrcl.SOLRRequest(domain='localhost', port=8983)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_request_default(self, mock_requests_get):
         SOLR_RESPONSE = {'responseHeader': {'status': 0, 'QTime': 5}, 'foo': 'bar'}
         response = mock.Mock()
@@ -698,7 +827,7 @@ class TestSOLRRequest(unittest.TestCase):
         mock_requests_get.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json'}, headers={}, data=None)
         self.assertEqual(solr_response, SOLR_RESPONSE)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_requests_parameters(self, mock_requests_get):
         SOLR_RESPONSE = {'responseHeader': {'status': 0, 'QTime': 5}, 'foo': 'bar'}
         response = mock.Mock()
@@ -711,7 +840,56 @@ class TestSOLRRequest(unittest.TestCase):
         mock_requests_get.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json', 'foo': 'bar'}, headers={}, data=None)
         self.assertEqual(solr_response, SOLR_RESPONSE)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.get')
+    def test_requests_conditional(self, mock_requests_get):
+        SOLR_RESPONSE = {'responseHeader': {'status': 0, 'QTime': 5}, 'foo': 'bar'}
+        response = mock.Mock()
+        response.status_code = 200
+        response.headers = requests.structures.CaseInsensitiveDict({'Content-Type': 'application/json', 'ETag': '"abc"', 'Last-Modified': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+        response.json = mock.Mock(return_value=SOLR_RESPONSE)
+        not_modified = mock.Mock()
+        not_modified.status_code = 304
+        not_modified.headers = {}
+        mock_requests_get.side_effect = [response, not_modified]
+
+        solr = solrcl.SOLRRequest(domain='localhost', port=8983, conditional_bytes=10000)
+        self.assertEqual(solr.request('foo/bar', parameters={'q': 'x'}), SOLR_RESPONSE)
+        mock_requests_get.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json', 'q': 'x'}, headers={}, data=None)
+        self.assertTrue(solr.request('foo/bar', parameters={'q': 'x'}) is solr.conditional.get(('http://localhost:8983/solr/foo/bar', solrcl.ResultCache.key({'q': 'x'})))[2])
+        mock_requests_get.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json', 'q': 'x'}, headers={'If-None-Match': '"abc"', 'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'}, data=None)
+        self.assertEqual(solr.not_modified, 1)
+
+        #No validators in response: nothing stored
+        response.headers = {'content-type': 'application/json'}
+        mock_requests_get.side_effect = None
+        mock_requests_get.return_value = response
+        solr.request('foo/bar', parameters={'q': 'x'})
+        solr.request('foo/bar', parameters={'q': 'x'})
+        mock_requests_get.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json', 'q': 'x'}, headers={}, data=None)
+        self.assertEqual(len(solr.conditional), 0)
+
+    @mock.patch('requests.Session.post')
+    def test_requests_bad_request(self, mock_requests_post):
+        response = mock.Mock()
+        response.headers = {'content-type': 'application/json'}
+        response.json = mock.Mock(return_value={'responseHeader': {'status': 400, 'QTime': 1}, 'error': {'msg': 'unknown field', 'code': 400}})
+        mock_requests_post.return_value = response
+        self.assertRaises(solrcl.SOLRBadRequestError, self.solr.request, 'foo/bar', data='<add/>')
+
+        response.json.return_value = {'responseHeader': {'status': 500, 'QTime': 1}, 'error': {'msg': 'server error', 'code': 500}}
+        try:
+            self.solr.request('foo/bar', data='<add/>')
+            self.fail()
+        except solrcl.SOLRResponseError, e:
+            self.assertFalse(isinstance(e, solrcl.SOLRBadRequestError))
+            self.assertEqual(e.httpStatus, 500)
+
+        response.headers = {'content-type': 'text/html'}
+        response.status_code = 400
+        response.raise_for_status = mock.Mock(side_effect=requests.HTTPError("400 Bad Request"))
+        self.assertRaises(solrcl.SOLRBadRequestError, self.solr.request, 'foo/bar', data='<add/>')
+
+    @mock.patch('requests.Session.post')
     def test_requests_data(self, mock_requests_post):
         SOLR_RESPONSE = {'responseHeader': {'status': 0, 'QTime': 5}, 'foo': 'bar'}
         response = mock.Mock()
@@ -725,7 +903,7 @@ class TestSOLRRequest(unittest.TestCase):
         mock_requests_post.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json'}, headers={'Content-type': 'text/xml'}, data=mydata)
         self.assertEqual(solr_response, SOLR_RESPONSE)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_requests_data_mimetype(self, mock_requests_post):
         SOLR_RESPONSE = {'responseHeader': {'status': 0, 'QTime': 5}, 'foo': 'bar'}
         response = mock.Mock()
@@ -740,14 +918,14 @@ class TestSOLRRequest(unittest.TestCase):
         self.assertEqual(solr_response, SOLR_RESPONSE)
 
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_requests_NetworkError(self, mock_requests_post):
         mock_requests_post.side_effect = requests.ConnectionError
         mydata = mock.Mock()
         self.assertRaises(solrcl.SOLRNetworkError, self.solr.request, 'foo/bar', data=mydata)
         mock_requests_post.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json'}, headers={'Content-type': 'text/xml'}, data=mydata)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_requests_SOLRResponseError(self, mock_requests_post):
         response = mock.Mock()
         response.headers = {'content-type': 'text/html'}
@@ -761,7 +939,7 @@ class TestSOLRRequest(unittest.TestCase):
         self.assertRaises(solrcl.SOLRResponseError, self.solr.request, 'foo/bar', data=mydata)
         mock_requests_post.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json'}, headers={'Content-type': 'text/xml'}, data=mydata)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_requests_SOLRResponseFormatError(self, mock_requests_post):
         response = mock.Mock()
         response.headers = {'content-type': 'application/json'}
@@ -774,6 +952,21 @@ class TestSOLRRequest(unittest.TestCase):
         self.assertRaises(solrcl.SOLRResponseFormatError, self.solr.request, 'foo/bar', data=mydata)
         mock_requests_post.assert_called_with('http://localhost:8983/solr/foo/bar', params={'wt': 'json'}, headers={'Content-type': 'text/xml'}, data=mydata)
 
+    def test_session_per_thread(self):
+        sessions = []
+        t = threading.Thread(target=lambda: sessions.append(self.solr.session))
+        t.start()
+        t.join()
+        #Same session in the same thread, different sessions in different threads
+        self.assertIs(self.solr.session, self.solr.session)
+        self.assertIsNot(self.solr.session, sessions[0])
+        #All sessions share the same connection pool
+        self.assertIs(self.solr.session.get_adapter('http://localhost:8983/'), sessions[0].get_adapter('http://localhost:8983/'))
+
+    def test_session_no_keep_alive(self):
+        solr = solrcl.SOLRRequest(domain='localhost', port=8983, keep_alive=False)
+        self.assertEqual(solr.session.headers['Connection'], 'close')
+
 
 TEST_ADMIN_INFO_SYSTEM_OK = {'responseHeader': {'status': 0, 'QTime': 5}, 'lucene': {'solr-spec-version': '4.8.0', 'lucene-spec-version': '4.8.0'}}
 TEST_ADMIN_INFO_SYSTEM_ERROR = {'responseHeader': {'status': 0, 'QTime': 5}, 'foo': 'bar'}
@@ -810,7 +1003,8 @@ TEST_ADMIN_LUKE_OK = {
         'fields': {
             'mytestfield': {'type': 'mytesttype', 'flags': 'ITS-------------', 'copySources': []},
             'mytestfieldmulti': {'type': 'mytesttype2', 'flags': 'I-S-M---OF-----l', 'copySources': []},
-            'mytestfieldcopy': {'type': 'mytesttype', 'flags': 'IT--------------', 'copySources': ['mytestfield']}
+            'mytestfieldcopy': {'type': 'mytesttype', 'flags': 'IT--------------', 'copySources': ['mytestfield']},
+            'mytestfielddv': {'type': 'mytesttype', 'flags': 'I-SD------------', 'copySources': []}
         },
         'dynamicFields': {
             'mydynamicfield_*': {'type': 'mytesttype', 'flags': 'ITS-------------', 'copySources': []}
@@ -862,11 +1056,13 @@ class TestSOLRCore(unittest.TestCase):
         st.side_effect = mock_solrtype_init
 
     def _mock_SOLRField(self, sf):
-        def mock_solrfield_init(name, type, multi=False, copySources=None):
+        def mock_solrfield_init(name, type, multi=False, copySources=None, docValues=False, stored=True):
             sfi = mock.Mock()
             sfi.name = name
             sfi.type = type
             sfi.multi = multi
+            sfi.docValues = docValues
+            sfi.stored = stored
             if copySources is None:
                 sfi.copySources = []
             else:
@@ -895,11 +1091,15 @@ class TestSOLRCore(unittest.TestCase):
         self.assertEqual(solr.fields['mytestfieldmulti'].type, solr.types['mytesttype2'])
         self.assertEqual(solr.fields['mytestfieldmulti'].multi, True)
         self.assertEqual(solr.fields['mytestfieldmulti'].copySources, [])
+        self.assertEqual(solr.fields['mytestfieldmulti'].docValues, False)
+        self.assertEqual(solr.fields['mytestfielddv'].docValues, True)
 
         self.assertEqual(solr.fields['mytestfieldcopy'].name, 'mytestfieldcopy')
         self.assertEqual(solr.fields['mytestfieldcopy'].type, solr.types['mytesttype'])
         self.assertEqual(solr.fields['mytestfieldcopy'].multi, False)
         self.assertEqual(solr.fields['mytestfieldcopy'].copySources, [solr.fields['mytestfield']])
+        self.assertEqual(solr.fields['mytestfieldcopy'].stored, False)
+        self.assertEqual(solr.fields['mytestfield'].stored, True)
 
         self.assertEqual(solr.dynamicFields['mydynamicfield_*'].name, 'mydynamicfield_*')
         self.assertEqual(solr.dynamicFields['mydynamicfield_*'].type, solr.types['mytesttype'])
@@ -915,6 +1115,7 @@ class TestSOLRCore(unittest.TestCase):
         self.assertEqual(solr.fields['_root_'].type, solr.types['mytesttype'])
         self.assertEqual(solr.fields['_root_'].multi, False)
         self.assertEqual(solr.fields['_root_'].copySources, [])
+        self.assertEqual(solr.fields['_root_'].stored, True)
 
     def test_init_with_blockjoin_noroot(self, mock_solrrequest, mock_solrtype, mock_solrfield):
         self._mock_SOLRRequest(mock_solrrequest, TEST_ADMIN_LUKE_OK, TEST_CORE_ADMIN_SYSTEM_OK)
@@ -941,6 +1142,1173 @@ class TestSOLRCore(unittest.TestCase):
         self.assertRaises(solrcl.SOLRResponseError, solrcl.SOLRCore, 'nonexistingcore')
 
 
+class TestSOLRCoreMethods(unittest.TestCase):
+    def setUp(self):
+        #Builds a SOLRCore without connecting to SOLR
+        solr = solrcl.SOLRCore.__new__(solrcl.SOLRCore)
+        solr.core = 'testcore'
+        solr.domain = 'localhost'
+        solr.port = 8983
+        solr._setLogger()
+        solr.id_field = 'myid'
+        solr.blockjoin_condition = None
+        solr.cache = solrcl.CacheManager()
+        solr.result_cache = None
+        solr._pinned_stores = None
+        solr.prefetch_store = 'set'
+        solr.select = mock.Mock()
+        self.solr = solr
+
+    def _mock_cursor_select(self, ids):
+        #Simulates cursorMark paging over ids (cursor mark is the last id returned)
+        def mocked_select(query):
+            if query['cursorMark'] == '*':
+                remaining = ids
+            else:
+                remaining = [x for x in ids if x > query['cursorMark']]
+            page = remaining[:query['rows']]
+            next_cursor_mark = page[-1] if page else query['cursorMark']
+            return {'response': {'numFound': len(ids), 'docs': [{'myid': x} for x in page]}, 'nextCursorMark': next_cursor_mark}
+
+        self.solr.select.side_effect = mocked_select
+
+    def test_cursorSort(self):
+        self.assertEqual(self.solr._cursorSort(), 'myid asc')
+        self.assertEqual(self.solr._cursorSort('foo desc'), 'foo desc,myid asc')
+        self.assertEqual(self.solr._cursorSort('foo desc, myid desc'), 'foo desc, myid desc')
+
+    def test_selectAllIter_cursor(self):
+        ids = ['%03d' % x for x in range(25)]
+        self._mock_cursor_select(ids)
+        self.assertEqual(list(self.solr.selectAllIter('*:*', blocksize=10, cursor=True)), [(x,) for x in ids])
+        #3 full or partial pages plus the last empty one
+        self.assertEqual(self.solr.select.call_count, 4)
+        for call in self.solr.select.call_args_list:
+            self.assertFalse('start' in call[0][0])
+            self.assertEqual(call[0][0]['sort'], 'myid asc')
+
+    def test_selectAllIter_cursor_limit(self):
+        ids = ['%03d' % x for x in range(25)]
+        self._mock_cursor_select(ids)
+        self.assertEqual(list(self.solr.listFieldsIter(limit=12, blocksize=10, cursor=True)), [(x,) for x in ids[:12]])
+        self.assertEqual(self.solr.select.call_count, 2)
+
+    def test_partitionFilters(self):
+        self.assertEqual(self.solr._partitionFilters(3), [u'{!hash workers=3 worker=0 partitionKeys=myid}', u'{!hash workers=3 worker=1 partitionKeys=myid}', u'{!hash workers=3 worker=2 partitionKeys=myid}'])
+        self.assertEqual(self.solr._partitionFilters(1, field='other'), [u'{!hash workers=1 worker=0 partitionKeys=other}'])
+        #No sampling requests
+        self.assertFalse(self.solr.select.called)
+
+    def test_selectAllIter_partitions(self):
+        ids = ['%03d' % x for x in range(100)]
+        def mocked_select(query):
+            self.assertFalse(query.has_key('start'))
+            #Cursor request on a hash partition
+            params = dict(x.split('=') for x in query['fq'][len('{!hash '):-1].split())
+            partition = [x for x in ids if zlib.crc32(x) % int(params['workers']) == int(params['worker'])]
+            if query['cursorMark'] != '*':
+                partition = [x for x in partition if x > query['cursorMark']]
+            page = partition[:query['rows']]
+            return {'response': {'numFound': len(partition), 'docs': [{'myid': x} for x in page]}, 'nextCursorMark': page[-1] if page else query['cursorMark']}
+        self.solr.select.side_effect = mocked_select
+
+        result = list(self.solr.selectAllIter('*:*', blocksize=10, parallel=3, partitions=4))
+        self.assertEqual(sorted(result), [(x,) for x in ids])
+
+    def test_exportIter(self):
+        self.solr.fields = {'myid': mock.Mock(docValues=True), 'myvalue': mock.Mock(docValues=True)}
+        self.solr.streamRequest = mock.Mock()
+        response = u'{"responseHeader": {"status": 0}, "response": {"numFound": 3, "docs": [{"myid": "a", "myvalue": 1}, {"myid": "b"}, {"myid": "c", "myvalue": 3}]}}'
+        #Splits response in small chunks to check incremental parsing
+        self.solr.streamRequest.return_value = (response[i:i+7] for i in range(0, len(response), 7))
+        self.assertEqual(list(self.solr.exportIter('*:*', ('myid', 'myvalue'))), [('a', 1), ('b', None), ('c', 3)])
+        self.solr.streamRequest.assert_called_once_with('export', parameters={'q': '*:*', 'fl': 'myid,myvalue', 'sort': 'myid asc'})
+        self.assertFalse(self.solr.select.called)
+
+    def test_exportIter_error(self):
+        self.solr.fields = {'myid': mock.Mock(docValues=True)}
+        self.solr.streamRequest = mock.Mock()
+        self.solr.streamRequest.return_value = (x for x in [u'{"responseHeader": {"status": 400}, "response": {"numFound": 0, "docs": [{"EXCEPTION": "bad"}]}}'])
+        self.assertRaises(solrcl.SOLRResponseError, list, self.solr.exportIter('*:*'))
+
+    def test_exportIter_fallback(self):
+        self.solr.fields = {'myid': mock.Mock(docValues=True), 'myvalue': mock.Mock(docValues=False)}
+        self.solr.streamRequest = mock.Mock()
+        self.solr.select.return_value = {'response': {'numFound': 1, 'docs': [{'myid': 'a', 'myvalue': 1}]}}
+        self.assertEqual(list(self.solr.listFieldsIter(('myid', 'myvalue'), export=True)), [('a', 1)])
+        self.assertFalse(self.solr.streamRequest.called)
+
+        #Paging options are passed to the fallback
+        self.solr.select.reset_mock()
+        self.solr.select.return_value = {'response': {'numFound': 1, 'docs': [{'myid': 'a', 'myvalue': 1}]}, 'nextCursorMark': '*'}
+        self.assertEqual(list(self.solr.listFieldsIter(('myid', 'myvalue'), export=True, cursor=True)), [('a', 1)])
+        self.assertEqual(self.solr.select.call_args[0][0]['cursorMark'], '*')
+
+    def test_listFieldsIter_export_columnar(self):
+        self.solr.fields = {'myid': mock.Mock(docValues=True, multi=False)}
+        self.solr.fields['myid'].type.className = 'org.apache.solr.schema.StrField'
+        self.solr.streamRequest = mock.Mock()
+        self.solr.select.return_value = {'response': {'numFound': 1, 'docs': [{'myid': 'a'}]}}
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            batches = list(self.solr.listFieldsIter(('myid',), export=True, columnar=True))
+            self.assertEqual(len(w), 1)
+        self.assertEqual(list(batches[0]['myid']), ['a'])
+        self.assertFalse(self.solr.streamRequest.called)
+
+    def _mock_offset_select(self, ids):
+        def mocked_select(query):
+            #Later pages answer first to check that order is preserved
+            time.sleep(0.001 * (len(ids) - query['start']) / query['rows'])
+            return {'response': {'numFound': len(ids), 'docs': [{'myid': x} for x in ids[query['start']:query['start'] + query['rows']]]}}
+        self.solr.select.side_effect = mocked_select
+
+    def test_selectAllIter_sorted_parallel(self):
+        ids = ['%03d' % x for x in range(95)]
+        self._mock_offset_select(ids)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            result = list(self.solr.selectAllIter('*:*', blocksize=10, start_blocksize=5, parallel=4, sort='myid asc', window=3))
+            self.assertEqual(len(w), 0)
+        self.assertEqual(result, [(x,) for x in ids])
+        self.assertEqual(self.solr.select.call_count, 10)
+
+    def test_selectAllIter_unsorted_parallel(self):
+        ids = ['%03d' % x for x in range(95)]
+        self._mock_offset_select(ids)
+        result = list(self.solr.selectAllIter('*:*', blocksize=10, start_blocksize=5, parallel=4))
+        self.assertEqual(sorted(result), [(x,) for x in ids])
+
+    def test_selectAllIter_limit(self):
+        ids = ['%03d' % x for x in range(1000)]
+        self._mock_offset_select(ids)
+        self.assertEqual(len(list(self.solr.listFieldsIter(limit=10))), 10)
+        self.assertEqual(self.solr.select.call_count, 1)
+
+        self.solr.select.reset_mock()
+        self.assertEqual(len(list(self.solr.selectAllIter('*:*', limit=250, blocksize=100, start_blocksize=5))), 250)
+        #First page and pages starting at 5, 105, 205
+        self.assertEqual(self.solr.select.call_count, 4)
+
+    def test_selectAllIter_close(self):
+        ids = ['%03d' % x for x in range(1000)]
+        self._mock_offset_select(ids)
+        it = self.solr.selectAllIter('*:*', blocksize=10, start_blocksize=10, parallel=2, window=3)
+        for _ in range(15):
+            it.next()
+        it.close()
+        #First page, the page being consumed and at most window prefetched pages
+        self.assertTrue(self.solr.select.call_count <= 5)
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_selectAllIter_columnar(self):
+        def field(className, multi=False):
+            return mock.Mock(type=mock.Mock(className=className), multi=multi)
+        self.solr.fields = {
+            'myid': field('org.apache.solr.schema.StrField'),
+            'myint': field('org.apache.solr.schema.TrieIntField'),
+            'mylong': field('org.apache.solr.schema.TrieLongField'),
+            'myfloat': field('org.apache.solr.schema.TrieFloatField'),
+            'mydate': field('org.apache.solr.schema.TrieDateField'),
+            'mymulti': field('org.apache.solr.schema.TrieIntField', multi=True),
+        }
+        docs = [
+            {'myid': u'a', 'myint': 1, 'mylong': 10, 'myfloat': 0.5, 'mydate': u'2014-01-02T03:04:05Z', 'mymulti': [1, 2]},
+            {'myid': u'b', 'myint': 2, 'myfloat': None, 'mymulti': [3, 4]},
+            {'myid': u'c', 'myint': 3, 'mylong': 30, 'myfloat': 1.5, 'mydate': u'1850-01-01T00:00:00Z', 'mymulti': [5, 6]},
+        ]
+        self.solr.select.return_value = {'response': {'numFound': 3, 'docs': docs}}
+        fields = ('myid', 'myint', 'mylong', 'myfloat', 'mydate', 'mymulti')
+        batches = list(self.solr.listFieldsIter(fields, columnar=True, limit=2))
+        self.assertEqual(len(batches), 1)
+        columns = batches[0]
+        self.assertEqual(columns['myint'].dtype, numpy.int32)
+        self.assertEqual(list(columns['myint']), [1, 2])
+        self.assertEqual(columns['myid'].dtype, object)
+        #Missing value in integer field: object array
+        self.assertEqual(columns['mylong'].dtype, object)
+        self.assertEqual(list(columns['mylong']), [10, None])
+        self.assertEqual(columns['myfloat'].dtype, numpy.float64)
+        self.assertTrue(numpy.isnan(columns['myfloat'][1]))
+        self.assertEqual(columns['mydate'][0], numpy.datetime64('2014-01-02T03:04:05'))
+        self.assertTrue(numpy.isnat(columns['mydate'][1]))
+        self.assertEqual(columns['mymulti'].shape, (2,))
+        self.assertEqual(columns['mymulti'][1], [3, 4])
+
+    def _mock_doc_fields(self, *fieldnames):
+        solrtype = mock.Mock()
+        solrtype.deserialize.side_effect = lambda x: x
+        solrtype.deserializeList.side_effect = lambda x: list(x)
+        solrtype.serialize.side_effect = lambda x: unicode(x)
+        self.solr.fields = dict((f, mock.Mock(type=solrtype, multi=False)) for f in fieldnames)
+
+    def test_select_post_long_query(self):
+        self.solr.request = mock.Mock(return_value={'response': {'numFound': 0, 'docs': []}})
+        #select is mocked in setUp
+        solrcl.SOLRCore.select(self.solr, {'q': u'id:"\xe0"', 'rows': 1})
+        self.solr.request.assert_called_with('select', parameters={'q': u'id:"\xe0"', 'rows': 1})
+
+        ids = [u'%08d-0000-0000-0000-000000000000\xe0' % x for x in range(500)]
+        query = {'q': self.solr._termsQuery('myid', ids), 'fq': ['a', 'b'], 'rows': 500}
+        solrcl.SOLRCore.select(self.solr, query)
+        (args, kwargs) = self.solr.request.call_args
+        self.assertEqual(kwargs['parameters'], {'wt': 'json'})
+        self.assertEqual(kwargs['dataMIMEType'], 'application/x-www-form-urlencoded; charset=UTF-8')
+        body = urlparse.parse_qs(kwargs['data'])
+        self.assertEqual(body['q'][0].decode('utf8'), query['q'])
+        self.assertEqual((body['fq'], body['rows']), (['a', 'b'], ['500']))
+
+    def test_getDocs(self):
+        self._mock_doc_fields('myid', 'myvalue')
+        index = dict((u'%03d' % x, {'myid': u'%03d' % x, 'myvalue': u'v%d' % x, '_version_': 1}) for x in range(10))
+        def mocked_select(query):
+            ids = query['q'][len('{!terms f=myid}'):].split(',')
+            docs = [index[x] for x in ids if index.has_key(x)]
+            return {'response': {'numFound': len(docs), 'docs': docs}}
+        self.solr.select.side_effect = mocked_select
+
+        (docs, missing) = self.solr.getDocs([u'001', u'002', u'xxx', u'005', u'001', u'yyy'], chunksize=2, parallel=2)
+        self.assertEqual(sorted(docs.keys()), [u'001', u'002', u'005'])
+        self.assertEqual(docs[u'005'].getField('myvalue'), u'v5')
+        self.assertRaises(KeyError, docs[u'005'].getField, '_version_')
+        self.assertEqual(sorted(missing), [u'xxx', u'yyy'])
+        self.assertEqual(self.solr.select.call_count, 3)
+
+    def test_getDocs_children(self):
+        self._mock_doc_fields('myid', '_root_')
+        self.solr.blockjoin_condition = '_is_parent:true'
+        def mocked_select(query):
+            if query.has_key('cursorMark'):
+                self.assertEqual(query['q'], '{!terms f=_root_}a')
+                self.assertEqual(query['fq'], '-(_is_parent:true)')
+                docs = [{'myid': u'a.1', '_root_': u'a'}, {'myid': u'a.2', '_root_': u'a'}] if query['cursorMark'] == '*' else []
+                return {'response': {'numFound': 2, 'docs': docs}, 'nextCursorMark': 'a.2'}
+            return {'response': {'numFound': 1, 'docs': [{'myid': u'a', '_root_': u'a'}]}}
+        self.solr.select.side_effect = mocked_select
+
+        (docs, missing) = self.solr.getDocs([u'a'])
+        self.assertEqual(missing, [])
+        self.assertEqual(sorted(d.id for d in docs[u'a'].getChildDocs()), [u'a.1', u'a.2'])
+        self.assertRaises(KeyError, docs[u'a'].getChildDocs()[0].getField, '_root_')
+
+    def test_getDocs_children_root_not_stored(self):
+        self._mock_doc_fields('myid', '_root_')
+        self.solr.fields['_root_'].stored = False
+        self.solr.blockjoin_condition = '_is_parent:true'
+        index = {u'a': {'myid': u'a'}, u'a.1': {'myid': u'a.1'}, u'a.2': {'myid': u'a.2'}}
+        def mocked_select(query):
+            self.assertFalse(query['q'].startswith('{!terms f=_root_}'))
+            if query['q'].startswith('{!child'):
+                docs = [{'myid': u'a.1'}, {'myid': u'a.2'}] if query.get('cursorMark', '*') == '*' else []
+                return {'response': {'numFound': 2, 'docs': docs}, 'nextCursorMark': 'a.2'}
+            ids = query['q'][len('{!terms f=myid}'):].split(',')
+            docs = [index[x] for x in ids if index.has_key(x)]
+            return {'response': {'numFound': len(docs), 'docs': docs}}
+        self.solr.select.side_effect = mocked_select
+
+        (docs, missing) = self.solr.getDocs([u'a'])
+        self.assertEqual(missing, [])
+        self.assertEqual(sorted(d.id for d in docs[u'a'].getChildDocs()), [u'a.1', u'a.2'])
+
+    def test_termsQuery(self):
+        self.assertEqual(self.solr._termsQuery('myid', [u'a', 1]), u'{!terms f=myid}a,1')
+        self.assertEqual(self.solr._termsQuery('myid', [u'a,b', u'c"']), u'{!terms f=myid separator="|"}a,b|c"')
+        self.assertEqual(self.solr._termsQuery('myid', [u'a,|;~^b', u'c']), u'{!terms f=myid separator="\ue000"}a,|;~^b\ue000c')
+        #No boolean clauses for long lists
+        self.assertTrue(self.solr._termsQuery('myid', [u'%d,' % x for x in range(5000)]).startswith(u'{!terms f=myid separator="|"}'))
+
+    def test_getDoc_child_transformer(self):
+        self._mock_doc_fields('myid', 'myvalue')
+        self.solr.blockjoin_condition = 'type:"parent"'
+        self.solr.select.return_value = {'response': {'numFound': 1, 'docs': [{'myid': u'a', 'myvalue': u'x', '_childDocuments_': [{'myid': u'a.1', 'myvalue': u'y'}, {'myid': u'a.2'}]}]}}
+
+        doc = self.solr.getDoc(u'a', child_transformer=True)
+        self.solr.select.assert_called_once_with({'q': 'myid:"a"', 'rows': '1', 'fl': u'*,[child parentFilter="type:\\"parent\\"" limit=-1]'})
+        self.assertEqual(doc.getField('myvalue'), u'x')
+        self.assertEqual(sorted(d.id for d in doc.getChildDocs()), [u'a.1', u'a.2'])
+        self.assertEqual(doc.getChildDocs()[0].getField('myvalue'), u'y')
+
+    def test_mergeBlockJoinDocs(self):
+        self._mock_doc_fields('myid', 'myvalue', '_version_')
+        self.solr._deleteByParentIds = mock.Mock()
+
+        def doc(solrid, version=None, value=None):
+            d = solrcl.SOLRDocument(solrid, self.solr)
+            if not version is None:
+                d.setField('_version_', version)
+            if not value is None:
+                d.setField('myvalue', value)
+            return d
+
+        current = {u'a': doc(u'a', 5, u'old'), u'b': doc(u'b', 5), u'c': doc(u'c', 5)}
+        current[u'a'].addChild(doc(u'a.1'))
+        self.solr.cache.set('ids', set(), ids=True)
+        self.solr.getDocs = mock.Mock(return_value=(current, [u'd', u'e']))
+        newdocs = [
+            doc(u'a', value=u'new'),
+            #version < 0 and document exists
+            doc(u'b', -1),
+            #version > 1 not matching
+            doc(u'c', 7),
+            #version > 0 and document does not exist
+            doc(u'd', 1),
+            doc(u'e', value=u'new'),
+        ]
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            xmldocs = self.solr._mergeBlockJoinDocs(newdocs)
+            self.assertEqual(len(w), 3)
+
+        #One item for each new document, None if it can't be loaded
+        self.assertEqual([x is None for x in xmldocs], [False, True, True, True, False])
+        self.assertTrue('old' not in xmldocs[0] and 'new' in xmldocs[0] and '_version_' not in xmldocs[0])
+        self.assertTrue('update=' not in xmldocs[0])
+        #Only one delete request for the whole chunk
+        self.solr._deleteByParentIds.assert_called_once_with([u'a'])
+        #Deleted child documents are invalidated in cache
+        self.assertTrue(self.solr.cache.isStale('ids', u'a.1'))
+
+    def test_loadDocs_batches(self):
+        self._mock_doc_fields('myid')
+        self.solr.update = mock.Mock(return_value={'responseHeader': {'status': 0, 'QTime': 1}})
+        docs = [solrcl.SOLRDocument(u'%03d' % x, self.solr) for x in range(25)]
+        stats = self.solr.loadDocs(iter(docs), parallel=2, batch_size=10, commitWithin=1000)
+        self.assertEqual(self.solr.update.call_count, 3)
+        self.assertEqual(stats.docs, 25)
+        for call in self.solr.update.call_args_list:
+            self.assertEqual(call[1]['parameters'], {'commitWithin': 1000})
+
+    def test_loadDocs_bisect(self):
+        self._mock_doc_fields('myid')
+        def mocked_update(parameters={}, data=None, dataMIMEType=None):
+            if any('bad' in x for x in data):
+                raise solrcl.SOLRBadRequestError("Invalid document", httpStatus=400)
+            return {'responseHeader': {'status': 0, 'QTime': 1}}
+        self.solr.update = mock.Mock(side_effect=mocked_update)
+        docs = [solrcl.SOLRDocument(u'bad' if x in (3, 17) else u'%03d' % x, self.solr) for x in range(25)]
+        failed = []
+        stats = self.solr.loadDocs(iter(docs), parallel=2, batch_size=10, bisect=True, on_error=lambda xmldoc, exc_info: failed.append(xmldoc))
+        self.assertEqual(len(failed), 2)
+        self.assertTrue(all('bad' in x for x in failed))
+        self.assertEqual(stats.docs, 23)
+        self.assertEqual(stats.failed, 2)
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.solr.loadDocs(iter(docs), bisect=True)
+            self.assertEqual(len(w), 2)
+            self.assertEqual(w[0].category, solrcl.SOLRDocumentWarning)
+
+    def test_loadDocs_bisect_server_error(self):
+        self._mock_doc_fields('myid')
+        self.solr.update = mock.Mock(side_effect=solrcl.SOLRResponseError("Service Unavailable", httpStatus=503))
+        docs = [solrcl.SOLRDocument(u'%03d' % x, self.solr) for x in range(25)]
+        failed = []
+        (fd, path) = tempfile.mkstemp(prefix='solrcl_journal_')
+        os.close(fd)
+        try:
+            journal = solrcl.LoadJournal(path)
+            #Server errors are not bisected: the batch fails
+            self.assertRaises(solrcl.ThreadError, self.solr.loadDocs, journal.resume(docs), batch_size=10, bisect=True, journal=journal, on_error=lambda xmldoc, exc_info: failed.append(xmldoc))
+            journal.close()
+            self.assertEqual(self.solr.update.call_count, 1)
+            self.assertEqual(failed, [])
+            #No document is confirmed in journal
+            self.assertEqual(solrcl.LoadJournal(path).checkpoint, journal.checkpoint)
+            self.assertTrue(solrcl.LoadJournal(path).checkpoint < 0)
+        finally:
+            os.remove(path)
+
+    def test_loadDocs_thread_error(self):
+        self._mock_doc_fields('myid')
+        def mocked_update(parameters={}, data=None, dataMIMEType=None):
+            data.next()
+            raise solrcl.SOLRNetworkError("Connection refused")
+        self.solr.update = mock.Mock(side_effect=mocked_update)
+        docs = (solrcl.SOLRDocument(u'%03d' % x, self.solr) for x in range(100))
+        #Producer must not wait forever on the bounded queue
+        self.assertRaises(solrcl.ThreadError, self.solr.loadDocs, docs, queue_size=5)
+
+    def test_loadDocs_processes(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.solr.fields = {'myid': solrcl.SOLRField('myid', solrcl.SOLRType('string', 'org.apache.solr.schema.StrField')), 'myvalue': solrcl.SOLRField('myvalue', solrcl.SOLRType('int', 'org.apache.solr.schema.TrieIntField'), multi=True)}
+        sent = []
+        lock = threading.Lock()
+        def mocked_update(parameters={}, data=None, dataMIMEType=None):
+            with lock:
+                sent.extend(x for x in data if x.startswith('<doc>'))
+            return {'responseHeader': {'status': 0, 'QTime': 1}}
+        self.solr.update = mock.Mock(side_effect=mocked_update)
+        docs = []
+        for x in range(250):
+            doc = solrcl.SOLRDocument(u'%03d' % x, self.solr)
+            doc.setField('myvalue', [x, x + 1])
+            docs.append(doc)
+
+        self.solr.loadDocs(iter(docs), processes=2)
+        self.assertEqual(sent, [doc.toXML() for doc in docs])
+
+        del sent[:]
+        stats = self.solr.loadDocs(iter(docs), parallel=2, batch_size=50, processes=2, ordered=False)
+        self.assertEqual(stats.docs, 250)
+        self.assertEqual(sorted(sent), [doc.toXML() for doc in docs])
+
+    def test_isBlockJoinChildDoc_prefetch_stores(self):
+        self.solr.blockjoin_condition = 'type:parent'
+        ids = sorted(u'%05d.1' % x for x in range(2500))
+        exact_checks = []
+        def mocked_select(query):
+            self.assertTrue(query['q'].startswith('-(type:parent) AND _root_:[* TO *]'))
+            if ' AND myid:' in query['q']:
+                #Exact check of a single id
+                solrid = query['q'].split(' AND myid:')[-1].strip('"')
+                exact_checks.append(solrid)
+                return self._mock_cursor_select_page([x for x in ids if x == solrid], query)
+            return self._mock_cursor_select_page(ids, query)
+        self.solr.select.side_effect = mocked_select
+
+        for store in ('set', 'sorted', 'bloom'):
+            self.solr.clearCache()
+            self.solr.prefetch_store = store
+            self.assertTrue(self.solr.isBlockJoinChildDoc(u'00010.1', prefetch=True))
+            self.assertFalse(self.solr.isBlockJoinChildDoc(u'00010', prefetch=True))
+            self.assertTrue(self.solr.isBlockJoinChildDoc(u'02499.1', prefetch=True))
+            self.assertEqual(len(self.solr.cache['_listBlockJoinChildIdsIter_ids_cache']), 2500)
+        #Only bloom store positive hits are checked exactly
+        self.assertEqual(exact_checks[:2], [u'00010.1', u'02499.1'])
+
+        self.solr.prefetch_store = 'nonexistent'
+        self.solr.clearCache()
+        self.assertRaises(ValueError, self.solr.isBlockJoinChildDoc, u'a', prefetch=True)
+
+    def _mock_cursor_select_page(self, ids, query):
+        if query['cursorMark'] == '*':
+            remaining = ids
+        else:
+            remaining = [x for x in ids if x > query['cursorMark']]
+        page = remaining[:query['rows']]
+        next_cursor_mark = page[-1] if page else query['cursorMark']
+        return {'response': {'numFound': len(ids), 'docs': [{'myid': x} for x in page]}, 'nextCursorMark': next_cursor_mark}
+
+    def _mock_update_data(self):
+        sent = []
+        lock = threading.Lock()
+        def mocked_update(parameters={}, data=None, dataMIMEType=None):
+            with lock:
+                sent.append(''.join(data))
+            return {'responseHeader': {'status': 0, 'QTime': 1}}
+        self.solr.update = mock.Mock(side_effect=mocked_update)
+        return sent
+
+    def test_deleteByIds(self):
+        sent = self._mock_update_data()
+        self.solr.deleteByIds([u'a', u'b<&>:"c', 3], commitWithin=1000)
+        self.assertEqual(sent, ['<delete><id>a</id><id>b&lt;&amp;&gt;:"c</id><id>3</id></delete>'])
+        self.assertEqual(self.solr.update.call_args[1]['parameters'], {'commitWithin': 1000})
+
+        del sent[:]
+        self.solr.deleteByIds([u'a', u'b"\xe0'], wire_format='json')
+        self.assertEqual(json.loads(sent[0]), {'delete': [u'a', u'b"\xe0']})
+        self.assertEqual(self.solr.update.call_args[1]['dataMIMEType'], 'application/json; charset=utf-8')
+
+    def test_deleteByIds_chunks(self):
+        sent = self._mock_update_data()
+        stats = self.solr.deleteByIds((u'%03d' % x for x in range(25)), chunksize=10, parallel=3)
+        self.assertEqual(stats.docs, 25)
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(sorted(x.count('<id>') for x in sent), [5, 10, 10])
+
+    def test_deleteByParentIds(self):
+        sent = self._mock_update_data()
+        self.solr.blockjoin_condition = 'type:parent'
+        stats = self.solr.deleteByParentIds((u'%03d' % x for x in range(5)), chunksize=3)
+        self.assertEqual(stats.docs, 5)
+        self.assertEqual(sent[0], '<delete><query>{!terms f=_root_}000,001,002</query><query>{!terms f=myid}000,001,002</query></delete>')
+        self.assertEqual(len(sent), 2)
+
+        del sent[:]
+        self.solr.deleteByParentIds([u'a&b'])
+        self.assertEqual(sent, ['<delete><query>{!terms f=_root_}a&amp;b</query><query>{!terms f=myid}a&amp;b</query></delete>'])
+
+        del sent[:]
+        self.solr.blockjoin_condition = None
+        self.solr.deleteByParentIds([u'a'])
+        self.assertEqual(sent, ['<delete><id>a</id></delete>'])
+
+    def test_delete_clearCache(self):
+        self._mock_update_data()
+        for (method, kwargs) in ((self.solr.deleteByIds, {}), (self.solr.deleteByIds, {'chunksize': 10}), (self.solr.deleteByParentIds, {}), (self.solr.deleteByParentIds, {'chunksize': 10})):
+            self.solr.cache.set('ids', set(), ids=True)
+            method([u'a'], **kwargs)
+            self.assertEqual(len(self.solr.cache), 0)
+
+    def test_loadDocs_adaptive(self):
+        self._mock_doc_fields('myid')
+        self.solr.update = mock.Mock(side_effect=[solrcl.SOLRNetworkError("Timeout")] + [{'responseHeader': {'status': 0, 'QTime': 1}}] * 3)
+        docs = [solrcl.SOLRDocument(u'%03d' % x, self.solr) for x in range(25)]
+        stats = self.solr.loadDocs(iter(docs), parallel=4, batch_size=10, adaptive=True)
+        self.assertEqual(stats.docs, 25)
+        self.assertEqual(stats.retries, 1)
+        self.assertEqual(stats.concurrency[0][1], 1)
+
+        #Without adaptive network errors are not retried
+        self.solr.update = mock.Mock(side_effect=solrcl.SOLRNetworkError("Timeout"))
+        self.assertRaises(solrcl.ThreadError, self.solr.loadDocs, iter(docs), batch_size=10)
+        self.assertEqual(self.solr.update.call_count, 1)
+
+    def test_loadDocs_json(self):
+        self._mock_doc_fields('myid')
+        sent = []
+        def mocked_update(parameters={}, data=None, dataMIMEType=None):
+            sent.append((''.join(data), dataMIMEType))
+            return {'responseHeader': {'status': 0, 'QTime': 1}}
+        self.solr.update = mock.Mock(side_effect=mocked_update)
+        docs = [solrcl.SOLRDocument(u'%03d' % x, self.solr) for x in range(25)]
+        self.solr.loadDocs(iter(docs), batch_size=10, wire_format='json')
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(sent[0][1], 'application/json; charset=utf-8')
+        self.assertEqual([x['myid'] for (data, _) in sent for x in json.loads(data)], [u'%03d' % x for x in range(25)])
+
+        #Streaming mode
+        del sent[:]
+        self.solr.loadDocs(iter(docs), wire_format='json')
+        self.assertEqual(len(json.loads(sent[0][0])), 25)
+        self.assertRaises(ValueError, self.solr.loadDocs, iter(docs), wire_format='csv')
+
+    def test_select_result_cache(self):
+        self.solr.result_cache = solrcl.ResultCache(check_interval=60)
+        self.solr.request = mock.Mock(side_effect=lambda resource, parameters={}, **kwargs: {'response': {'numFound': 1, 'docs': [{'q': parameters['q']}]}})
+        version = [(1, 1, 1)]
+        self.solr.getIndexVersion = mock.Mock(side_effect=lambda: version[0])
+        #select is mocked in setUp
+        select = lambda query: solrcl.SOLRCore.select(self.solr, query)
+
+        r1 = select({'q': 'a', 'fq': ['x', 'y'], 'rows': 10})
+        r2 = select({'rows': '10', 'fq': ['y', 'x'], 'q': 'a', 'wt': 'json'})
+        self.assertTrue(r1 is r2)
+        self.assertEqual(self.solr.request.call_count, 1)
+        select({'q': 'b'})
+        self.assertEqual(self.solr.request.call_count, 2)
+        self.assertEqual(len(self.solr.result_cache), 2)
+        self.assertTrue(self.solr.result_cache.nbytes > 0)
+        self.assertAlmostEqual(self.solr.result_cache.hitRatio, 1 / 3.0)
+        #Version checks are rate limited
+        self.assertEqual(self.solr.getIndexVersion.call_count, 1)
+
+        #New index version
+        version[0] = (2, 2, 2)
+        select({'q': 'a', 'fq': ['x', 'y'], 'rows': 10})
+        self.assertEqual(self.solr.request.call_count, 2)
+        self.solr.result_cache.check_interval = 0
+        select({'q': 'a', 'fq': ['x', 'y'], 'rows': 10})
+        self.assertEqual(self.solr.request.call_count, 3)
+        self.assertEqual(self.solr.result_cache.version, (2, 2, 2))
+        self.assertEqual(len(self.solr.result_cache), 1)
+
+    def test_prefetch_over_budget(self):
+        self._mock_doc_fields('myid')
+        self.solr.update = mock.Mock(return_value={'responseHeader': {'status': 0, 'QTime': 1}})
+        self.solr.blockjoin_condition = 'type:parent'
+        self.solr.cache = solrcl.CacheManager(max_bytes=1000)
+        parents = sorted(u'p%04d' % x for x in range(3000))
+        children = sorted(u'c%04d' % x for x in range(3000))
+        scans = []
+        def mocked_select(query):
+            ids = children if query['q'].startswith('-') else parents
+            if ' AND myid:' in query['q']:
+                solrid = query['q'].split(' AND myid:')[-1].strip('"')
+                return self._mock_cursor_select_page([x for x in ids if x == solrid], query)
+            if query['cursorMark'] == '*':
+                scans.append(query['q'])
+            return self._mock_cursor_select_page(ids, query)
+        self.solr.select.side_effect = mocked_select
+
+        #Stores larger than the budget are pinned for the whole load
+        docs = [solrcl.SOLRDocument(u'n%03d' % x, self.solr) for x in range(10)]
+        self.solr.loadDocs(iter(docs), batch_size=10)
+        self.assertEqual(len(scans), 2)
+        self.solr.loadDocs(iter(docs))
+        self.assertEqual(len(scans), 4)
+        self.assertEqual(len(self.solr.cache), 0)
+        self.assertTrue(self.solr._pinned_stores is None)
+
+        #Out of a load they are checked in core without prefetching again
+        self.assertTrue(self.solr.isBlockJoinParentDoc(u'p0001', prefetch=True))
+        self.assertFalse(self.solr.isBlockJoinParentDoc(u'c0001', prefetch=True))
+        self.assertTrue(self.solr.isBlockJoinChildDoc(u'c0001', prefetch=True))
+        self.assertEqual(len(scans), 4)
+
+    def test_loadDocs_same_id_order(self):
+        self._mock_doc_fields('myid', 'myvalue')
+        sent = []
+        def mocked_update(parameters={}, data=None, dataMIMEType=None):
+            sent.append(''.join(data))
+            return {'responseHeader': {'status': 0, 'QTime': 1}}
+        self.solr.update = mock.Mock(side_effect=mocked_update)
+        self.solr._mergeBlockJoinDocs = mock.Mock(side_effect=lambda chunk, **kwargs: chunk)
+        parent = solrcl.SOLRDocument(u'p', self.solr)
+        parent.setField('myvalue', u'first')
+        parent.addChild(solrcl.SOLRDocument(u'p.1', self.solr))
+        update = solrcl.SOLRDocument(u'p', self.solr)
+        update.setField('myvalue', u'second')
+        self.solr.loadDocs(iter([parent, solrcl.SOLRDocument(u'x', self.solr), update]), batch_size=1)
+        #Buffered blockjoin document is sent before the later update of the same id
+        self.assertEqual(['first' in x for x in sent if '>p<' in x], [True, False])
+        self.assertTrue('second' in sent[-1])
+
+    def test_loadDocs_cache_invalidation(self):
+        self._mock_doc_fields('myid')
+        self.solr.update = mock.Mock(return_value={'responseHeader': {'status': 0, 'QTime': 1}})
+        store = solrcl.SortedIdStore()
+        for solrid in (u'000', u'999'):
+            store.add(solrid)
+        self.solr.cache.set('_listBlockJoinChildIdsIter_ids_cache', store, ids=True)
+        self.solr.cache.set('other', 'x')
+        self.assertTrue(self.solr.isBlockJoinChildDoc(u'000', prefetch=True))
+
+        docs = [solrcl.SOLRDocument(u'%03d' % x, self.solr) for x in range(3)]
+        docs[2].addChild(solrcl.SOLRDocument(u'002.1', self.solr))
+        self.solr._mergeBlockJoinDocs = mock.Mock(side_effect=lambda chunk, **kwargs: chunk)
+        self.solr.loadDocs(iter(docs), batch_size=10)
+        #Only ids of loaded documents are invalidated
+        self.assertFalse('other' in self.solr.cache)
+        self.assertTrue(self.solr.cache.isStale('_listBlockJoinChildIdsIter_ids_cache', u'002.1'))
+        self.assertFalse(self.solr.cache.isStale('_listBlockJoinChildIdsIter_ids_cache', u'999'))
+        self.assertTrue(self.solr.isBlockJoinChildDoc(u'999', prefetch=True))
+        #Stale ids are checked in core (no blockjoin condition: no child documents)
+        self.assertFalse(self.solr.isBlockJoinChildDoc(u'000', prefetch=True))
+
+    def test_loadXMLDocs_json(self):
+        self.solr.update = mock.Mock()
+        self.solr._loadXMLDocs(iter(['\n', '{"id":"a"}', '\n', '{"id":"b"}']), wire_format='json')
+        self.assertEqual(''.join(self.solr.update.call_args[1]['data']), '\n[{"id":"a"}\n,{"id":"b"}]')
+        self.solr._loadXMLDocs(iter([]), wire_format='json')
+        self.assertEqual(''.join(self.solr.update.call_args[1]['data']), '[]')
+
+    def test_loadDocs_journal(self):
+        self._mock_doc_fields('myid')
+        sent = []
+        def mocked_update(parameters={}, data=None, dataMIMEType=None):
+            sent.append(''.join(data))
+            if len(sent) == 2:
+                raise solrcl.SOLRNetworkError("Connection refused")
+            return {'responseHeader': {'status': 0, 'QTime': 1}}
+        self.solr.update = mock.Mock(side_effect=mocked_update)
+        docs = [solrcl.SOLRDocument(u'%03d' % x, self.solr) for x in range(25)]
+        (fd, path) = tempfile.mkstemp(prefix='solrcl_journal_')
+        os.close(fd)
+        try:
+            journal = solrcl.LoadJournal(path)
+            self.assertRaises(solrcl.ThreadError, self.solr.loadDocs, journal.resume(docs), batch_size=10, journal=journal)
+            journal.close()
+
+            #Restarted job skips the first (acknowledged) batch
+            journal = solrcl.LoadJournal(path)
+            self.assertEqual(journal.checkpoint, 9)
+            stats = self.solr.loadDocs(journal.resume(docs), batch_size=10, journal=journal)
+            journal.close()
+            self.assertEqual(stats.docs, 15)
+            self.assertTrue(sent[2].startswith('<add><doc>') and '>010<' in sent[2] and not '>009<' in sent[2])
+            self.assertEqual(solrcl.LoadJournal(path).checkpoint, 24)
+        finally:
+            os.remove(path)
+
+    def test_loadDocs_spool(self):
+        self._mock_doc_fields('myid')
+        sent = []
+        def mocked_update(parameters={}, data=None, dataMIMEType=None):
+            for x in data:
+                if x == '</add>':
+                    break
+                if x.startswith('<doc'):
+                    sent.append(x)
+            return {'responseHeader': {'status': 0, 'QTime': 1}}
+        self.solr.update = mock.Mock(side_effect=mocked_update)
+        docs = (solrcl.SOLRDocument(u'%03d' % x, self.solr) for x in range(50))
+        self.solr.loadDocs(docs, queue_size=2, spool=True)
+        self.assertEqual(len(sent), 50)
+        self.assertTrue('001' in sent[1])
+
+
+class TestIterJSONDocs(unittest.TestCase):
+    def test_chunks(self):
+        response = u'{"responseHeader":{"status":0},"response":{"numFound":2,"docs":[ {"id":"a]{,"} ,\n{"id":"\u00e0"}\n]}}'
+        for size in (1, 3, 1000):
+            self.assertEqual(list(solrcl.iterJSONDocs(response[i:i+size] for i in range(0, len(response), size))), [{'id': u'a]{,'}, {'id': u'\xe0'}])
+
+    def test_truncated(self):
+        self.assertRaises(solrcl.SOLRResponseFormatError, list, solrcl.iterJSONDocs([u'{"response":{"docs":[{"id":"a"}']))
+        self.assertRaises(solrcl.SOLRResponseFormatError, list, solrcl.iterJSONDocs([u'{"response":{}}']))
+
+
+class TestSpoolQueue(unittest.TestCase):
+    def test_fifo(self):
+        q = solrcl.SpoolQueue(memory_size=2)
+        for x in range(5):
+            q.put('doc%d' % x, False)
+        self.assertEqual(q.qsize(), 5)
+        self.assertEqual(len(q.queue), 2)
+        self.assertEqual(q.get(), 'doc0')
+        q.put(u'doc5', False)
+        self.assertEqual([q.get() for _ in range(5)], ['doc1', 'doc2', 'doc3', 'doc4', u'doc5'])
+        self.assertTrue(q.empty())
+        #Spool is reused after being emptied
+        for x in range(4):
+            q.put(['batch', x], False)
+        self.assertEqual([q.get()[1] for _ in range(4)], [0, 1, 2, 3])
+        q.close()
+
+
+class TestSerializerPool(unittest.TestCase):
+    def setUp(self):
+        self.solr = solrcl.SOLRSchema('id', {'id': solrcl.SOLRField('id', solrcl.SOLRType('string', 'org.apache.solr.schema.StrField')), 'date': solrcl.SOLRField('date', solrcl.SOLRType('date', 'org.apache.solr.schema.TrieDateField'))})
+
+    def test_serialize(self):
+        docs = []
+        for x in range(10):
+            doc = solrcl.SOLRDocument(u'%d' % x, self.solr)
+            doc.setField('date', datetime.datetime(2015, 1, 1 + x))
+            doc.addChild(solrcl.SOLRDocument(u'%d.1' % x, self.solr))
+            docs.append(doc)
+        pool = solrcl.SerializerPool(processes=2, chunksize=3, wire_format='json')
+        try:
+            out = list(pool.serialize((x, None if x == 5 else doc, x % 2 == 0) for (x, doc) in enumerate(docs)))
+        finally:
+            pool.close()
+        self.assertEqual([x for (x, _) in out], range(10))
+        self.assertEqual(out[5][1], None)
+        self.assertEqual(json.loads(out[1][1]), docs[1].toDict(update=False))
+        self.assertEqual(json.loads(out[2][1]), docs[2].toDict(update=True))
+
+    def test_serialize_error(self):
+        doc = solrcl.SOLRDocument(u'a', self.solr)
+        #Skips field check
+        doc._fields['date'] = [u'not a date']
+        pool = solrcl.SerializerPool(processes=1, ordered=False)
+        try:
+            self.assertRaises(ValueError, list, pool.serialize([(0, doc, True)]))
+        finally:
+            pool.close()
+
+
+class TestSOLRSchema(unittest.TestCase):
+    def setUp(self):
+        strtype = solrcl.SOLRType('string', 'org.apache.solr.schema.StrField')
+        fields = {'id': solrcl.SOLRField('id', strtype), 'tags': solrcl.SOLRField('tags', strtype, multi=True, docValues=True)}
+        fields['all'] = solrcl.SOLRField('all', solrcl.SOLRType('text', 'org.apache.solr.schema.TextField'), multi=True, copySources=[fields['id'], fields['tags']])
+        self.schema = solrcl.SOLRSchema('id', fields)
+
+    def test_immutable(self):
+        self.assertRaises(AttributeError, setattr, self.schema, 'id_field', 'tags')
+        self.assertRaises(TypeError, self.schema.fields.__setitem__, 'x', self.schema.fields['id'])
+        self.assertRaises(TypeError, self.schema.fields.update, {})
+        self.assertRaises(TypeError, self.schema.fields.pop, 'id')
+        fields = pickle.loads(pickle.dumps(self.schema.fields))
+        self.assertTrue(isinstance(fields, solrcl.schema.ReadOnlyDict))
+        self.assertEqual(sorted(fields), sorted(self.schema.fields))
+
+    def test_unpickled_cache(self):
+        schema = pickle.loads(pickle.dumps(solrcl.SOLRSchema('other', {})))
+        state = schema._getState()
+        self.assertTrue(state in solrcl.schema._unpickled)
+        del schema
+        #Not kept once unreferenced
+        self.assertFalse(state in solrcl.schema._unpickled)
+
+    def test_pickle(self):
+        schema = pickle.loads(pickle.dumps(self.schema, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(schema, self.schema)
+        self.assertTrue(schema.fields['tags'].multi and schema.fields['tags'].docValues)
+        self.assertEqual([f.name for f in schema.fields['all'].copySources], ['id', 'tags'])
+        self.assertEqual(schema.fields['all'].type.serialize(u'x'), u'x')
+        #Unpickled schemas are shared
+        self.assertTrue(pickle.loads(pickle.dumps(self.schema)) is schema)
+
+    def test_pickle_document(self):
+        doc = solrcl.SOLRDocument(u'a', self.schema)
+        doc.setField('tags', [u'x', u'y'])
+        child = solrcl.SOLRDocument(u'a.1', self.schema)
+        child.addChild(solrcl.SOLRDocument(u'a.1.1', self.schema))
+        doc.addChild(child)
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            unpickled = pickle.loads(pickle.dumps(doc, protocol))
+            self.assertEqual(unpickled, doc)
+            self.assertEqual(unpickled.toXML(), doc.toXML())
+            self.assertTrue(unpickled.getChildDocs()[0].getChildDocs()[0].solr is unpickled.solr)
+
+    def test_core_schema(self):
+        solr = solrcl.SOLRCore.__new__(solrcl.SOLRCore)
+        solr.id_field = 'id'
+        solr.fields = dict(self.schema.fields)
+        self.assertTrue(solr.schema is solr.schema)
+        self.assertTrue(solrcl.SOLRDocument(u'a', solr).solr is solr.schema)
+        #Rebuilt when fields are reloaded
+        schema = solr.schema
+        solr.fields = dict(self.schema.fields)
+        self.assertFalse(solr.schema is schema)
+
+
+class TestIdStores(unittest.TestCase):
+    def test_sorted(self):
+        store = solrcl.idstore.SortedIdStore()
+        for x in (u'a', u'b', u'b', u'c\xe0', 'd'):
+            store.add(x)
+        store.freeze()
+        self.assertEqual(len(store), 4)
+        self.assertTrue(u'c\xe0' in store and 'd' in store and u'a' in store)
+        self.assertFalse(u'c' in store or u'' in store or u'e' in store)
+        self.assertEqual(store.nbytes, 6 + 5 * 4)
+
+    def test_sorted_unsorted_input(self):
+        store = solrcl.idstore.SortedIdStore()
+        values = [7, 3, 11, 3, 100, 1]
+        for x in values:
+            store.add(x)
+        store.freeze()
+        self.assertEqual(len(store), 5)
+        for x in values:
+            self.assertTrue(x in store)
+        self.assertFalse(2 in store or 1000 in store)
+
+    def test_bloom(self):
+        store = solrcl.idstore.BloomIdStore(capacity=100, error_rate=0.01)
+        for x in range(1000):
+            store.add(u'id%d' % x)
+        #Grows as a chain of filters
+        self.assertEqual(len(store._filters), 4)
+        self.assertEqual(len(store), 1000)
+        self.assertTrue(all(u'id%d' % x in store for x in range(1000)))
+        false_positives = sum(1 for x in range(10000) if u'other%d' % x in store)
+        self.assertTrue(false_positives < 200)
+
+        #Exact fallback on positive hits
+        fallback = mock.Mock(return_value=False)
+        store.fallback = fallback
+        self.assertFalse(u'id1' in store)
+        fallback.assert_called_once_with(u'id1')
+
+    def test_newIdStore(self):
+        self.assertTrue(isinstance(solrcl.idstore.newIdStore('set'), solrcl.idstore.SetIdStore))
+        f = lambda x: True
+        self.assertTrue(solrcl.idstore.newIdStore('bloom', fallback=f).fallback is f)
+        self.assertRaises(ValueError, solrcl.idstore.newIdStore, 'btree')
+
+
+class TestCacheManager(unittest.TestCase):
+    def test_lru_budget(self):
+        cache = solrcl.CacheManager(max_bytes=100)
+        cache.set('a', 'A', size=40)
+        cache.set('b', 'B', size=40)
+        self.assertEqual(cache['a'], 'A')
+        cache.set('c', 'C', size=40)
+        #b is the least recently used
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.nbytes, 80)
+        self.assertEqual(cache.evictions, 1)
+        #Too big to be stored
+        self.assertEqual(cache.set('d', 'D', size=200), 'D')
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertAlmostEqual(cache.hitRatio, 2 / 3.0)
+
+    def test_size(self):
+        cache = solrcl.CacheManager()
+        store = solrcl.SortedIdStore()
+        store.add(u'abc')
+        cache['store'] = store
+        self.assertEqual(cache.nbytes, store.nbytes)
+        del cache['store']
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_wasEvicted(self):
+        cache = solrcl.CacheManager(max_bytes=100)
+        cache.set('a', 'A', size=200)
+        self.assertTrue(cache.wasEvicted('a'))
+        cache.set('a', 'A', size=60)
+        self.assertFalse(cache.wasEvicted('a'))
+        cache.set('b', 'B', size=60)
+        self.assertTrue(cache.wasEvicted('a'))
+        cache.clear()
+        self.assertFalse(cache.wasEvicted('a'))
+
+    def test_ttl(self):
+        cache = solrcl.CacheManager(ttl=0.05)
+        cache.set('a', 'A', size=1)
+        self.assertTrue('a' in cache)
+        time.sleep(0.1)
+        self.assertRaises(KeyError, cache.__getitem__, 'a')
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_invalidateIds(self):
+        cache = solrcl.CacheManager(max_stale=3)
+        cache.set('ids', set(['a', 'b']), ids=True)
+        cache.set('other', 'x')
+        cache.invalidateIds(['a', 'c'])
+        self.assertTrue(cache.isStale('ids', 'a'))
+        self.assertFalse(cache.isStale('ids', 'b'))
+        self.assertFalse(cache.has_key('other'))
+        cache.invalidateIds(['a'])
+        self.assertTrue(cache.has_key('ids'))
+        #More than max_stale ids
+        cache.invalidateIds(['d', 'e'])
+        self.assertFalse(cache.has_key('ids'))
+        self.assertEqual(cache.invalidations, 2)
+        self.assertEqual(cache.nbytes, 0)
+
+
+class TestResultCache(unittest.TestCase):
+    def test_set_after_version_change(self):
+        cache = solrcl.ResultCache(check_interval=0)
+        cache.checkVersion(lambda: 1)
+        key = cache.key({'q': 'a'})
+        cache.checkVersion(lambda: 2)
+        #Response requested with the old index version is not stored
+        cache.set(key, {'response': {}}, 1)
+        self.assertEqual(cache.get(key), None)
+        cache.set(key, {'response': {}}, 2)
+        self.assertEqual(cache.get(key), {'response': {}})
+        self.assertEqual(cache.version_checks, 2)
+
+    def test_key(self):
+        self.assertEqual(solrcl.ResultCache.key({'q': 'caf\xc3\xa8', 'rows': 10}), solrcl.ResultCache.key({'q': 'caf\xc3\xa8', 'rows': '10', 'wt': 'json'}))
+        self.assertNotEqual(solrcl.ResultCache.key({'sort': ['a', 'b']}), solrcl.ResultCache.key({'sort': ['b', 'a']}))
+
+    def test_budget(self):
+        cache = solrcl.ResultCache(max_bytes=solrcl.cache.deepSizeOf({'docs': [u'x' * 100]}) * 2, check_interval=0)
+        cache.checkVersion(lambda: 1)
+        for q in ('a', 'b', 'c'):
+            cache.set(cache.key({'q': q}), {'docs': [u'x' * 100]}, 1)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(cache.key({'q': 'a'})), None)
+
+
+class TestLoadJournal(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(prefix='solrcl_journal_')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_checkpoint(self):
+        journal = solrcl.LoadJournal(self.path)
+        self.assertEqual(journal.checkpoint, None)
+        items = journal.track(journal.resume(['a', 'b', 'c', 'd']))
+        self.assertEqual([items.next() for _ in range(3)], [(0, 'a'), (1, 'b'), (2, 'c')])
+        #Checkpoint waits for all previous positions
+        journal.done([1, 2])
+        self.assertEqual(journal.checkpoint, None)
+        journal.done([0])
+        self.assertEqual(journal.checkpoint, 2)
+        journal.close()
+
+        #A truncated line is ignored
+        with open(self.path, 'a') as fh:
+            fh.write('3')
+        journal = solrcl.LoadJournal(self.path)
+        self.assertEqual(journal.checkpoint, 2)
+        self.assertEqual(list(journal.resume(['a', 'b', 'c', 'd'])), [(3, 'd')])
+        journal.close()
+
+    def test_dispatcher(self):
+        journal = solrcl.LoadJournal(self.path)
+        sent = []
+        d = solrcl.UpdateDispatcher(lambda batch: sent.extend(batch), batch_size=2, journal=journal)
+        d.run(journal.track([(0, 'a'), (1, None), (5, 'b'), (9, 'c')]))
+        journal.close()
+        self.assertEqual(sent, ['a', 'b', 'c'])
+        self.assertEqual(solrcl.LoadJournal(self.path).checkpoint, 9)
+
+    def test_dispatcher_error(self):
+        journal = solrcl.LoadJournal(self.path)
+        def send(batch):
+            if 'c' in batch:
+                raise solrcl.SOLRResponseError("Error")
+        d = solrcl.UpdateDispatcher(send, batch_size=2, journal=journal)
+        d.run(journal.track(enumerate(['a', 'b', 'c', 'd', 'e'])))
+        journal.close()
+        self.assertEqual(solrcl.LoadJournal(self.path).checkpoint, 1)
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def test_aimd(self):
+        c = solrcl.ConcurrencyController(min_parallel=1, max_parallel=4, latency_target=1.0)
+        stop = threading.Event()
+        #Additive increase: one step after limit good batches
+        for limit in (1, 2, 2, 3, 3, 3):
+            self.assertEqual(c.limit, limit)
+            c.record(c.acquire(stop), 0.1)
+            c.release()
+        self.assertEqual(c.limit, 4)
+        for _ in range(8):
+            c.record(0, 0.1)
+        self.assertEqual(c.limit, 4)
+
+        #Multiplicative decrease once per round
+        tokens = [c.acquire(stop) for _ in range(4)]
+        self.assertEqual(c.in_flight, 4)
+        c.record(tokens[0], 0.1, ok=False)
+        self.assertEqual(c.limit, 2)
+        c.record(tokens[1], 5.0)
+        self.assertEqual(c.limit, 2)
+        for _ in range(4):
+            c.release()
+        c.record(c.acquire(stop), 5.0)
+        c.release()
+        self.assertEqual(c.limit, 1)
+        self.assertEqual([x[1] for x in c.history], [1, 2, 3, 4, 2, 1])
+        self.assertTrue(1.0 <= c.meanLimit() <= 4.0)
+
+    def test_acquire_stop(self):
+        c = solrcl.ConcurrencyController(min_parallel=1, max_parallel=2)
+        stop = threading.Event()
+        c.acquire(stop)
+        stop.set()
+        self.assertEqual(c.acquire(stop), None)
+
+    def test_latency_baseline(self):
+        c = solrcl.ConcurrencyController(min_parallel=1, max_parallel=8, start=4, tolerance=2.0)
+        c.record(0, 0.1)
+        c.record(0, 0.15)
+        self.assertEqual(c.limit, 4)
+        #Slower than twice the fastest batch
+        c.record(0, 0.3)
+        self.assertEqual(c.limit, 2)
+
+
+class TestUpdateDispatcher(unittest.TestCase):
+    def test_retry(self):
+        attempts = []
+        def send(batch):
+            attempts.append(batch)
+            if len(attempts) == 2:
+                raise solrcl.SOLRNetworkError("Timeout")
+        d = solrcl.UpdateDispatcher(send, batch_size=2, retry=(solrcl.SOLRNetworkError,), retry_delay=0.001)
+        stats = d.run(['a', 'b', 'c', 'd'])
+        self.assertEqual(d.errors, [])
+        self.assertEqual(attempts, [['a', 'b'], ['c', 'd'], ['c', 'd']])
+        self.assertEqual(stats.retries, 1)
+
+        d = solrcl.UpdateDispatcher(mock.Mock(side_effect=solrcl.SOLRNetworkError("Timeout")), retry=(solrcl.SOLRNetworkError,), max_retries=2, retry_delay=0.001)
+        stats = d.run(['a'])
+        self.assertEqual(d.errors[0][0], solrcl.SOLRNetworkError)
+        self.assertEqual(stats.retries, 2)
+
+    def test_retry_backoff(self):
+        attempts = []
+        def send(batch):
+            attempts.append(time.time())
+            raise solrcl.SOLRNetworkError("Connection refused")
+        d = solrcl.UpdateDispatcher(send, retry=(solrcl.SOLRNetworkError,), max_retries=3, retry_delay=0.05, max_retry_delay=0.08)
+        d.run(['a'])
+        self.assertEqual(len(attempts), 4)
+        delays = [attempts[i + 1] - attempts[i] for i in range(3)]
+        #0.05, 0.1 capped to 0.08, 0.08
+        self.assertTrue(delays[0] >= 0.05 and delays[1] >= 0.08 and delays[2] >= 0.08)
+
+    def test_bisect_retry(self):
+        sent = []
+        def send(batch):
+            sent.append(list(batch))
+            if batch == ['c', 'd'] and sent.count(['c', 'd']) == 1:
+                raise solrcl.SOLRNetworkError("Timeout")
+            if 'c' in batch:
+                raise ValueError("bad doc")
+        d = solrcl.UpdateDispatcher(send, batch_size=4, bisect=(ValueError,), retry=(solrcl.SOLRNetworkError,), retry_delay=0.001)
+        stats = d.run(['a', 'b', 'c', 'd'])
+        self.assertEqual(d.errors, [])
+        #Only the request that failed is sent again
+        self.assertEqual(sent, [['a', 'b', 'c', 'd'], ['a', 'b'], ['c', 'd'], ['c', 'd'], ['c'], ['d']])
+        self.assertEqual([x[0] for x in d.failed], ['c'])
+        self.assertEqual((stats.docs, stats.failed, stats.retries), (3, 1, 1))
+
+    def test_run_adaptive(self):
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'max_in_flight': 0, 'sent': 0}
+        def send(batch):
+            with lock:
+                state['in_flight'] += 1
+                state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+                overloaded = state['in_flight'] > 3
+            #Requests fail when SOLR is overloaded
+            time.sleep(0.01)
+            with lock:
+                state['in_flight'] -= 1
+                state['sent'] += len(batch)
+            if overloaded:
+                raise solrcl.SOLRNetworkError("Timeout")
+        c = solrcl.ConcurrencyController(min_parallel=1, max_parallel=8, latency_target=1.0)
+        d = solrcl.UpdateDispatcher(send, batch_size=1, retry=(solrcl.SOLRNetworkError,), max_retries=100, adaptive=c, retry_delay=0.001, max_retry_delay=0.01)
+        stats = d.run(str(x) for x in range(200))
+        self.assertEqual(d.errors, [])
+        self.assertEqual(stats.docs, 200)
+        self.assertEqual(stats.concurrency, c.history)
+        self.assertTrue(state['max_in_flight'] <= 8)
+        self.assertTrue(max(x[1] for x in c.history) >= 4)
+        self.assertTrue(stats.retries > 0)
+        self.assertTrue(c.limit < 8)
+
+    def test_run_spool(self):
+        sent = []
+        d = solrcl.UpdateDispatcher(lambda batch: sent.extend(batch), parallel=1, batch_size=2, spool=True)
+        d.run(str(x) for x in range(21))
+        self.assertEqual(sent, [str(x) for x in range(21)])
+
+    def test_bisect(self):
+        def send(batch):
+            if 'x' in batch:
+                raise ValueError("bad doc")
+        d = solrcl.UpdateDispatcher(send, batch_size=8, bisect=(ValueError,))
+        stats = d.run(['a', 'b', 'x', 'c', 'd', 'e', 'f', 'x', 'g'])
+        self.assertEqual(d.errors, [])
+        self.assertEqual([x[0] for x in d.failed], ['x', 'x'])
+        self.assertEqual(stats.docs, 7)
+
+    def test_bisect_other_errors(self):
+        send = mock.Mock(side_effect=TypeError)
+        d = solrcl.UpdateDispatcher(send, batch_size=8, bisect=(ValueError,))
+        d.run(['a', 'b'])
+        self.assertEqual(d.errors[0][0], TypeError)
+        self.assertEqual(send.call_count, 1)
+
+    def test_batches(self):
+        d = solrcl.UpdateDispatcher(mock.Mock(), batch_size=3, batch_bytes=10)
+        xmldocs = ['aa', 'bb', 'cc', 'dd', 'eeeeeeee', 'ffffffffffff', 'g']
+        self.assertEqual(list(d.batches(xmldocs)), [['aa', 'bb', 'cc'], ['dd', 'eeeeeeee'], ['ffffffffffff'], ['g']])
+
+    def test_run(self):
+        sent = []
+        lock = threading.Lock()
+        def send(batch):
+            with lock:
+                sent.extend(batch)
+        d = solrcl.UpdateDispatcher(send, parallel=3, batch_size=7, batch_bytes=None)
+        stats = d.run(str(x) for x in range(100))
+        self.assertEqual(sorted(sent, key=int), [str(x) for x in range(100)])
+        self.assertEqual(d.errors, [])
+        self.assertEqual(stats.docs, 100)
+        self.assertEqual(len(stats.batches), 15)
+
+    def test_run_no_idle_wait(self):
+        d = solrcl.UpdateDispatcher(mock.Mock(), parallel=3, batch_size=1)
+        start = time.time()
+        d.run(['a', 'b', 'c'])
+        #Workers end as soon as the queue is drained
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_run_error(self):
+        send = mock.Mock(side_effect=solrcl.SOLRResponseError("Error"))
+        d = solrcl.UpdateDispatcher(send, parallel=2, batch_size=1)
+        d.run(str(x) for x in range(100))
+        self.assertEqual(d.errors[0][0], solrcl.SOLRResponseError)
+        #Dispatching stops at first error
+        self.assertTrue(send.call_count < 100)
+
+
 if __name__ == '__main__':
         logger = logging.getLogger('solrcl')
         loghandler = logging.StreamHandler()